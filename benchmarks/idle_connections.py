@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Idle connection memory benchmark for python -m pywebtv.
+
+Starts the server against a throwaway stub service, opens many keep-alive connections that each make one request as
+a different box and then sit idle, and reports how much the server's resident memory grew per connection. Every
+connection is checked against the IP blacklist, so the database in --config has to be reachable; state is kept in
+memory and rate limiting is turned off, since all the boxes come from one address. Reads /proc, so Linux only.
+"""
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+box_headers = {
+    'wtv-capability-flags': '10935ffc8f',
+    'wtv-client-rom-type': 'bf0app',
+    'wtv-system-version': '7181',
+    'wtv-client-bootrom-version': '105',
+    'wtv-system-chipversion': '51511296',
+    'Accept-Language': 'en-US'
+}
+
+
+def write_fixture(directory: str, config_path: str, port: int):
+    service_dir = os.path.join(directory, 'service')
+    os.makedirs(os.path.join(service_dir, 'config'))
+    with open(os.path.join(service_dir, 'config', 'service.json'), 'w') as fh:
+        json.dump({'name': 'wtv-benchmark', 'stub': True, 'port': port}, fh)
+    with open(config_path) as fh:
+        config = json.load(fh)
+    config.update({
+        'state': {'backend': 'memory'},
+        'ratelimit': dict(),
+        'logging': {'level': 'WARNING', 'access_log': None}
+    })
+    config_path = os.path.join(directory, 'config.json')
+    with open(config_path, 'w') as fh:
+        json.dump(config, fh)
+    return config_path, service_dir
+
+
+def status(pid: int):
+    """
+    Returns the server's resident memory in KiB and its thread count.
+    """
+    fields = dict()
+    with open(f'/proc/{pid}/status') as fh:
+        for line in fh:
+            key, _, value = line.partition(':')
+            fields[key] = value.split()[0] if value.split() else ''
+    return int(fields['VmRSS']), int(fields['Threads'])
+
+
+def wait_for_port(port: int, server: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'pywebtv exited with {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'pywebtv did not start listening on port {port}')
+
+
+def open_box(port: int, number: int):
+    """
+    Connects as box number, makes one request and returns the still open socket.
+    """
+    sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+    headers = dict(box_headers, **{'wtv-client-serial-number': f'8100000000{number:06x}'})
+    request = 'GET wtv-benchmark:/idle\r\n' + ''.join(f'{key}: {value}\r\n' for key, value in headers.items())
+    sock.sendall((request + '\r\n').encode())
+    response = b''
+    while b'\r\n\r\n' not in response:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise RuntimeError(f'Connection {number} was closed by the server: {response[:200]!r}')
+        response += chunk
+    head, _, body = response.partition(b'\r\n\r\n')
+    for line in head.split(b'\r\n')[1:]:
+        key, _, value = line.partition(b':')
+        if key.strip().lower() == b'content-length':
+            length = int(value)
+            while len(body) < length:
+                body += sock.recv(length - len(body))
+    return sock
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 benchmarks/idle_connections.py')
+    parser.add_argument('--config', '-c', default=os.path.join(root, 'config.json'),
+                        help='config.json with the database to use.')
+    parser.add_argument('--connections', '-n', type=int, default=10000, help='Idle connections to open.')
+    parser.add_argument('--port', '-p', type=int, default=18602, help='Port for the throwaway service.')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help='Connections opened before the baseline is taken, so it includes one-time costs.')
+    parser.add_argument('--budget-kb', type=float,
+                        help='Exit with status 1 if a connection costs more than this many KiB.')
+    args = parser.parse_args()
+
+    # the server inherits the raised limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.connections + args.warmup + 256
+    if soft < wanted:
+        if hard != resource.RLIM_INFINITY and hard < wanted:
+            print(f'The open file limit ({hard}) is too low for {args.connections} connections.')
+            sys.exit(1)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    with tempfile.TemporaryDirectory() as directory:
+        config, service_dir = write_fixture(directory, args.config, args.port)
+        server = subprocess.Popen([sys.executable, '-m', 'pywebtv', '--config', config, '--service', service_dir,
+                                   '--bind', '127.0.0.1'], cwd=root, stdout=subprocess.DEVNULL)
+        sockets = list()
+        try:
+            wait_for_port(args.port, server)
+            sockets += [open_box(args.port, number) for number in range(args.warmup)]
+            time.sleep(1)
+            baseline, baseline_threads = status(server.pid)
+
+            started = time.perf_counter()
+            for number in range(args.warmup, args.warmup + args.connections):
+                sockets.append(open_box(args.port, number))
+            elapsed = time.perf_counter() - started
+            time.sleep(1)
+            rss, threads = status(server.pid)
+        finally:
+            for sock in sockets:
+                sock.close()
+            server.terminate()
+            server.wait(timeout=30)
+
+    per_connection = (rss - baseline) / args.connections
+    print(f'opened {args.connections} idle connections in {elapsed:.1f}s ({threads - baseline_threads} new threads)')
+    print(f'RSS {baseline / 1024:.1f}MiB -> {rss / 1024:.1f}MiB, {per_connection:.1f}KiB per connection')
+    if args.budget_kb is not None and per_connection > args.budget_kb:
+        print(f'over the {args.budget_kb:.0f}KiB budget')
+        sys.exit(1)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Cold-start benchmark for python -m pywebtv.
+
+Starts the server repeatedly in the same mode as --profile-startup (every import and startup phase, then exit before
+serving) against a throwaway stub service with the in-memory state backend, so it needs no database or Redis.
+Postgres isn't contacted during startup, so the placeholder credentials are never used.
+"""
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_fixture(directory: str, port: int):
+    service_dir = os.path.join(directory, 'service')
+    os.makedirs(os.path.join(service_dir, 'config'))
+    with open(os.path.join(service_dir, 'config', 'service.json'), 'w') as fh:
+        json.dump({'name': 'wtv-benchmark', 'stub': True, 'port': port}, fh)
+    config = os.path.join(directory, 'config.json')
+    with open(config, 'w') as fh:
+        json.dump({
+            'db': {'psql': {'host': 'localhost', 'port': 5432, 'username': 'benchmark', 'password': 'benchmark',
+                            'database': 'benchmark'}},
+            'state': {'backend': 'memory'},
+            'logging': {'level': 'WARNING'}
+        }, fh)
+    return config, service_dir
+
+
+def run_once(config: str, service_dir: str):
+    started = time.perf_counter()
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'pywebtv', '--config', config,
+                            '--service', service_dir, '--bind', '127.0.0.1', '--profile-startup'],
+                           cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                           env=dict(os.environ, PYWEBTV_PROFILE_STARTUP='1'))
+    wall = time.perf_counter() - started
+    if child.returncode != 0:
+        raise RuntimeError(f'pywebtv exited with {child.returncode}:\n{child.stderr[-2000:]}')
+    return wall
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 benchmarks/startup.py')
+    parser.add_argument('--runs', '-n', type=int, default=10, help='Number of cold starts.')
+    parser.add_argument('--port', '-p', type=int, default=18600, help='Port for the throwaway service.')
+    parser.add_argument('--budget-ms', type=float,
+                        help='Exit with status 1 if the median start takes longer than this.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config, service_dir = write_fixture(directory, args.port)
+        run_once(config, service_dir)  # warm the bytecode cache so every run measures the same thing
+        times = [run_once(config, service_dir) * 1000 for _ in range(args.runs)]
+
+    median = statistics.median(times)
+    print(f'cold start over {args.runs} runs: median {median:.0f}ms, min {min(times):.0f}ms, max {max(times):.0f}ms')
+    if args.budget_ms is not None and median > args.budget_ms:
+        print(f'over the {args.budget_ms:.0f}ms budget')
+        sys.exit(1)
@@ -1,29 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import csv
+import gzip
+import io
 import json
+import os
 import redis
 import sqlalchemy
-from marshmallow_sqlalchemy import SQLAlchemyAutoSchema, auto_field
-from redis.commands.json.path import Path
-from sqlalchemy.ext.declarative import declarative_base
+import sqlalchemy.orm
+import sys
+import time
+from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
+from pywebtv import migrations
+from pywebtv.models import Base, IPBlacklist, Subscribers, Terminals, Users
+from pywebtv.state import create_store, redis_nodes
 from sqlalchemy.sql import text
 from urllib.parse import quote
 
 print(
     'pyWebTV database management tool\nhttps://github.com/samicrusader/pyWebTV\nTAKE BACKUPS WHEN USING THIS TOOL!!!!\n')
 
-Base = declarative_base()
-
-
-class IPBlacklist(Base):
-    __tablename__ = "ipblacklist"
-    ip = sqlalchemy.Column(sqlalchemy.String(length=15),
-                           unique=True, nullable=False, primary_key=True)
-    expires = sqlalchemy.Column(
-        sqlalchemy.DateTime, unique=False, nullable=True)
-    reason = sqlalchemy.Column(sqlalchemy.String(
-        length=100), unique=False, nullable=False)
-
 
 class IPBlacklistSchema(SQLAlchemyAutoSchema):
     class Meta:
@@ -31,154 +27,24 @@ class IPBlacklistSchema(SQLAlchemyAutoSchema):
         include_fk = True
 
 
-class Subscribers(Base):
-    __tablename__ = "subscribers"
-    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-
-    # Required
-    user = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
-    subscriber_category = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    registration_ip = sqlalchemy.Column(
-        sqlalchemy.String(length=15), unique=False, nullable=False)
-    cancelled = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    terminated = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-
-
 class SubscribersSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = Subscribers
         include_fk = True
 
 
-class Terminals(Base):
-    __tablename__ = "terminals"
-    ssid = sqlalchemy.Column(sqlalchemy.String(
-        length=16), primary_key=True, unique=True, nullable=False)
-    subscriber = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-
-
 class TerminalsSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = Terminals
         include_fk = True
 
 
-class Users(Base):
-    __tablename__ = "users"
-    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-
-    # Required
-    username = sqlalchemy.Column(sqlalchemy.String(
-        length=12), unique=True, nullable=False)
-    # FIXME: something something argon2id compatible settings
-    password = sqlalchemy.Column(sqlalchemy.String(
-        length=100), unique=False, nullable=False)
-    timezone = sqlalchemy.Column(sqlalchemy.String(
-        length=5), unique=False, nullable=False)
-    is_subscriber = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    subscriber = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    registration_ip = sqlalchemy.Column(
-        sqlalchemy.String(length=15), unique=False, nullable=False)
-
-    # User information
-    first_name = sqlalchemy.Column(sqlalchemy.String(
-        length=18), unique=False, nullable=False)
-    last_name = sqlalchemy.Column(sqlalchemy.String(
-        length=18), unique=False, nullable=True)
-
-    # Socialization
-    irc_nick = sqlalchemy.Column(sqlalchemy.String(
-        length=8), unique=True, nullable=False)
-    has_mail_account = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    mail_username = sqlalchemy.Column(
-        sqlalchemy.String(length=12), unique=True, nullable=True)
-    mail_password = sqlalchemy.Column(
-        sqlalchemy.String(length=256), unique=True, nullable=True)
-    has_news_account = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    news_username = sqlalchemy.Column(
-        sqlalchemy.String(length=12), unique=True, nullable=True)
-    news_password = sqlalchemy.Column(
-        sqlalchemy.String(length=256), unique=True, nullable=True)
-    messenger_enabled = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    messenger_server = sqlalchemy.Column(
-        sqlalchemy.String(length=253), unique=False, nullable=True)
-    # FIXME: Escargot password WILL be encrypted. No clue what the output is.
-    messenger_password = sqlalchemy.Column(
-        sqlalchemy.String(length=20), unique=True, nullable=True)
-    wtv_domain = sqlalchemy.Column(sqlalchemy.String(
-        length=253), unique=False, nullable=True)
-
-    # Settings
-    setup_advanced_option = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    setup_play_bgm = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    setup_bgm_tempo = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    setup_bgm_volume = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    setup_background_color = sqlalchemy.Column(
-        sqlalchemy.String(6), unique=False, nullable=False)
-    setup_font_sizes = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    setup_in_stereo = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    setup_keyboard = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    setup_link_color = sqlalchemy.Column(
-        sqlalchemy.String(6), unique=False, nullable=False)
-    setup_play_songs = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    setup_play_sounds = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    setup_text_color = sqlalchemy.Column(
-        sqlalchemy.String(6), unique=False, nullable=False)
-    setup_visited_color = sqlalchemy.Column(
-        sqlalchemy.String(6), unique=False, nullable=False)
-    setup_japan_keyboard = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    setup_chat_access_level = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-    setup_chat_on_nontrusted_page = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-    setup_tv_chat_level = sqlalchemy.Column(
-        sqlalchemy.Integer, unique=False, nullable=False)
-
-    # Change in case of compromise
-    force_chpasswd = sqlalchemy.Column(
-        sqlalchemy.Boolean, unique=False, nullable=False)
-
-
 class UsersSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = Users
         include_fk = True
 
 
-def redis_set(name: str, data: dict):
-    """
-    ReJSON.set wrapper
-    """
-    r.json().set(name, Path.rootPath(), data)
-    return True
-
-
-def redis_get(name: str):
-    """
-    ReJSON.get wrapper
-    """
-    return r.json().get(name)
-
-
 def createdb():
     if engine.execute(
             text('select exists (select from information_schema.tables where table_schema = \'public\' and table_name = \'subscribers\' or table_name = \'terminals\' or table_name = \'users\');')).one()[
@@ -186,7 +52,195 @@ def createdb():
         input(
             'You are going to wipe your database!\nPlease Ctrl+C NOW if you do not want to do this.\nPress Enter to proceed...')
         Base.metadata.drop_all(engine)
+        engine.execute(text('drop table if exists public.schema_version'))
     Base.metadata.create_all(engine)
+    migrations.stamp(engine)
+    invalidate_accounts()
+
+
+def migratedb(target: int = None):
+    """
+    Brings an existing database up to the latest schema without dropping anything.
+    """
+    version = migrations.current_version(engine)
+    print(f'Schema version {version}, latest {migrations.latest_version()}.')
+    version = migrations.migrate(engine, target)
+    print(f'Schema is at version {version}.')
+    checkdb()
+
+
+def checkdb():
+    """
+    Prints the schema version and any lookup columns without an index. Returns False if something needs attention.
+    """
+    version = migrations.current_version(engine)
+    ok = version == migrations.latest_version()
+    if not ok:
+        print(f'Schema version {version} is behind {migrations.latest_version()}; run --migrate.')
+    for table, column in migrations.missing_indexes(engine):
+        print(f'Missing index on {table}.{column}.')
+        ok = False
+    if ok:
+        print('Schema is up to date.')
+    return ok
+
+
+def invalidate_accounts(ssid: str = None):
+    """
+    Drops cached accounts on every running server. Call this after changing terminals, subscribers or users.
+    The database change has already been committed, so a Redis failure here is only a warning.
+    """
+    if full_config.get('state', dict()).get('backend', 'redis') != 'redis' or 'redis' not in full_config['db']:
+        return  # in-memory state belongs to the server process
+    try:
+        clients = {name: redis.Redis(host=node['host'], port=node['port'], db=node['db'])
+                   for name, node in redis_nodes(full_config)}
+        store = create_store(dict(full_config, state=dict(full_config.get('state', dict()), write_behind=0)),
+                             clients)
+        store.invalidate_accounts(ssid)
+    except redis.RedisError as e:
+        print(f'Could not drop cached accounts, servers may use stale ones until they expire: {e}')
+
+
+# table name: (model, schema), in the order they're imported
+tables = {
+    'users': (Users, UsersSchema),
+    'subscribers': (Subscribers, SubscribersSchema),
+    'terminals': (Terminals, TerminalsSchema),
+    'ipblacklist': (IPBlacklist, IPBlacklistSchema)
+}
+
+
+class Progress:
+    """
+    Prints a running row count for a table at most once a second.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.rows = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def add(self, rows: int):
+        self.rows += rows
+        now = time.monotonic()
+        if now - self.reported >= 1:
+            self.reported = now
+            print(f'{self.table}: {self.rows} rows ({self.rows / (now - self.started):.0f}/s)', end='\r', flush=True)
+
+    def done(self, verb: str):
+        print(f'{self.table}: {verb} {self.rows} rows in {time.monotonic() - self.started:.1f}s')
+
+
+class CountingWriter:
+    """
+    Passes COPY output through to a file, counting the rows as they go by.
+    """
+
+    def __init__(self, fh, progress: Progress):
+        self.fh = fh
+        self.progress = progress
+
+    def write(self, data: bytes):
+        self.progress.add(data.count(b'\n'))
+        return self.fh.write(data)
+
+
+def exportdb(directory: str, names: list):
+    """
+    Streams tables to gzipped CSV files in directory with COPY ... TO STDOUT.
+    """
+    os.makedirs(directory, exist_ok=True)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for table in names:
+            columns = ', '.join(f'"{column.name}"' for column in tables[table][0].__table__.columns)
+            progress = Progress(table)
+            with gzip.open(os.path.join(directory, f'{table}.csv.gz'), 'wb') as fh:
+                cursor.execute(f'copy public.{table} ({columns}) to stdout with (format csv, header)',
+                               stream=CountingWriter(fh, progress))
+            progress.rows -= 1  # header
+            progress.done('exported')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def import_rows(reader, schema, columns: list, batch_size: int):
+    """
+    Yields CSV batches of rows that pass schema validation, with the number of rows each holds.
+    Invalid rows are reported and left out.
+    """
+    nullable = {column.name for column in schema.Meta.model.__table__.columns if column.nullable}
+    validator = schema(session=sqlalchemy.orm.Session())  # only used for validation, never queries
+    batch = io.StringIO()
+    writer = csv.writer(batch, lineterminator='\n')
+    count = 0
+    for line, row in enumerate(reader, start=2):
+        # COPY writes NULL as an empty field
+        record = {column: (None if value == '' and column in nullable else value)
+                  for column, value in zip(columns, row)}
+        errors = validator.validate(record)
+        if errors:
+            print(f'\nline {line}: skipped, {errors}', file=sys.stderr)
+            continue
+        writer.writerow(row)
+        count += 1
+        if count >= batch_size:
+            yield batch.getvalue().encode(), count
+            batch.seek(0)
+            batch.truncate()
+            count = 0
+    if count:
+        yield batch.getvalue().encode(), count
+
+
+def importdb(directory: str, names: list, batch_size: int):
+    """
+    Loads tables from CSV files (gzipped or not) in directory with COPY ... FROM STDIN, one batch at a time.
+
+    Each table is imported in one transaction, so a failed import leaves it as it was.
+    """
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for table in names:
+            model, schema = tables[table]
+            path = os.path.join(directory, f'{table}.csv.gz')
+            opener = gzip.open
+            if not os.path.exists(path):
+                path = os.path.join(directory, f'{table}.csv')
+                opener = open
+                if not os.path.exists(path):
+                    print(f'{table}: no file, skipping')
+                    continue
+            progress = Progress(table)
+            with opener(path, 'rt', newline='') as fh:
+                reader = csv.reader(fh)
+                columns = next(reader)
+                quoted = ', '.join(f'"{column}"' for column in columns)
+                # an empty field in a NOT NULL column is an empty string, not NULL
+                not_null = ', '.join(f'"{column.name}"' for column in model.__table__.columns
+                                     if not column.nullable and column.name in columns)
+                options = f'format csv, force_not_null ({not_null})' if not_null else 'format csv'
+                for data, count in import_rows(reader, schema, columns, batch_size):
+                    cursor.execute(f'copy public.{table} ({quoted}) from stdin with ({options})',
+                                   stream=io.BytesIO(data))
+                    progress.add(count)
+            if 'id' in columns:
+                # rows came with their ids, so move the sequence past them
+                cursor.execute(f"select setval(pg_get_serial_sequence('public.{table}', 'id'), "
+                               f"coalesce((select max(id) from public.{table}), 0) + 1, false)")
+            conn.commit()
+            progress.done('imported')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    invalidate_accounts()
 
 
 if __name__ == '__main__':
@@ -196,29 +250,44 @@ if __name__ == '__main__':
         '--create', '-d', help='Create database.', action='store_true')
     parser.add_argument('--migrate', '-m',
                         help='Migrate database.', action='store_true')
+    parser.add_argument('--target', type=int,
+                        help='Schema version to migrate to (defaults to the latest).')
+    parser.add_argument('--check', '-k',
+                        help='Check the schema version and lookup indexes.', action='store_true')
+    parser.add_argument('--export', '-e', metavar='DIRECTORY',
+                        help='Export tables to gzipped CSV files in a directory.')
+    parser.add_argument('--import', '-i', metavar='DIRECTORY', dest='import_dir',
+                        help='Import tables from CSV files in a directory.')
+    parser.add_argument('--tables', '-t', nargs='+', choices=list(tables), default=list(tables),
+                        help='Tables to export or import.')
+    parser.add_argument('--batch-size', default=10000, type=int,
+                        help='Rows per COPY batch when importing.')
     parser.add_argument('--config', '-c', default='config.json',
                         help='Specify server configuration file.')
 
     args = parser.parse_args()
 
     try:
-        config = json.load(open(args.config, 'r'))['db']
+        full_config = json.load(open(args.config, 'r'))
+        config = full_config['db']
     except:
         print('Specify a config.')
         exit(1)
 
     sqlconfig = config['psql']
-    redisconfig = config['redis']
     engine = sqlalchemy.create_engine(
         f"postgresql+pg8000://{sqlconfig['username']}:{quote(sqlconfig['password'])}@{sqlconfig['host']}:{sqlconfig['port']}/{sqlconfig['database']}")
-    r = redis.Redis(
-        host=redisconfig['host'], port=redisconfig['port'], db=redisconfig['db'])
 
     if args.create:
         createdb()
     elif args.migrate:
-        # migratedb()
-        pass
+        migratedb(args.target)
+    elif args.check:
+        exit(0 if checkdb() else 1)
+    elif args.export:
+        exportdb(args.export, args.tables)
+    elif args.import_dir:
+        importdb(args.import_dir, args.tables, args.batch_size)
     else:
         parser.print_help()
         exit(1)
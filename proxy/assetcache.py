@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Content-addressed cache for transcoded assets.
+
+Processed bodies are stored once under the SHA-256 of their content in blobs/, and index/ maps the hash of
+(URL, capability class) to a blob, so the same asset reached through different URLs is only stored once.
+
+The directory is kept under max_disk_bytes. When a write goes over, expired index entries are removed first, then
+the least recently written ones, down to nine tenths of the limit, and any blob no index entry points to is deleted.
+"""
+
+
+class AssetCache:
+    """
+    Two-tier processed-asset cache: a small in-memory LRU in front of the on-disk blob store.
+    """
+
+    def __init__(self, directory: str, ttl: int = 300, max_memory_entries: int = 512,
+                 max_memory_bytes: int = 64 * 1024 * 1024, max_disk_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.evicted = 0
+        os.makedirs(os.path.join(directory, 'index'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self._disk_bytes = sum(size for _, _, size in self._files('index')) + \
+            sum(size for _, _, size in self._files('blobs'))
+
+    @staticmethod
+    def key(url: str, capability_class: str):
+        return hashlib.sha256(f'{capability_class} {url}'.encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Returns (content_type, data) for a fresh entry, or None.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+        try:
+            with open(os.path.join(self.directory, 'index', key), 'r') as fh:
+                index = json.load(fh)
+            if index['expires'] <= now:
+                raise FileNotFoundError(key)
+            with open(os.path.join(self.directory, 'blobs', index['blob']), 'rb') as fh:
+                data = fh.read()
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        self._remember(key, index['expires'], index['content_type'], data)
+        with self._lock:
+            self.hits += 1
+        return index['content_type'], data
+
+    def put(self, key: str, content_type: str, data: bytes):
+        expires = time.time() + self.ttl
+        blob = hashlib.sha256(data).hexdigest()
+        blob_path = os.path.join(self.directory, 'blobs', blob)
+        index = json.dumps({'blob': blob, 'content_type': content_type, 'expires': expires}).encode()
+        with self._disk_lock:
+            if not os.path.exists(blob_path):
+                self._write(blob_path, data)
+                self._disk_bytes += len(data)
+            self._write(os.path.join(self.directory, 'index', key), index)
+            self._disk_bytes += len(index)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+        self._remember(key, expires, content_type, data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'memory_entries': len(self._memory), 'memory_bytes': self._memory_bytes,
+                    'disk_bytes': self._disk_bytes, 'evicted': self.evicted}
+
+    def _remember(self, key: str, expires: float, content_type: str, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old:
+                self._memory_bytes -= len(old[2])
+            self._memory[key] = (expires, content_type, data)
+            self._memory_bytes += len(data)
+            while len(self._memory) > self.max_memory_entries or self._memory_bytes > self.max_memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old[2])
+
+    def _files(self, kind: str):
+        """
+        Yields (path, mtime, size) for every file in index/ or blobs/.
+        """
+        with os.scandir(os.path.join(self.directory, kind)) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        """
+        Brings the directory back under the size limit. Call with _disk_lock held.
+        """
+        now = time.time()
+        target = self.max_disk_bytes * 0.9
+        entries = list()
+        for path, mtime, size in self._files('index'):
+            try:
+                with open(path, 'r') as fh:
+                    index = json.load(fh)
+                entries.append((index['expires'] <= now, mtime, path, size, index['blob']))
+            except (OSError, ValueError, KeyError):
+                entries.append((True, mtime, path, size, None))
+        blobs = {os.path.basename(path): size for path, _, size in self._files('blobs')}
+        references = dict()
+        for entry in entries:
+            references[entry[4]] = references.get(entry[4], 0) + 1
+        total = sum(entry[3] for entry in entries) + sum(blobs.values())
+        # expired first, then oldest first
+        entries.sort(key=lambda entry: (not entry[0], entry[1]))
+        kept = list()
+        for expired, mtime, path, size, blob in entries:
+            if expired or total > target:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                references[blob] -= 1
+                if not references[blob]:
+                    # the blob goes with its last index entry
+                    total -= blobs.get(blob, 0)
+                self.evicted += 1
+                with self._lock:
+                    old = self._memory.pop(os.path.basename(path), None)
+                    if old:
+                        self._memory_bytes -= len(old[2])
+            else:
+                kept.append(blob)
+        referenced = set(kept)
+        for blob in blobs:
+            if blob not in referenced:
+                try:
+                    os.remove(os.path.join(self.directory, 'blobs', blob))
+                except OSError:
+                    pass
+        self._disk_bytes = sum(size for _, _, size in self._files('index')) + \
+            sum(size for _, _, size in self._files('blobs'))
+
+    def _write(self, path: str, data: bytes):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,178 @@
+import ipaddress
+import multiprocessing
+import os
+import threading
+import xrequests
+from assetcache import AssetCache
+from concurrent.futures import ProcessPoolExecutor
+from pywebtv.decorators import WTVPError, WTVPResponse
+from transcode import transcode_html, transcode_image
+from urllib.parse import quote, urljoin, urlsplit
+
+"""
+wtv-proxy fetches pages from the modern web and transcodes them for the box.
+
+HTML is simplified and its links are rewritten to go back through the proxy, and images are downscaled and re-encoded
+to formats the box can show. Transcoding runs in a process pool, and the results are cached by URL and capability
+class so repeated pages are served without refetching or reprocessing.
+
+Only hosts on public addresses are fetched, so the proxy can't be used to reach the server's own network. The check
+is made on the addresses the upstream connections actually use, so a name that re-resolves to a private address
+between the check and the fetch is refused too.
+"""
+
+html_types = ('text/html', 'application/xhtml+xml')
+redirect_statuses = (301, 302, 303, 307, 308)
+user_agent = 'Mozilla/4.0 WebTV/2.8 (compatible; MSIE 4.0)'
+
+_lock = threading.Lock()
+_state = dict()
+
+
+class BlockedAddress(OSError):
+    pass
+
+
+def is_public(address: str):
+    """
+    True if an IP address is globally routable, i.e. not loopback, private, link-local, reserved or multicast.
+    """
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver:
+    """
+    Resolves like xrequests' resolver, but only to public addresses. Raises BlockedAddress if a host has none.
+    """
+
+    def __init__(self, resolver: xrequests.Resolver):
+        self.resolver = resolver
+
+    def resolve(self, host: str, port: int):
+        addresses = [(family, sockaddr) for family, sockaddr in self.resolver.resolve(host, port)
+                     if is_public(sockaddr[0])]
+        if not addresses:
+            raise BlockedAddress(f'{host} has no public address')
+        return addresses
+
+    def forget(self, host: str, port: int):
+        self.resolver.forget(host, port)
+
+
+def _shared(request):
+    """
+    Returns the process pool, caches and upstream session, created on first use.
+    """
+    with _lock:
+        if not _state:
+            config = request.service_config
+            cache_dir = os.path.join(request.service_dir, config.get('cache_dir', 'cache'))
+            # forking a threaded server can copy locks held by other threads into the workers, so they're spawned
+            _state['executor'] = ProcessPoolExecutor(max_workers=config.get('transcode_workers', 2),
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            _state['assets'] = AssetCache(cache_dir, ttl=config.get('cache_ttl', 300),
+                                          max_disk_bytes=config.get('cache_max_bytes', 1024 ** 3))
+            _state['resolver'] = PublicResolver(xrequests.Resolver())
+            # its own pool, so it never reuses a connection another session opened to a private address
+            _state['pool'] = xrequests.ConnectionPool()
+            _state['session'] = xrequests.Session(pool=_state['pool'], resolver=_state['resolver'])
+        return _state
+
+
+def _capability_class(box):
+    """
+    Sorts a box into a capability class, and returns the class name with the image limits for it.
+    """
+    memory = sum(box.has(f'client-has-memory-size-bit{bit}-set') << (bit - 1) for bit in (1, 2, 3))
+    png = box.has('client-can-do-png')
+    javascript = box.has('client-can-do-javascript')
+    limits = {
+        'png': png,
+        'javascript': javascript,
+        'max_width': 544,
+        'max_height': 1024 if memory < 2 else 2048,
+        'quality': 50 if memory < 2 else 70
+    }
+    return f'png{int(png)}-js{int(javascript)}-mem{memory}', limits
+
+
+def fetch(request):
+    """
+    Fetches and transcodes ?url= for the box.
+    """
+    url = request.params.get('url', '')
+    if not url.startswith(('http://', 'https://')):
+        return WTVPError(404)
+    state = _shared(request)
+    try:
+        parts = urlsplit(url)
+        state['resolver'].resolve(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+    except (OSError, ValueError):
+        # unresolvable, or only on private addresses
+        return WTVPError(404)
+    capability_class, limits = _capability_class(request.router.box)
+    key = AssetCache.key(url, capability_class)
+
+    cached = state['assets'].get(key)
+    if cached:
+        return WTVPResponse(content_type=cached[0], data=cached[1], headers=dict())
+
+    try:
+        with state['session'].get(url, headers={'User-Agent': user_agent, 'Accept-Encoding': 'gzip, deflate'},
+                                  stream=True) as resp:
+            if resp.status in redirect_statuses and 'location' in resp.headers:
+                target = urljoin(url, resp.headers['location'])
+                return WTVPResponse(content_type='text/html', status_code=302, headers={
+                    'Location': f'{request.service_config["name"]}:/fetch?url={quote(target, safe="")}'})
+            if resp.status in (404, 410):
+                return WTVPError(404)
+            if resp.status >= 400:
+                return WTVPError(500)
+            limit = request.service_config.get('max_upstream_size', 8 * 1024 * 1024)
+            chunks = list()
+            size = 0
+            for chunk in resp.iter_content(65536):
+                size += len(chunk)
+                if size > limit:
+                    return WTVPError(500)
+                chunks.append(chunk)
+            data = b''.join(chunks)
+            content_type = resp.headers.get('content-type', 'application/octet-stream')
+    except xrequests.exceptions.RequestException:
+        return WTVPError(500)
+
+    mimetype, _, params = content_type.partition(';')
+    mimetype = mimetype.strip().lower()
+    charset = params.partition('charset=')[2].strip(' "\'') or None
+    if mimetype in html_types:
+        job = state['executor'].submit(transcode_html, data, charset, url,
+                                       f'{request.service_config["name"]}:/fetch?url=', limits['javascript'])
+    elif mimetype.startswith('image/'):
+        job = state['executor'].submit(transcode_image, data, mimetype, limits['png'], limits['max_width'],
+                                       limits['max_height'], limits['quality'])
+    else:
+        job = None
+
+    if job:
+        try:
+            content_type, data = job.result(timeout=30)
+        except Exception:
+            return WTVPError(500)
+    state['assets'].put(key, content_type, data)
+    return WTVPResponse(content_type=content_type, data=data, headers=dict())
+
+
+def stats(request):
+    """
+    Cache statistics.
+    """
+    state = _shared(request)
+    lines = [f'{name}: {value}' for name, value in state['assets'].stats().items()]
+    lines += [f'pool_{name}: {value}' for name, value in state['pool'].stats().items()]
+    return WTVPResponse(content_type='text/plain', data='\n'.join(lines).encode(), headers=dict())
@@ -0,0 +1,163 @@
+import io
+from html.parser import HTMLParser
+from urllib.parse import quote, urljoin
+
+"""
+Content transcoders for wtv-proxy.
+
+These run in the service's process pool, so they only take and return plain, picklable values.
+"""
+
+try:
+    from PIL import Image
+except ImportError:  # Images are passed through untouched without Pillow.
+    Image = None
+
+# Tags a box can't do anything useful with. Their contents are dropped too.
+dropped_tags = {'script', 'style', 'iframe', 'object', 'embed', 'video', 'audio', 'svg', 'canvas', 'template'}
+# Tags that are removed but whose contents are kept.
+unwrapped_tags = {'noscript'}
+void_tags = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track',
+             'wbr'}
+url_attributes = {'href', 'src', 'action', 'background', 'usemap'}
+
+
+class HTMLSimplifier(HTMLParser):
+    """
+    Re-emits an HTML document with unsupported elements removed and links rewritten to go through the proxy.
+    """
+
+    def __init__(self, base_url: str, proxy_prefix: str, javascript: bool):
+        super().__init__(convert_charrefs=False)
+        self.base_url = base_url
+        self.proxy_prefix = proxy_prefix
+        self.javascript = javascript
+        self.out = list()
+        self.skip_depth = 0
+        self.skip_tag = None
+
+    def rewrite_url(self, url: str):
+        url = url.strip()
+        if url.startswith(('#', 'javascript:', 'mailto:', 'wtv-', 'client:', 'file:')):
+            return url
+        return self.proxy_prefix + quote(urljoin(self.base_url, url), safe='')
+
+    def dropped(self, tag: str):
+        if tag == 'script' and self.javascript:
+            return False
+        return tag in dropped_tags
+
+    def emit_tag(self, tag: str, attrs: list, closed: bool = False):
+        parts = [tag]
+        for name, value in attrs:
+            if name.startswith('on') and not self.javascript:
+                continue
+            if name in ('srcset', 'integrity', 'crossorigin', 'loading', 'decoding'):
+                continue
+            if value is None:
+                parts.append(name)
+                continue
+            if name in url_attributes:
+                value = self.rewrite_url(value)
+            value = value.replace('&', '&amp;').replace('"', '&quot;')
+            parts.append(f'{name}="{value}"')
+        self.out.append('<' + ' '.join(parts) + (' />' if closed else '>'))
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_depth:
+            if tag == self.skip_tag:
+                self.skip_depth += 1
+            return
+        if self.dropped(tag):
+            if tag not in void_tags:
+                self.skip_tag = tag
+                self.skip_depth = 1
+            return
+        if tag in unwrapped_tags and not self.javascript:
+            return
+        if tag == 'link' and ('rel', 'stylesheet') in attrs:
+            return
+        if tag == 'base':
+            return
+        self.emit_tag(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        if self.skip_depth or self.dropped(tag):
+            return
+        if tag == 'link' and ('rel', 'stylesheet') in attrs:
+            return
+        self.emit_tag(tag, attrs, closed=True)
+
+    def handle_endtag(self, tag):
+        if self.skip_depth:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+            return
+        if tag in unwrapped_tags and not self.javascript:
+            return
+        self.out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.out.append(data)
+
+    def handle_entityref(self, name):
+        if not self.skip_depth:
+            self.out.append(f'&{name};')
+
+    def handle_charref(self, name):
+        if not self.skip_depth:
+            self.out.append(f'&#{name};')
+
+    def handle_decl(self, decl):
+        self.out.append(f'<!{decl}>')
+
+    def result(self):
+        return ''.join(self.out)
+
+
+def transcode_html(data: bytes, charset: str, base_url: str, proxy_prefix: str, javascript: bool):
+    """
+    Simplifies an HTML page for a box. Returns (content_type, data).
+    """
+    text = data.decode(charset or 'utf-8', errors='replace')
+    parser = HTMLSimplifier(base_url, proxy_prefix, javascript)
+    parser.feed(text)
+    parser.close()
+    return 'text/html', parser.result().encode('iso-8859-1', errors='xmlcharrefreplace')
+
+
+def transcode_image(data: bytes, content_type: str, png: bool, max_width: int, max_height: int, quality: int):
+    """
+    Downscales an image to fit the box's screen and re-encodes it to a format it can display.
+    Returns (content_type, data).
+    """
+    if Image is None:
+        return content_type, data
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        return content_type, data
+
+    animated = getattr(image, 'is_animated', False)
+    if animated and image.format == 'GIF' and image.width <= max_width and image.height <= max_height:
+        return 'image/gif', data
+
+    if image.width > max_width or image.height > max_height:
+        image.thumbnail((max_width, max_height))
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    out = io.BytesIO()
+    if has_alpha and png:
+        image.save(out, format='PNG', optimize=True)
+        return 'image/png', out.getvalue()
+    if image.mode == 'P' and not has_alpha:
+        image.save(out, format='GIF')
+        return 'image/gif', out.getvalue()
+    if has_alpha:
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image.convert('RGBA'), mask=image.convert('RGBA').split()[-1])
+        image = background
+    image.convert('RGB').save(out, format='JPEG', quality=quality, optimize=True)
+    return 'image/jpeg', out.getvalue()
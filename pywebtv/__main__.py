@@ -1,19 +1,20 @@
 # -*- coding: UTF-8 -*-
 
-from .server import WTVPRequestRouter, WTVPServer
-from .functions import load_json
+from . import startup
+from .context import ServiceContext
+from .logs import apply_levels, setup_logging
+from .profiler import SamplingProfiler
+from .server import WTVPPooledServer, WTVPRequestRouter, WTVPServer
 import argparse
 import logging
 import os
+import signal
+import subprocess
 import sys
+import threading
 from functools import partial
 
 __version__ = "1.0"
-print(f"""pyWebTV
-Version {__version__} - https://github.com/samicrusader/pyWebTV
---""")
-
-logging.basicConfig(level=logging.DEBUG)
 
 
 def run(
@@ -21,33 +22,124 @@ def run(
         bind: str,
         service_ip: str,
         service_dir: str,
-        config: dict
+        config_path: str,
+        workers: int = 0,
+        queue_size: int = 0,
+        listen_fd: int = None,
+        drain_timeout: float = 30
 ):
     """
     Runs a WTVP server.
+
+    If workers is set, connections are handled by a fixed-size worker pool with a bounded accept queue instead of a
+    thread per connection. Pooled connections that stay idle for "idle_timeout" seconds (service.json, default 120)
+    are closed.
+
+    Sending SIGHUP reloads config.json and service.json without dropping connections. Log levels are reloaded
+    with them; the rest of the "logging" section takes effect on restart.
+
+    Sending SIGUSR1 runs the sampling profiler for a while and writes the request threads' stacks, by route, in
+    collapsed-stack format.
+
+    Sending SIGUSR2 starts a new server process that inherits the listening socket. This process then stops
+    accepting, lets its open connections finish their current request, and exits once they're gone or after
+    drain_timeout seconds.
     """
     service_dir = os.path.abspath(service_dir)
-    service_config = load_json(os.path.join(
-        service_dir, 'config/service.json'))
+    with startup.phase('configuration and clients'):
+        # a profiling run mustn't clear the bookkeeping of a server that's live on the same store
+        context = ServiceContext(config_path, service_dir,
+                                 reset_connections=listen_fd is None and not startup.profiling())
+    with startup.phase('logging'):
+        listener = setup_logging(context.state.global_config.get('logging', dict()))
     if port == 0:
-        port = service_config['port']
+        port = context.state.service_config['port']
     sys.path.insert(1, service_dir)  # FIXME: This is a hack.
     handlerargs = partial(
         WTVPRequestRouter,
         service_ip=service_ip,
         service_dir=service_dir,
-        service_config=service_config,
-        global_config=config
+        context=context
     )
-    with WTVPServer((bind, port), handlerargs) as s:
+    if hasattr(signal, 'SIGHUP'):
+        # reload off the main thread so serve_forever isn't held up by it
+        signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=reload, args=(context,), daemon=True).start())
+    with startup.phase('server'):
+        # a profiling run doesn't bind, so it can't collide with a server that's live on the same port
+        bind_and_activate = not startup.profiling()
+        if workers:
+            server = WTVPPooledServer((bind, port), handlerargs, workers=workers, queue_size=queue_size,
+                                      idle_timeout=context.state.service_config.get('idle_timeout'),
+                                      bind_and_activate=bind_and_activate, listen_fd=listen_fd)
+        else:
+            server = WTVPServer((bind, port), handlerargs, bind_and_activate=bind_and_activate, listen_fd=listen_fd)
+    if startup.profiling():
+        # started by --profile-startup; report and stop before serving
+        server.server_close()
+        listener.stop()
+        startup.report_phases()
+        return
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda *_: threading.Thread(target=handoff, args=(server,), daemon=True).start())
+    if hasattr(signal, 'SIGUSR1'):
+        settings = context.state.global_config.get('profiler', dict())
+        profiler = SamplingProfiler(rate=settings.get('rate', 100),
+                                    output=settings.get('output', 'profile-{pid}-{time}.folded'))
+        signal.signal(signal.SIGUSR1, lambda *_: profiler.start(settings.get('duration', 30)))
+    with server as s:
         try:
             s.serve_forever()
+            if s.draining:
+                remaining = s.drain(drain_timeout)
+                logging.info('Drained; %d connection(s) still open at exit.', remaining)
         except KeyboardInterrupt:
             print('\nstopping...')
+            if workers:
+                logging.info('Worker pool stats: %s', s.stats())
+            logging.info('Rate limit stats: %s', context.state.ratelimiter.stats())
             sys.exit(0)
+        finally:
+            listener.stop()
+
+
+def reload(context: ServiceContext):
+    """
+    Reloads the configuration, including log levels.
+    """
+    if context.reload():
+        apply_levels(context.state.global_config.get('logging', dict()))
+
+
+def handoff(server):
+    """
+    Starts a new server process on the same listening socket, then stops this one from accepting.
+    """
+    fd = server.socket.fileno()
+    os.set_inheritable(fd, True)
+    argv = list()
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg in ('--listen-fd', '-l'):
+            skip = True
+        elif not arg.startswith('--listen-fd='):
+            argv.append(arg)
+    try:
+        child = subprocess.Popen([sys.executable, '-m', 'pywebtv'] + argv + ['--listen-fd', str(fd)], pass_fds=(fd,))
+    except OSError as e:
+        logging.error('Could not start the new server process: %s', e)
+        return
+    logging.info('Handed the listening socket to process %d; draining.', child.pid)
+    server.draining = True
+    server.shutdown()
 
 
 if __name__ == '__main__':
+    # only here, since spawned worker processes (like wtv-proxy's transcoders) import this module again
+    print(f"""pyWebTV
+Version {__version__} - https://github.com/samicrusader/pyWebTV
+--""")
     parser = argparse.ArgumentParser(prog='python3 -m pywebtv')
 
     parser.add_argument('--config', '-c', default='config.json',
@@ -58,20 +150,36 @@ if __name__ == '__main__':
                         help='Override port to listen on.')
     parser.add_argument('--service-ip', '-x',
                         help='Specify IP address for network use.')
+    parser.add_argument('--workers', '-w', default=0, type=int,
+                        help='Handle connections with a fixed-size worker pool of this many threads.')
+    parser.add_argument('--queue-size', '-q', default=128, type=int,
+                        help='Maximum number of connections waiting for a worker before new ones are refused.')
+    parser.add_argument('--listen-fd', '-l', default=None, type=int,
+                        help='Serve on an inherited listening socket (used by SIGUSR2 handoff).')
+    parser.add_argument('--drain-timeout', default=30, type=float,
+                        help='Seconds to wait for open connections after handing off the listening socket.')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report import and initialization time, then exit instead of serving. This connects '
+                             'to the configured backends but leaves a running server alone.')
 
     args = parser.parse_args()
 
-    try:
-        config = load_json(args.config)
-    except:
+    if not os.path.isfile(args.config):
         print('Specify a config.')
         parser.print_help()
         exit(1)
 
+    if args.profile_startup and not startup.profiling():
+        sys.exit(startup.profile(sys.argv[1:]))
+
     run(
         service_dir=args.service,
         bind=args.bind,
         port=args.port,
         service_ip=args.service_ip,
-        config=config
+        config_path=args.config,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        listen_fd=args.listen_fd,
+        drain_timeout=args.drain_timeout
     )
@@ -0,0 +1,268 @@
+# -*- coding: UTF-8 -*-
+
+from .logs import access_fields
+import argparse
+import contextlib
+import gzip
+import math
+import sys
+from datetime import datetime, timezone
+
+"""
+Offline analysis of pyWebTV access logs (see logs.py for the format).
+
+Logs are streamed line by line, and latencies go into fixed log-scale histograms instead of being kept, so memory
+depends on the number of routes and windows, not on the size of the log. Percentiles are accurate to about 2%.
+"""
+
+bucket_base = 1.02
+
+
+class Histogram:
+    """
+    A sparse log-scale latency histogram.
+    """
+
+    def __init__(self):
+        self.buckets = dict()
+        self.count = 0
+
+    def add(self, value: float):
+        bucket = int(math.log(value + 1, bucket_base))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def percentile(self, p: float):
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # the middle of the bucket
+                return bucket_base ** (bucket + 0.5) - 1
+        return 0.0
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.latency = Histogram()
+
+    def add(self, timestamp: float, status: int, size: int, duration: float):
+        self.requests += 1
+        if status >= 400:
+            self.errors += 1
+        self.bytes += size
+        self.latency.add(duration)
+        self.first = timestamp if self.first is None else min(self.first, timestamp)
+        self.last = timestamp if self.last is None else max(self.last, timestamp)
+
+    def summary(self, span: float):
+        return {
+            'requests': self.requests,
+            'rate': self.requests / span if span > 0 else float(self.requests),
+            'p50': self.latency.percentile(50),
+            'p90': self.latency.percentile(90),
+            'p99': self.latency.percentile(99),
+            'bytes': self.bytes,
+            'error_rate': self.errors / self.requests if self.requests else 0.0
+        }
+
+
+def open_log(path: str):
+    """
+    Opens an access log for reading, or wraps stdin for "-" so leaving the with block doesn't close it.
+    """
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def parse_time(value: str):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc).timestamp()
+
+
+def iter_records(paths: list, since: float = None, until: float = None):
+    """
+    Yields (timestamp, service, path, status, bytes, duration_ms) for each well-formed access log line.
+    """
+    for path in paths:
+        with open_log(path) as fh:
+            for line in fh:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != len(access_fields):
+                    continue
+                try:
+                    timestamp = parse_time(fields[0])
+                    status, size, duration = int(fields[6]), int(fields[7]), float(fields[8])
+                except ValueError:
+                    continue
+                if (since is not None and timestamp < since) or (until is not None and timestamp >= until):
+                    continue
+                yield timestamp, fields[3], fields[5].split('?', 1)[0], status, size, duration
+
+
+def analyze(records, by: str = 'path', window: float = 0, split: float = None):
+    """
+    Groups records into {window start: {route: RouteStats}}. The window start is 0 if window is 0.
+    With split, records are grouped into the periods before and from that time instead, keyed False and True.
+    """
+    windows = dict()
+    for timestamp, service, path, status, size, duration in records:
+        if split is not None:
+            start = timestamp >= split
+        else:
+            start = timestamp // window * window if window else 0
+        route = service if by == 'service' else path
+        routes = windows.setdefault(start, dict())
+        stats = routes.get(route)
+        if stats is None:
+            stats = routes[route] = RouteStats()
+        stats.add(timestamp, status, size, duration)
+    return windows
+
+
+def span_of(routes: dict, window: float):
+    if window:
+        return window
+    first = min(stats.first for stats in routes.values())
+    last = max(stats.last for stats in routes.values())
+    return last - first
+
+
+def format_bytes(size: float):
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.0f}T'
+
+
+def report(windows: dict, window: float, top: int, out=sys.stdout):
+    for start in sorted(windows):
+        routes = windows[start]
+        span = span_of(routes, window)
+        if window:
+            stamp = datetime.fromtimestamp(start, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            print(f'== {stamp} UTC ({window:g}s)', file=out)
+        print(f'{"route":<40} {"reqs":>8} {"req/s":>8} {"p50":>8} {"p90":>8} {"p99":>8} {"bytes":>8} {"err%":>6}',
+              file=out)
+        summaries = sorted(((route, stats.summary(span)) for route, stats in routes.items()),
+                           key=lambda item: -item[1]['requests'])
+        for route, s in summaries[:top]:
+            print(f'{route[:40]:<40} {s["requests"]:>8} {s["rate"]:>8.2f} {s["p50"]:>8.1f} {s["p90"]:>8.1f} '
+                  f'{s["p99"]:>8.1f} {format_bytes(s["bytes"]):>8} {s["error_rate"] * 100:>6.1f}', file=out)
+
+
+def merge(windows: dict):
+    """
+    Folds every window into one {route: RouteStats}.
+    """
+    merged = dict()
+    for routes in windows.values():
+        for route, stats in routes.items():
+            total = merged.get(route)
+            if total is None:
+                total = merged[route] = RouteStats()
+            total.requests += stats.requests
+            total.errors += stats.errors
+            total.bytes += stats.bytes
+            total.latency.count += stats.latency.count
+            for bucket, count in stats.latency.buckets.items():
+                total.latency.buckets[bucket] = total.latency.buckets.get(bucket, 0) + count
+            total.first = stats.first if total.first is None else min(total.first, stats.first)
+            total.last = stats.last if total.last is None else max(total.last, stats.last)
+    return merged
+
+
+def diff(before: dict, after: dict, top: int, min_requests: int, out=sys.stdout):
+    """
+    Compares two periods route by route, worst p99 regressions first.
+    """
+    before_span = span_of(before, 0) if before else 0
+    after_span = span_of(after, 0) if after else 0
+    rows = list()
+    for route in set(before) | set(after):
+        a = before[route].summary(before_span) if route in before else None
+        b = after[route].summary(after_span) if route in after else None
+        if (a and a['requests'] < min_requests) or (b and b['requests'] < min_requests):
+            continue
+        if a and b:
+            change = (b['p99'] - a['p99']) / a['p99'] if a['p99'] else 0.0
+        else:
+            change = math.inf if b else -math.inf
+        rows.append((route, a, b, change))
+    rows.sort(key=lambda row: -row[3])
+    print(f'{"route":<40} {"p50 before":>10} {"p50 after":>10} {"p99 before":>10} {"p99 after":>10} '
+          f'{"p99 change":>10} {"req/s change":>12} {"err% change":>11}', file=out)
+    for route, a, b, change in rows[:top]:
+        if not a or not b:
+            print(f'{route[:40]:<40} {"only in " + ("after" if b else "before"):>10}', file=out)
+            continue
+        rate = (b['rate'] - a['rate']) / a['rate'] * 100 if a['rate'] else 0.0
+        print(f'{route[:40]:<40} {a["p50"]:>10.1f} {b["p50"]:>10.1f} {a["p99"]:>10.1f} {b["p99"]:>10.1f} '
+              f'{change * 100:>+9.1f}% {rate:>+11.1f}% {(b["error_rate"] - a["error_rate"]) * 100:>+10.1f}%',
+              file=out)
+
+
+def parse_when(value: str):
+    if value is None:
+        return None
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)  # access log times are UTC
+    return when.timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m pywebtv.accesslog')
+    subparsers = parser.add_subparsers(dest='command')
+    summary = subparsers.add_parser('summary', help='Per-route throughput, latency, bytes and errors.')
+    summary.add_argument('logs', nargs='+', help='Access logs, gzipped or not ("-" for stdin).')
+    summary.add_argument('--by', choices=('path', 'service'), default='path', help='Group by path or service.')
+    summary.add_argument('--window', '-w', type=float, default=0,
+                         help='Report every window of this many seconds instead of the whole log.')
+    summary.add_argument('--since', help='Only count requests from this UTC time on (ISO 8601).')
+    summary.add_argument('--until', help='Only count requests before this UTC time (ISO 8601).')
+    summary.add_argument('--top', '-n', type=int, default=20, help='Routes to show per window.')
+    compare = subparsers.add_parser('diff', help='Compare two periods, e.g. before and after a deploy.')
+    compare.add_argument('before', help='Access log of the first period.')
+    compare.add_argument('after', nargs='?', help='Access log of the second period (defaults to the first).')
+    compare.add_argument('--split', help='UTC time dividing the two periods, when they are in one log.')
+    compare.add_argument('--by', choices=('path', 'service'), default='path', help='Group by path or service.')
+    compare.add_argument('--top', '-n', type=int, default=20, help='Routes to show.')
+    compare.add_argument('--min-requests', type=int, default=20,
+                         help='Ignore routes with fewer requests than this in either period.')
+
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        records = iter_records(args.logs, parse_when(args.since), parse_when(args.until))
+        report(analyze(records, args.by, args.window), args.window, args.top)
+    elif args.command == 'diff':
+        split = parse_when(args.split)
+        if args.after is None and split is None:
+            print('Give a second log or --split.')
+            sys.exit(1)
+        if args.before == '-' and args.after == '-':
+            print('Only one of the logs can be stdin.')
+            sys.exit(1)
+        if args.after is None:
+            # one pass over the log, so it can be stdin
+            periods = analyze(iter_records([args.before]), args.by, split=split)
+            before, after = periods.get(False, dict()), periods.get(True, dict())
+        else:
+            before = merge(analyze(iter_records([args.before], until=split), args.by))
+            after = merge(analyze(iter_records([args.after], since=split), args.by))
+        diff(before, after, args.top, args.min_requests)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import tempfile
+from urllib.parse import unquote_plus
+
+chunk_size = 64 * 1024
+
+
+class RequestBody:
+    """
+    File-like request body.
+
+    The body is read off the socket in fixed-size chunks into memory until it grows past the spool threshold, and is
+    then moved to a temporary file on disk (a threshold of 0 puts every non-empty body on disk). This keeps large
+    uploads from sitting in a request thread's memory.
+    """
+
+    def __init__(self, rfile, length: int, max_size: int = 16 * 1024 * 1024, spool_threshold: int = 256 * 1024):
+        """
+        Reads length bytes from rfile into the body.
+        """
+        if length < 0:
+            raise ValueError('Invalid Content-Length.')
+        if length > max_size:
+            raise ValueError('Request body is too large.')
+        self.length = length
+        self.spool_threshold = spool_threshold
+        self.file = io.BytesIO()
+        # True once the body has been moved to a file on disk
+        self.spooled = False
+        remaining = length
+        while remaining > 0:
+            chunk = rfile.read(min(remaining, chunk_size))
+            if not chunk:
+                self.file.close()
+                raise ValueError('Request body is shorter than Content-Length.')
+            if not self.spooled and self.file.tell() + len(chunk) > spool_threshold:
+                self._spool()
+            self.file.write(chunk)
+            remaining -= len(chunk)
+        self.file.seek(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size: int = -1):
+        return self.file.read(size)
+
+    def readline(self, size: int = -1):
+        return self.file.readline(size)
+
+    def seek(self, offset: int, whence: int = 0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def _spool(self):
+        """
+        Moves what has been read so far to a temporary file on disk.
+        """
+        disk = tempfile.TemporaryFile()
+        disk.write(self.file.getbuffer())
+        self.file.close()
+        self.file = disk
+        self.spooled = True
+
+    def getvalue(self):
+        """
+        Returns the entire body as bytes. This loads the body into memory.
+        """
+        position = self.file.tell()
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(position)
+        return data
+
+
+def iter_form_params(body, max_field_size: int = 1024 * 1024):
+    """
+    Yields (key, value) pairs from an application/x-www-form-urlencoded body.
+    The body is read in chunks, so only one field is held in memory at a time.
+    """
+    body.seek(0)
+    pending = b''
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        fields = pending.split(b'&')
+        pending = fields.pop()
+        if len(pending) > max_field_size:
+            raise ValueError('Form field is too long.')
+        for field in fields:
+            if field:
+                yield decode_form_field(field)
+    if pending:
+        yield decode_form_field(pending)
+    body.seek(0)
+
+
+def decode_form_field(field: bytes):
+    """
+    Decodes a single key=value form field.
+    """
+    key, _, value = field.decode(errors='replace').partition('=')
+    return unquote_plus(key), unquote_plus(value)
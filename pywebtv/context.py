@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+
+from .data import AccountCache, Database
+from .functions import load_json
+from .ratelimit import RateLimiter
+from .state import RedisStore, StateStore, create_store, redis_nodes
+import logging
+import os
+import sqlalchemy
+import threading
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceState:
+    """
+    One consistent set of configuration and shared database clients.
+
+    Routers take the current state when their connection starts and keep it for the life of the connection, so a
+    reload never changes settings under a request that's in flight.
+    """
+
+    def __init__(self, global_config: dict, service_config: dict):
+        """
+        This will validate the configuration and create the shared database clients.
+        """
+        validate_config(global_config, service_config)
+        self.global_config = global_config
+        self.service_config = service_config
+
+        sqlconfig = global_config['db']['psql']
+        # sql used for service and user information storage
+        self.sqlengine = sqlalchemy.create_engine(
+            f"postgresql+pg8000://{sqlconfig['username']}:{quote(sqlconfig['password'])}@{sqlconfig['host']}:{sqlconfig['port']}/{sqlconfig['database']}")
+        self.db = Database(self.sqlengine)
+        # redis used for temporary session storage, sharded by ssid if there's more than one node
+        self.redisengines = dict()
+        if 'redis' in global_config['db']:
+            import redis
+            for name, node in redis_nodes(global_config):
+                self.redisengines[name] = redis.Redis(host=node['host'], port=node['port'], db=node['db'])
+        # connection, session and ticket state
+        self.store: StateStore = create_store(global_config, self.redisengines)
+        self.accounts = self.create_accounts()
+        self.ratelimiter = RateLimiter(global_config.get('ratelimit', dict()), self.store)
+        # connections using this state; a replaced state is closed once they're all gone
+        self.users = 0
+
+    def create_accounts(self):
+        settings = self.global_config.get('state', dict())
+        return AccountCache(self.db, self.store, ttl=settings.get('account_ttl', 3600),
+                            local_ttl=settings.get('account_local_ttl', 30))
+
+    def close(self, close_store: bool = True):
+        """
+        Closes the account cache and the database engine, and the store unless a newer state shares it.
+        """
+        self.accounts.close()
+        if close_store:
+            self.store.close()
+        self.sqlengine.dispose()
+
+
+class ServiceContext:
+    """
+    Holds the current ServiceState and swaps it on reload.
+
+    reload() builds and validates a complete new state first and only then replaces the old one with a single
+    assignment. If anything is wrong with the new configuration, the old state stays in place.
+
+    Connections take the state with acquire() and give it back with release(). A replaced state is closed when its
+    last connection gives it back, so keep-alive connections opened before a reload keep working.
+    """
+
+    def __init__(self, config_path: str, service_dir: str, reset_connections: bool = True):
+        self.config_path = config_path
+        self.service_dir = service_dir
+        self._reload_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._retired = list()
+        self.state = self.load()
+        if reset_connections:
+            # connection pool bookkeeping starts empty, unless we're taking over from a running server
+            self.state.store.reset_connections()
+
+    def load(self):
+        return ServiceState(
+            global_config=load_json(self.config_path),
+            service_config=load_json(os.path.join(self.service_dir, 'config/service.json'))
+        )
+
+    def acquire(self):
+        """
+        Returns the current state, counting the caller as one of its users until release().
+        """
+        with self._state_lock:
+            state = self.state
+            state.users += 1
+            return state
+
+    def release(self, state: ServiceState):
+        with self._state_lock:
+            state.users -= 1
+            done = self._collect()
+        self._close(done)
+
+    def _collect(self):
+        """
+        Takes the replaced states nobody uses anymore off the retired list. Call with _state_lock held.
+        Returns [(state, close_store)]; a store is only closed once no state that's still around uses it.
+        """
+        done = [state for state in self._retired if not state.users]
+        self._retired = [state for state in self._retired if state.users]
+        alive = self._retired + [self.state]
+        return [(state, not any(other.store is state.store for other in alive)) for state in done]
+
+    def _close(self, done: list):
+        for state, close_store in done:
+            try:
+                state.close(close_store)
+            except Exception as e:
+                logger.warning('Could not close the replaced configuration: %s', e)
+
+    def reload(self):
+        """
+        Reloads config.json and service.json. Returns True if the new configuration was applied.
+        """
+        with self._reload_lock:
+            try:
+                state = self.load()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error('Configuration reload failed, keeping the current configuration: %s', e)
+                return False
+            old = self.state
+            if state.service_config['port'] != old.service_config['port']:
+                logger.warning('The service port changed; it will take effect on the next restart.')
+            if state.global_config.get('state') == old.global_config.get('state') and \
+                    state.global_config['db'].get('redis') == old.global_config['db'].get('redis'):
+                # keep the same store, so in-process state isn't lost on reload
+                state.accounts.close()
+                state.store.close()
+                state.store = old.store
+                state.accounts = state.create_accounts()
+                state.ratelimiter = RateLimiter(state.global_config.get('ratelimit', dict()), state.store)
+            if state.global_config.get('ratelimit') == old.global_config.get('ratelimit') and \
+                    state.store is old.store:
+                # keep the buckets and counters
+                state.ratelimiter = old.ratelimiter
+            if state.store is not old.store and isinstance(state.store, RedisStore) and \
+                    state.global_config['db'].get('redis') != old.global_config['db'].get('redis'):
+                # the redis nodes changed; move the keys that now belong elsewhere, including off nodes that were
+                # removed, before switching over (the old store is closed once the last request using it finishes)
+                import redis
+                previous = old.store.clients if isinstance(old.store, RedisStore) else None
+                try:
+                    moved = state.store.rebalance(previous)
+                    logger.info('Moved %d key(s) to their new redis node.', moved)
+                except redis.RedisError as e:
+                    logger.error('Could not rebalance redis keys: %s', e)
+            with self._state_lock:
+                self.state = state
+                self._retired.append(old)
+                done = self._collect()
+            self._close(done)
+            logger.info('Configuration reloaded.')
+            return True
+
+
+def validate_config(global_config: dict, service_config: dict):
+    """
+    Raises ValueError if a configuration is missing settings the server needs.
+    """
+    required = {
+        'psql': ('host', 'port', 'username', 'password', 'database')
+    }
+    if not isinstance(global_config, dict) or not isinstance(global_config.get('db'), dict):
+        raise ValueError('config.json has no "db" section.')
+    if global_config.get('state', dict()).get('backend', 'redis') == 'redis':
+        required['redis'] = ('host', 'port', 'db')
+    for section, keys in required.items():
+        settings = global_config['db'].get(section)
+        if section == 'redis' and isinstance(settings, list) and settings:
+            nodes = settings  # sharded over several nodes
+        elif isinstance(settings, dict):
+            nodes = [settings]
+        else:
+            raise ValueError(f'config.json has no "db.{section}" section.')
+        for node in nodes:
+            missing = [key for key in keys if not isinstance(node, dict) or key not in node]
+            if missing:
+                raise ValueError(f'config.json "db.{section}" is missing {", ".join(missing)}.')
+    if not isinstance(service_config, dict):
+        raise ValueError('service.json is not an object.')
+    missing = [key for key in ('name', 'port', 'stub') if key not in service_config]
+    if missing:
+        raise ValueError(f'service.json is missing {", ".join(missing)}.')
+    if not isinstance(service_config['port'], int):
+        raise ValueError('service.json "port" must be a number.')
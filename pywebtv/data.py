@@ -0,0 +1,328 @@
+# -*- coding: UTF-8 -*-
+
+from .models import IPBlacklist, Subscribers, Terminals, Users
+from .state import StateStore
+import sqlalchemy
+import threading
+import time
+from collections import OrderedDict
+from pg8000.exceptions import InterfaceError
+from pg8000.native import PreparedStatement
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text
+
+"""
+Data access for the server and services.
+
+The hot lookups are prepared once per database connection, so Postgres doesn't parse and plan them again on every
+request. Rows come back as transient model instances.
+"""
+
+
+def select_sql(model, where: str):
+    quote = postgresql.dialect().identifier_preparer.quote  # "user" is a reserved word
+    columns = ', '.join(quote(column.name) for column in model.__table__.columns)
+    return f'select {columns} from public.{quote(model.__tablename__)} where {where}'
+
+
+def account_sql():
+    """
+    Selects a terminal with its subscriber and every user on that subscriber, one row per user.
+    Columns are labelled <table>__<column>.
+    """
+    quote = postgresql.dialect().identifier_preparer.quote
+    columns = ', '.join(f'{model.__tablename__}.{quote(column.name)} as {model.__tablename__}__{column.name}'
+                        for model in (Terminals, Subscribers, Users) for column in model.__table__.columns)
+    return f'select {columns} from public.terminals ' \
+           f'join public.subscribers on subscribers.id = terminals.subscriber ' \
+           f'left join public.users on users.subscriber = subscribers.id ' \
+           f'where terminals.ssid = :ssid order by users.id'
+
+
+# name: select, with :named parameters
+statements = {
+    'ipblacklist_by_ip': select_sql(IPBlacklist, 'ip = :ip'),
+    'terminal_by_ssid': select_sql(Terminals, 'ssid = :ssid'),
+    'subscriber_by_id': select_sql(Subscribers, 'id = :id'),
+    'user_by_id': select_sql(Users, 'id = :id'),
+    'user_by_username': select_sql(Users, 'username = :username'),
+    'users_by_subscriber': select_sql(Users, 'subscriber = :subscriber order by id'),
+    'account_by_ssid': account_sql()
+}
+
+
+# never written to the shared store
+secret_columns = frozenset(('password', 'mail_password', 'news_password', 'messenger_password'))
+
+
+def to_model(model, keys, row):
+    return model(**dict(zip(keys, row)))
+
+
+class Account:
+    """
+    A box's terminal, its subscriber and the subscriber's users.
+    """
+
+    def __init__(self, terminal: Terminals, subscriber: Subscribers, users: list):
+        self.terminal = terminal
+        self.subscriber = subscriber
+        self.users = users
+
+    @property
+    def user(self) -> Users:
+        """
+        The subscriber's primary user.
+        """
+        for user in self.users:
+            if user.id == self.subscriber.user:
+                return user
+        return self.users[0] if self.users else None
+
+    @classmethod
+    def from_rows(cls, keys, rows):
+        if not rows:
+            return None
+        tables = {model.__tablename__: i for i, model in enumerate((Terminals, Subscribers, Users))}
+        users = list()
+        for row in rows:
+            split = [dict(), dict(), dict()]
+            for key, value in zip(keys, row):
+                table, _, column = key.partition('__')
+                split[tables[table]][column] = value
+            if split[2]['id'] is not None:
+                users.append(Users(**split[2]))
+        return cls(Terminals(**split[0]), Subscribers(**split[1]), users)
+
+    def to_dict(self):
+        """
+        Returns the account as plain data, without the secret_columns.
+        """
+        def columns(obj):
+            return {column.name: getattr(obj, column.name) for column in obj.__table__.columns
+                    if column.name not in secret_columns}
+
+        return {
+            'terminal': columns(self.terminal),
+            'subscriber': columns(self.subscriber),
+            'users': [columns(user) for user in self.users]
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(Terminals(**data['terminal']), Subscribers(**data['subscriber']),
+                   [Users(**user) for user in data['users']])
+
+
+class Database:
+    """
+    Typed queries over the models, using server-side prepared statements.
+
+    A statement is prepared with pg8000 the first time a pooled connection runs it, and kept with that connection
+    until the pool drops it. The engine has to use the pg8000 driver.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        self.engine = engine
+
+    def _rows(self, name: str, **params):
+        with self.engine.connect() as conn:
+            fairy = conn.connection
+            prepared = fairy.info.setdefault('prepared', dict())
+            statement = prepared.get(name)
+            if statement is None:
+                statement = prepared[name] = PreparedStatement(fairy.dbapi_connection, statements[name])
+            try:
+                rows = statement.run(**params)
+            except InterfaceError:
+                # the connection is gone; SQLAlchemy only notices that on statements it runs itself
+                fairy.invalidate()
+                raise
+            return [column['name'] for column in statement.columns], rows
+
+    def _execute(self, name: str, model, **params):
+        keys, rows = self._rows(name, **params)
+        return [to_model(model, keys, row) for row in rows]
+
+    def _first(self, name: str, model, **params):
+        rows = self._execute(name, model, **params)
+        return rows[0] if rows else None
+
+    def is_blacklisted(self, ip: str) -> bool:
+        return bool(self._rows('ipblacklist_by_ip', ip=ip)[1])
+
+    def get_blacklist_entry(self, ip: str) -> IPBlacklist:
+        return self._first('ipblacklist_by_ip', IPBlacklist, ip=ip)
+
+    def get_terminal(self, ssid: str) -> Terminals:
+        return self._first('terminal_by_ssid', Terminals, ssid=ssid)
+
+    def get_subscriber(self, subscriber_id: int) -> Subscribers:
+        return self._first('subscriber_by_id', Subscribers, id=subscriber_id)
+
+    def get_user(self, user_id: int) -> Users:
+        return self._first('user_by_id', Users, id=user_id)
+
+    def get_user_by_username(self, username: str) -> Users:
+        return self._first('user_by_username', Users, username=username)
+
+    def get_subscriber_users(self, subscriber_id: int) -> list:
+        return self._execute('users_by_subscriber', Users, subscriber=subscriber_id)
+
+    def get_account(self, ssid: str) -> Account:
+        """
+        Resolves a box's terminal, subscriber and users in one query. Returns None for an unregistered box.
+        """
+        return Account.from_rows(*self._rows('account_by_ssid', ssid=ssid))
+
+
+class AccountCache:
+    """
+    Cached SSID to account resolution, for logins.
+
+    Accounts are kept in-process for local_ttl seconds and in the shared store for ttl seconds, so after an outage
+    the reconnecting boxes are mostly resolved without touching Postgres. Concurrent misses for the same box share
+    one query. Anything that changes terminals, subscribers or users must call invalidate(), which drops the
+    account everywhere, including the in-process caches of other nodes.
+
+    Cached accounts don't have the password columns; check credentials against the Database.
+    """
+
+    def __init__(self, db: Database, store: StateStore, ttl: int = 3600, local_ttl: float = 30,
+                 max_entries: int = 10000):
+        self.db = db
+        self.store = store
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.max_entries = max_entries
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = dict()
+        self.store.add_invalidation_listener(self._drop)
+
+    def get(self, ssid: str) -> Account:
+        """
+        Returns the account for a box, or None if it isn't registered.
+        """
+        with self._lock:
+            entry = self._local.get(ssid)
+            if entry is not None and entry[1] > time.monotonic():
+                self._local.move_to_end(ssid)
+                return entry[0]
+            inflight = self._inflight.get(ssid)
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight[ssid] = [threading.Event(), None, None]
+        if not owner:
+            inflight[0].wait()
+            if inflight[2] is not None:
+                raise inflight[2]
+            return inflight[1]
+        try:
+            inflight[1] = account = self._resolve(ssid)
+            self._remember(ssid, account)
+            return account
+        except Exception as e:
+            # the waiters get the same error, instead of a None that reads as "not registered"
+            inflight[2] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(ssid, None)
+            inflight[0].set()
+
+    def _resolve(self, ssid: str):
+        cached = self.store.get_account(ssid)
+        if cached is not None:
+            return Account.from_dict(cached)
+        account = self.db.get_account(ssid)
+        if account is None:
+            # unregistered boxes aren't written to the store, but are remembered locally for local_ttl like any
+            # other box, so registering one still has to invalidate() it
+            return None
+        data = account.to_dict()
+        self.store.set_account(ssid, data, self.ttl)
+        # the same secret-free copy the store has, so the result doesn't depend on where it came from
+        return Account.from_dict(data)
+
+    def _remember(self, ssid: str, account: Account):
+        with self._lock:
+            self._local[ssid] = (account, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(ssid)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def invalidate(self, ssid: str = None):
+        """
+        Drops the cached account of one box, or of every box if ssid is None.
+        """
+        self._drop(ssid)
+        self.store.invalidate_accounts(ssid)
+
+    def _drop(self, ssid: str = None):
+        with self._lock:
+            if ssid is None:
+                self._local.clear()
+            else:
+                self._local.pop(ssid, None)
+
+    def close(self):
+        self.store.remove_invalidation_listener(self._drop)
+
+
+class AsyncDatabase:
+    """
+    The same queries as Database, for asyncio code, over SQLAlchemy's asyncio engine and asyncpg.
+
+    asyncpg prepares every statement it runs and keeps it in a per-connection cache, so the plain selects here are
+    parsed and planned once per connection as well.
+    """
+
+    def __init__(self, sqlconfig: dict):
+        """
+        sqlconfig is the "db.psql" section of config.json. Requires sqlalchemy>=1.4 and asyncpg.
+        """
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from urllib.parse import quote
+        self.engine = create_async_engine(
+            f"postgresql+asyncpg://{sqlconfig['username']}:{quote(sqlconfig['password'])}@{sqlconfig['host']}:{sqlconfig['port']}/{sqlconfig['database']}")
+
+    async def _rows(self, name: str, **params):
+        async with self.engine.connect() as conn:
+            result = await conn.execute(text(statements[name]), params)
+            return list(result.keys()), result.fetchall()
+
+    async def _execute(self, name: str, model, **params):
+        keys, rows = await self._rows(name, **params)
+        return [to_model(model, keys, row) for row in rows]
+
+    async def _first(self, name: str, model, **params):
+        rows = await self._execute(name, model, **params)
+        return rows[0] if rows else None
+
+    async def is_blacklisted(self, ip: str) -> bool:
+        return bool((await self._rows('ipblacklist_by_ip', ip=ip))[1])
+
+    async def get_blacklist_entry(self, ip: str) -> IPBlacklist:
+        return await self._first('ipblacklist_by_ip', IPBlacklist, ip=ip)
+
+    async def get_terminal(self, ssid: str) -> Terminals:
+        return await self._first('terminal_by_ssid', Terminals, ssid=ssid)
+
+    async def get_subscriber(self, subscriber_id: int) -> Subscribers:
+        return await self._first('subscriber_by_id', Subscribers, id=subscriber_id)
+
+    async def get_user(self, user_id: int) -> Users:
+        return await self._first('user_by_id', Users, id=user_id)
+
+    async def get_user_by_username(self, username: str) -> Users:
+        return await self._first('user_by_username', Users, username=username)
+
+    async def get_subscriber_users(self, subscriber_id: int) -> list:
+        return await self._execute('users_by_subscriber', Users, subscriber=subscriber_id)
+
+    async def get_account(self, ssid: str) -> Account:
+        return Account.from_rows(*(await self._rows('account_by_ssid', ssid=ssid)))
+
+    async def close(self):
+        await self.engine.dispose()
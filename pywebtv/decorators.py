@@ -8,14 +8,80 @@ lookuptable = {
 }
 
 
+capability_names = (
+    'client-can-do-muzac',
+    'client-can-do-chat',
+    'client-can-do-openISP',
+    'client-can-receive-compressed-data',
+    'client-can-display-spotads1',
+    'client-can-print',
+    'client-can-do-macromedia-flash1',
+    'client-can-do-javascript',
+    'client-can-do-videoflash',
+    'client-can-do-videoads',
+    'client-has-disk',
+    'client-supports-classical-service',
+    'client-open-isp-settings-valid',
+    'client-can-tell-valid-open-isp',
+    'client-has-tuner',
+    'client-can-data-download',
+    'client-supports-approx-content-len',
+    'client-has-built-in-printer-port',
+    'client-has-tv-experience',
+    'client-can-handle-proxy-bypass',
+    'client-can-handle-download-v2',
+    'client-has-relogin-function',
+    'client-can-display-spotads2',
+    'client-can-display-30-sec-video-ads',
+    'client-supports-etude-service',
+    'client-can-do-av-capture',
+    'client-can-do-disconnected-email',
+    'client-can-do-macromedia-flash2',
+    'client-has-memory-size-bit1-set',
+    'client-has-memory-size-bit2-set',
+    'client-has-memory-size-bit3-set',
+    'client-can-do-rmf',
+    'client-can-do-png',
+    'client-does-broadband-data-download',
+    'client-has-softmodem',
+    'client-can-do-preparsed-epg',
+    'client-supports-funk-e-service',
+    'client-wants-dial-script',
+    'client-upgrade-visits-not-needed',
+    'client-uses-flexible-videoad-paths',
+    'client-non-production-build',
+    'client-can-download-printer-drivers',
+    'client-supports-hiphop-service',
+    'client-can-use-messenger',
+    'client-uses-third-party-billing',
+    'client-can-do-offlineads',
+    'client-has-no-dialin-support',
+    'client-has-ssl-support-for-wtvp',
+    'client-can-do-audio-capture',
+    'client-can-do-metered-pricing',
+    'client-negotiates-user-agent',
+    'client-can-do-element-logging',
+    'client-supports-jazz-security',
+    'client-supports-MSN-service',
+    'client-supports-notify-port-header',
+    'client-supports-messenger-update-light',
+    'client-supports-MSN-chat',
+    'client-supports-MSN-chat-findu',
+    'client-supports-MSN-messenger-CVR',
+    'client-supports-MSN-messenger-MSNP8',
+    'client-supports-MSN-chat-R9C'
+)
+capability_bits = {name: bit for bit, name in enumerate(capability_names)}
+
+
 class Box:
     """
     This class identifies a box and configures the class to have it's information.
+
+    One is kept for every open connection, so it holds the capability flags as the integer the box sent instead of a
+    dictionary of them.
     """
-    client: int = None
-    systeminfo: dict = None
-    capabilities: dict = None
-    language: str = None
+    __slots__ = ('client', 'systeminfo', 'flags', 'flag_count', 'language')
 
     def __init__(self, headers: dict):
         """
@@ -29,8 +95,10 @@ class Box:
         capabilities will be stored with internal name only
         you need to implement the proper strings yourself.
         """
-        self.capabilities = self.getCapabilities(
-            headers['wtv-capability-flags'])
+        flags = headers['wtv-capability-flags']
+        self.flags = int(flags, 16)
+        self.flag_count = min(len(flags) * 4, len(capability_names))
+        self.systeminfo = None
         # FIXME: does this appear on a real box? ask whoever the fuck owns one
         if headers['wtv-client-rom-type'] == 'JP-Fiji':
             self.client = 3
@@ -40,13 +108,10 @@ class Box:
             disk = x.split('STORAGESIZE="')[1].split('"')[0]
             version = headers['wtv-system-version'].replace(',', '.')
             self.systeminfo = {'version': version, 'disksize': disk}
-        elif 'client-supports-MSN-service' not in self.capabilities.keys() or self.capabilities[
-            'client-supports-MSN-service'] == False:
-            self.client = 0
-        elif self.capabilities['client-supports-MSN-service'] == True:
+        elif self.has('client-supports-MSN-service'):
             self.client = 1
         else:
-            raise ValueError('invalid client')
+            self.client = 0
         if self.client == 0 or self.client == 1:
             version = headers['wtv-system-version']
             bootrom = headers['wtv-client-bootrom-version']
@@ -61,90 +126,22 @@ class Box:
         self.language = headers['Accept-Language'].split('-')[0]
         return
 
+    def has(self, capability: str):
+        """
+        Returns whether the box has a capability, by its internal name.
+        """
+        return bool(self.flags >> capability_bits[capability] & 1)
+
+    @property
+    def capabilities(self):
+        """
+        Every capability flag the box sent, by internal name. This is built on each access; use has() for one flag.
+        """
+        return {name: bool(self.flags >> bit & 1) for bit, name in enumerate(capability_names[:self.flag_count])}
+
     def getCapabilities(self, flags: str):
-        ct = [
-            'client-can-do-muzac',
-            'client-can-do-chat',
-            'client-can-do-openISP',
-            'client-can-receive-compressed-data',
-            'client-can-display-spotads1',
-            'client-can-print',
-            'client-can-do-macromedia-flash1',
-            'client-can-do-javascript',
-            'client-can-do-videoflash',
-            'client-can-do-videoads',
-            'client-has-disk',
-            'client-supports-classical-service',
-            'client-open-isp-settings-valid',
-            'client-can-tell-valid-open-isp',
-            'client-has-tuner',
-            'client-can-data-download',
-            'client-supports-approx-content-len',
-            'client-has-built-in-printer-port',
-            'client-has-tv-experience',
-            'client-can-handle-proxy-bypass',
-            'client-can-handle-download-v2',
-            'client-has-relogin-function',
-            'client-can-display-spotads2',
-            'client-can-display-30-sec-video-ads',
-            'client-supports-etude-service',
-            'client-can-do-av-capture',
-            'client-can-do-disconnected-email',
-            'client-can-do-macromedia-flash2',
-            'client-has-memory-size-bit1-set',
-            'client-has-memory-size-bit2-set',
-            'client-has-memory-size-bit3-set',
-            'client-can-do-rmf',
-            'client-can-do-png',
-            'client-does-broadband-data-download',
-            'client-has-softmodem',
-            'client-can-do-preparsed-epg',
-            'client-supports-funk-e-service',
-            'client-wants-dial-script',
-            'client-upgrade-visits-not-needed',
-            'client-uses-flexible-videoad-paths',
-            'client-non-production-build',
-            'client-can-download-printer-drivers',
-            'client-supports-hiphop-service',
-            'client-can-use-messenger',
-            'client-uses-third-party-billing',
-            'client-can-do-offlineads',
-            'client-has-no-dialin-support',
-            'client-has-ssl-support-for-wtvp',
-            'client-can-do-audio-capture',
-            'client-can-do-metered-pricing',
-            'client-negotiates-user-agent',
-            'client-can-do-element-logging',
-            'client-supports-jazz-security',
-            'client-supports-MSN-service',
-            'client-supports-notify-port-header',
-            'client-supports-messenger-update-light',
-            'client-supports-MSN-chat',
-            'client-supports-MSN-chat-findu',
-            'client-supports-MSN-messenger-CVR',
-            'client-supports-MSN-messenger-MSNP8',
-            'client-supports-MSN-chat-R9C'
-        ]
-
-        binary = bin(int(flags, 16))[2:].zfill(len(flags) * 4)
-
-        rev = binary[::-1]
-
-        split = list(rev)
-
-        cflags = dict()
-
-        for i, c in enumerate(split):
-            x = False
-            if c == '1':
-                x = True
-            try:
-                z = ct[i]
-            except:
-                pass
-            else:
-                cflags.update({z: x})
-        return cflags
+        value = int(flags, 16)
+        return {name: bool(value >> bit & 1) for bit, name in enumerate(capability_names[:len(flags) * 4])}
 
 
 class WTVPError():
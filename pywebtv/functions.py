@@ -2,14 +2,19 @@
 
 from .decorators import WTVPResponse
 import json
-import magic
 import os
 import pathlib
+import re
 import socket
-import xrequests
+import threading
 from datetime import datetime
-from geoip2 import database as geoip2
-from tzlocal import get_localzone
+
+# python-magic, geoip2, tzlocal and xrequests are imported where they're used, so starting a service doesn't pay
+# for the ones it never needs.
+
+geoip_path = os.path.join(pathlib.Path(__file__).parent.resolve(), 'GeoIP2-City.mmdb')
+_geoip_reader = None
+_geoip_lock = threading.Lock()
 
 
 def load_json(file: str):
@@ -28,6 +33,7 @@ def return_file(filepath: str):
         raise FileNotFoundError('file not found')
     try:
         # FIXME: Remove Magic, it sucks.
+        import magic
         mimetype = magic.from_file(filepath, mime=True)
     except AttributeError:
         raise Exception('python-magic is not correctly installed.')
@@ -39,6 +45,19 @@ def return_file(filepath: str):
     return WTVPResponse(data=data, content_type=mimetype)
 
 
+def geoip_reader():
+    """
+    Returns the GeoIP2 reader shared by every request, opening the database the first time it's needed.
+    """
+    global _geoip_reader
+    if _geoip_reader is None:
+        with _geoip_lock:
+            if _geoip_reader is None:
+                from geoip2 import database as geoip2
+                _geoip_reader = geoip2.Reader(geoip_path)
+    return _geoip_reader
+
+
 def returnLocalTime(ip: str):
     """
     Returns a dictionary of headers that will set the client's time.
@@ -48,22 +67,35 @@ def returnLocalTime(ip: str):
     If an error occurs with the DB, it will default to using the local machine's
     timezone.
     """
-    path = pathlib.Path(__file__).parent.resolve()
-    path = os.path.join(path, 'GeoIP2-City.mmdb')
-    with geoip2.Reader(path) as reader:
-        try:
-            r = reader.city(ip)
-        except:
-            tz = get_localzone()
-        else:
-            tz = r.location.time_zone
-    reader.close()
+    from tzlocal import get_localzone
+    reader = geoip_reader()
+    try:
+        r = reader.city(ip)
+    except:
+        tz = get_localzone()
+    else:
+        tz = r.location.time_zone
     dt = datetime.now(tz)
     return {'wtv-client-time-zone': dt.strftime('%Z %z'),
             'wtv-client-time-dst-rule': dt.strftime('%Z'),
             'wtv-client-date': dt.strftime("%a %b %d %H:%M:%S %Y")}
 
 
+def returnRegion(ip: str):
+    """
+    Returns the ISO 3166-2 code of the subdivision an IP address is in (e.g. "US-WA"), or None if it's unknown.
+    This uses the same GeoIP2 database as returnLocalTime.
+    """
+    try:
+        r = geoip_reader().city(ip)
+    except Exception:
+        return None
+    subdivision = r.subdivisions.most_specific.iso_code
+    if not r.country.iso_code or not subdivision:
+        return None
+    return f'{r.country.iso_code}-{subdivision}'
+
+
 def returnIP():
     """
     Return the local machine's public IP address.
@@ -75,6 +107,7 @@ def returnIP():
     This is only called if you don't.
     """
     try:
+        import xrequests
         req = xrequests.get('https://34.117.59.81/ip',
                             headers={'Host': 'ifconfig.me'},
                             verify=False)  # Normally you don't do this, however
@@ -82,7 +115,7 @@ def returnIP():
         ip = ''.join(re.findall(r'[0-9\.]', req.text))
     except:
         try:
-            returnLocalIP()
+            return returnLocalIP()
         except:
             raise ConnectionRefusedError(
                 'Unable to auto-obtain a services IP.')
@@ -103,9 +136,22 @@ def returnLocalIP():
         return ip
 
 
+_service_host = None
+
+
+def service_host():
+    """
+    Returns the public IP address for service headers, looking it up on first use.
+    """
+    global _service_host
+    if _service_host is None:
+        _service_host = returnIP()
+    return _service_host
+
+
 def return_service(name: str,
                    port: int,
-                   host: str = returnIP(),
+                   host: str = None,
                    DontEncryptRequests: bool = False,
                    UseHTTP: bool = False,
                    WideOpen: bool = False,
@@ -116,6 +162,8 @@ def return_service(name: str,
     Returns a wtv-service header from variables. 
     It's a cleaner way to deploy one of these things.
     """
+    if host is None:
+        host = service_host()
     flags = 0
 
     if DontEncryptRequests == True:
@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+"""
+Logging setup for the server.
+
+Request threads only put records on a bounded queue; formatting and writing happen on one background thread, so a
+slow terminal or disk never holds up a request. If the queue is full the record is dropped and counted instead.
+"""
+
+access_log = logging.getLogger('pywebtv.access')
+access_fields = ('time', 'client', 'ssid', 'service', 'method', 'path', 'status', 'bytes', 'duration_ms')
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are, and drops them if it's full.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord):
+        # the listener is in this process, so formatting can wait for its thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DebugSampler(logging.Filter):
+    """
+    Lets through only a fraction of DEBUG records. Everything above DEBUG always passes.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class AccessFormatter(logging.Formatter):
+    """
+    Formats access records as one tab-separated line, in the order of access_fields.
+    """
+
+    def format(self, record: logging.LogRecord):
+        fields = getattr(record, 'access', None)
+        if fields is None:
+            return super().format(record)
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z'
+        return '\t'.join([stamp] + ['-' if field is None else str(field).replace('\t', ' ') for field in fields])
+
+
+def log_access(client: str, ssid: str, service: str, method: str, path: str, status: int, size: int,
+               started: float):
+    """
+    Writes one access log record. started is the time.perf_counter() at which the request line was read.
+    """
+    if access_log.isEnabledFor(logging.INFO):
+        duration = round((time.perf_counter() - started) * 1000, 1)
+        access_log.info('', extra={'access': (client, ssid, service, method, path, status, size, duration)})
+
+
+def apply_levels(config: dict):
+    """
+    Sets the root level and the per-subsystem levels from the "logging" section of config.json.
+    """
+    logging.getLogger().setLevel(config.get('level', 'DEBUG'))
+    for name, level in config.get('levels', dict()).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def setup_logging(config: dict):
+    """
+    Routes all logging through a queue to a background thread, configured by the "logging" section of
+    config.json:
+
+    {"level": "INFO", "levels": {"pywebtv.server": "DEBUG"}, "debug_sample": 0.01, "file": null,
+     "access_log": "access.log", "queue_size": 10000}
+
+    Returns the started QueueListener; stop it on exit to flush what's left.
+    """
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    output = logging.FileHandler(config['file']) if config.get('file') else logging.StreamHandler(sys.stderr)
+    output.setFormatter(formatter)
+    output.addFilter(lambda record: not hasattr(record, 'access'))
+    handlers = [output]
+
+    access_log.propagate = False
+    access_log.handlers.clear()
+    if config.get('access_log'):
+        access = logging.FileHandler(config['access_log'])
+        access.setFormatter(AccessFormatter())
+        access.addFilter(lambda record: hasattr(record, 'access'))
+        handlers.append(access)
+    else:
+        access_log.disabled = True
+
+    log_queue = queue.Queue(maxsize=config.get('queue_size', 10000))
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(DebugSampler(config.get('debug_sample', 1.0)))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    access_log.addHandler(handler)
+    apply_levels(config)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
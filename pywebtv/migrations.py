@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+
+from .models import Base
+import logging
+import sqlalchemy
+from sqlalchemy.sql import text
+
+"""
+Versioned schema migrations.
+
+The applied version is recorded in public.schema_version. Migrations that build indexes do it with
+CREATE INDEX CONCURRENTLY outside of a transaction, so the tables stay writable while they run; everything else
+runs in one transaction per migration with a short lock_timeout, so a migration gives up instead of stalling the
+server behind a table lock.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class Migration:
+    def __init__(self, version: int, description: str, statements: tuple = (), indexes: tuple = (),
+                 create_tables: bool = False):
+        """
+        statements run in a transaction. indexes are (name, table, column) and are built concurrently afterwards.
+        """
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.indexes = indexes
+        self.create_tables = create_tables
+
+
+migrations = [
+    Migration(1, 'Initial schema', create_tables=True),
+    Migration(2, 'Indexes for account resolution and blacklist expiry', indexes=(
+        ('ix_terminals_subscriber', 'terminals', 'subscriber'),
+        ('ix_users_subscriber', 'users', 'subscriber'),
+        ('ix_ipblacklist_expires', 'ipblacklist', 'expires')
+    ))
+]
+
+# (table, column) pairs the server looks rows up by
+hot_columns = [
+    ('ipblacklist', 'ip'),
+    ('ipblacklist', 'expires'),
+    ('terminals', 'ssid'),
+    ('terminals', 'subscriber'),
+    ('subscribers', 'id'),
+    ('users', 'id'),
+    ('users', 'username'),
+    ('users', 'subscriber')
+]
+
+
+def latest_version():
+    return migrations[-1].version
+
+
+def current_version(engine: sqlalchemy.engine.Engine):
+    """
+    Returns the applied schema version, or 0 if none has been recorded.
+    """
+    with engine.begin() as conn:
+        conn.execute(text('create table if not exists public.schema_version '
+                          '(version integer primary key, description text not null, '
+                          'applied_at timestamp not null default now())'))
+        return conn.execute(text('select coalesce(max(version), 0) from public.schema_version')).scalar()
+
+
+def record_version(conn, migration: Migration):
+    conn.execute(text('insert into public.schema_version (version, description) values (:version, :description) '
+                      'on conflict do nothing'), version=migration.version, description=migration.description)
+
+
+def stamp(engine: sqlalchemy.engine.Engine):
+    """
+    Records every migration as applied, for a database that was just created from the models.
+    """
+    current_version(engine)
+    with engine.begin() as conn:
+        for migration in migrations:
+            record_version(conn, migration)
+
+
+def build_index(engine: sqlalchemy.engine.Engine, name: str, table: str, column: str):
+    """
+    Builds an index without locking out writes. An invalid index left behind by an interrupted build is dropped
+    and built again.
+    """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        valid = conn.execute(text('select i.indisvalid from pg_index i join pg_class c on c.oid = i.indexrelid '
+                                  'where c.relname = :name'), name=name).scalar()
+        if valid is False:
+            logger.warning('Rebuilding invalid index %s.', name)
+            conn.execute(text(f'drop index concurrently if exists public.{name}'))
+        conn.execute(text(f'create index concurrently if not exists {name} on public.{table} ("{column}")'))
+
+
+def migrate(engine: sqlalchemy.engine.Engine, target: int = None, lock_timeout: str = '5s'):
+    """
+    Applies every migration after the current version, up to target. Returns the new version.
+    """
+    target = target if target is not None else latest_version()
+    version = current_version(engine)
+    for migration in migrations:
+        if migration.version <= version or migration.version > target:
+            continue
+        logger.info('Applying migration %s: %s', migration.version, migration.description)
+        if migration.create_tables:
+            Base.metadata.create_all(engine, checkfirst=True)
+        if migration.statements:
+            with engine.begin() as conn:
+                conn.execute(text(f"set local lock_timeout = '{lock_timeout}'"))
+                for statement in migration.statements:
+                    conn.execute(text(statement))
+        for name, table, column in migration.indexes:
+            build_index(engine, name, table, column)
+        with engine.begin() as conn:
+            record_version(conn, migration)
+        version = migration.version
+    return version
+
+
+def missing_indexes(engine: sqlalchemy.engine.Engine):
+    """
+    Returns the hot (table, column) pairs that no valid index starts with.
+    """
+    with engine.connect() as conn:
+        indexed = set(conn.execute(text(
+            'select t.relname, a.attname from pg_index i '
+            'join pg_class t on t.oid = i.indrelid '
+            'join pg_namespace n on n.oid = t.relnamespace '
+            'join pg_attribute a on a.attrelid = t.oid and a.attnum = i.indkey[0] '
+            "where n.nspname = 'public' and i.indisvalid")).fetchall())
+    return [(table, column) for table, column in hot_columns if (table, column) not in indexed]
@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+
+import sqlalchemy
+from sqlalchemy.ext.declarative import declarative_base
+
+"""
+Database models, shared by the server, services and dbmanage.py.
+"""
+
+Base = declarative_base()
+
+
+class IPBlacklist(Base):
+    __tablename__ = "ipblacklist"
+    ip = sqlalchemy.Column(sqlalchemy.String(length=15),
+                           unique=True, nullable=False, primary_key=True)
+    expires = sqlalchemy.Column(
+        sqlalchemy.DateTime, unique=False, nullable=True, index=True)
+    reason = sqlalchemy.Column(sqlalchemy.String(
+        length=100), unique=False, nullable=False)
+
+
+class Subscribers(Base):
+    __tablename__ = "subscribers"
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+    # Required
+    user = sqlalchemy.Column(sqlalchemy.Integer, unique=False, nullable=False)
+    subscriber_category = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    registration_ip = sqlalchemy.Column(
+        sqlalchemy.String(length=15), unique=False, nullable=False)
+    cancelled = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    terminated = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+
+
+class Terminals(Base):
+    __tablename__ = "terminals"
+    ssid = sqlalchemy.Column(sqlalchemy.String(
+        length=16), primary_key=True, unique=True, nullable=False)
+    subscriber = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False, index=True)
+
+
+class Users(Base):
+    __tablename__ = "users"
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+    # Required
+    username = sqlalchemy.Column(sqlalchemy.String(
+        length=12), unique=True, nullable=False)
+    # FIXME: something something argon2id compatible settings
+    password = sqlalchemy.Column(sqlalchemy.String(
+        length=100), unique=False, nullable=False)
+    timezone = sqlalchemy.Column(sqlalchemy.String(
+        length=5), unique=False, nullable=False)
+    is_subscriber = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    subscriber = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False, index=True)
+    registration_ip = sqlalchemy.Column(
+        sqlalchemy.String(length=15), unique=False, nullable=False)
+
+    # User information
+    first_name = sqlalchemy.Column(sqlalchemy.String(
+        length=18), unique=False, nullable=False)
+    last_name = sqlalchemy.Column(sqlalchemy.String(
+        length=18), unique=False, nullable=True)
+
+    # Socialization
+    irc_nick = sqlalchemy.Column(sqlalchemy.String(
+        length=8), unique=True, nullable=False)
+    has_mail_account = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    mail_username = sqlalchemy.Column(
+        sqlalchemy.String(length=12), unique=True, nullable=True)
+    mail_password = sqlalchemy.Column(
+        sqlalchemy.String(length=256), unique=True, nullable=True)
+    has_news_account = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    news_username = sqlalchemy.Column(
+        sqlalchemy.String(length=12), unique=True, nullable=True)
+    news_password = sqlalchemy.Column(
+        sqlalchemy.String(length=256), unique=True, nullable=True)
+    messenger_enabled = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    messenger_server = sqlalchemy.Column(
+        sqlalchemy.String(length=253), unique=False, nullable=True)
+    # FIXME: Escargot password WILL be encrypted. No clue what the output is.
+    messenger_password = sqlalchemy.Column(
+        sqlalchemy.String(length=20), unique=True, nullable=True)
+    wtv_domain = sqlalchemy.Column(sqlalchemy.String(
+        length=253), unique=False, nullable=True)
+
+    # Settings
+    setup_advanced_option = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    setup_play_bgm = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    setup_bgm_tempo = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    setup_bgm_volume = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    setup_background_color = sqlalchemy.Column(
+        sqlalchemy.String(6), unique=False, nullable=False)
+    setup_font_sizes = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    setup_in_stereo = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    setup_keyboard = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    setup_link_color = sqlalchemy.Column(
+        sqlalchemy.String(6), unique=False, nullable=False)
+    setup_play_songs = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    setup_play_sounds = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    setup_text_color = sqlalchemy.Column(
+        sqlalchemy.String(6), unique=False, nullable=False)
+    setup_visited_color = sqlalchemy.Column(
+        sqlalchemy.String(6), unique=False, nullable=False)
+    setup_japan_keyboard = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    setup_chat_access_level = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+    setup_chat_on_nontrusted_page = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
+    setup_tv_chat_level = sqlalchemy.Column(
+        sqlalchemy.Integer, unique=False, nullable=False)
+
+    # Change in case of compromise
+    force_chpasswd = sqlalchemy.Column(
+        sqlalchemy.Boolean, unique=False, nullable=False)
@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+"""
+On-demand sampling profiler.
+
+While it runs, a background thread looks at the stack of every thread that is handling a request, rate times a
+second, and counts each stack with the service and path that thread is serving as its root frames. The result is
+written in collapsed-stack format, ready for flamegraph.pl or speedscope. When it isn't running, the only cost is
+request handlers noting their route in current_routes.
+"""
+
+logger = logging.getLogger(__name__)
+
+# thread ident: (service, path) of the request that thread is handling
+current_routes = dict()
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{frame.f_globals.get("__name__", "?")}:{code.co_name}'
+
+
+class SamplingProfiler:
+    def __init__(self, rate: float = 100, output: str = 'profile-{pid}-{time}.folded'):
+        """
+        rate is samples per second. output is the file each run writes, with {pid} and {time} filled in.
+        """
+        self.rate = rate
+        self.output = output
+        self.samples = Counter()
+        self._lock = threading.Lock()
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def sample(self):
+        """
+        Takes one sample of every request thread.
+        """
+        frames = sys._current_frames()
+        for ident, route in list(current_routes.items()):
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = list()
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.extend(reversed(route))
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def run(self, duration: float):
+        """
+        Samples for duration seconds, writes the collapsed stacks and returns the file name.
+        Returns None if a run is already in progress.
+        """
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+            self.samples = Counter()
+        logger.info('Profiling for %gs at %g samples/s.', duration, self.rate)
+        try:
+            interval = 1 / self.rate
+            deadline = time.monotonic() + duration
+            next_sample = time.monotonic()
+            while next_sample < deadline:
+                self.sample()
+                next_sample += interval
+                delay = next_sample - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_sample = time.monotonic()  # fell behind; don't try to catch up
+            return self.write()
+        finally:
+            self._running = False
+
+    def write(self):
+        path = self.output.format(pid=os.getpid(), time=time.strftime('%Y%m%d-%H%M%S'))
+        with open(path, 'w') as fh:
+            for stack, count in self.samples.most_common():
+                fh.write(f'{stack} {count}\n')
+        logger.info('Wrote %d samples of %d stacks to %s.', sum(self.samples.values()), len(self.samples), path)
+        return path
+
+    def start(self, duration: float):
+        """
+        Runs the profiler on a background thread.
+        """
+        threading.Thread(target=self.run, args=(duration,), name='profiler', daemon=True).start()
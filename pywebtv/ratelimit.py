@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBuckets:
+    """
+    In-process token buckets, one per key.
+
+    Each bucket holds up to burst tokens and refills at rate tokens per second; a request takes one token. Buckets
+    that have refilled completely are forgotten, so idle clients cost nothing.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = dict()
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + 60
+
+    def take(self, key: str):
+        """
+        Takes a token from key's bucket. Returns False if it's empty.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if now >= self._next_sweep:
+                self._sweep(now)
+            return allowed
+
+    def _sweep(self, now: float):
+        full = now - self.burst / self.rate if self.rate else now
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[1] > full}
+        self._next_sweep = now + 60
+
+
+class RateLimiter:
+    """
+    Admission-time rate limiting per client IP and per SSID.
+
+    Every request takes a token from the local bucket for its kind and key. With shared set, it then also takes one
+    from a bucket in the state store, which limits a client across every node; that costs a store round trip per
+    request, so the local tier runs first and turns most abusive traffic away on its own.
+    """
+
+    def __init__(self, config: dict, store=None):
+        """
+        config is the "ratelimit" section of config.json, e.g.
+        {"ip": {"rate": 20, "burst": 40}, "ssid": {"rate": 10, "burst": 20}, "shared": false}
+
+        store is the StateStore used for the shared tier.
+        """
+        self.limits = {kind: (float(config[kind]['rate']), float(config[kind]['burst']))
+                       for kind in ('ip', 'ssid') if kind in config}
+        self.local = {kind: TokenBuckets(rate, burst) for kind, (rate, burst) in self.limits.items()}
+        self.store = store if config.get('shared') else None
+        self.counters = {kind: {'allowed': 0, 'limited': 0} for kind in self.limits}
+        self._lock = threading.Lock()
+
+    def allow(self, kind: str, key: str):
+        """
+        Returns False if the client identified by key has gone over its limit for kind.
+        """
+        if kind not in self.limits or not key:
+            return True
+        allowed = self.local[kind].take(key)
+        if allowed and self.store is not None:
+            rate, burst = self.limits[kind]
+            try:
+                allowed = self.store.take_token(f'{kind}_{key}', rate, burst)
+            except Exception as e:
+                # the local tier still applies if the shared one is down
+                logger.warning('Shared rate limit check failed: %s', e)
+        with self._lock:
+            self.counters[kind]['allowed' if allowed else 'limited'] += 1
+        return allowed
+
+    def stats(self):
+        with self._lock:
+            return {kind: dict(counters) for kind, counters in self.counters.items()}
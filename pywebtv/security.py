@@ -1,13 +1,17 @@
 # -*- coding: UTF-8 -*-
 
 import base64
+import hashlib
 import os
 import random
-from Crypto.Cipher import ARC4, DES
-from Crypto.Hash import MD5
-from Crypto.Random import get_random_bytes
+import string
 from json import dumps as jdump
 from json import loads as jload
+from typing import TYPE_CHECKING
+
+# pycryptodome is only imported once a box actually goes secure
+if TYPE_CHECKING:
+    from .state import StateStore
 
 
 class WTVNetworkSecurity():
@@ -24,36 +28,51 @@ class WTVNetworkSecurity():
     https://github.com/zefie/zefie_wtvp_minisrv/blob/master/zefie_wtvp_minisrv/WTVSec.js
     https://discord.com/channels/669359927893950483/808168241306140703/848731674962821181 (WebTV Server, join from https://webtvwiki.net)
     """
-    initial_shared_key = bytes()
-    initial_shared_key_b64 = str()
-    current_shared_key = bytes()
-    current_shared_key_b64 = str()
-    past_shared_key = bytes()
-    past_shared_key_b64 = str()
-    incarnation = 1
-    rc4_key1 = bytes()
-    rc4_key2 = bytes()
-    hRC4_Key1 = None
-    hRC4_rawkey1 = bytes()
-    hRC4_Key2 = None
-    hRC4_rawkey2 = bytes()
-    session_token1 = str()
-    session_token2 = str()
-    ip_address = str()
-    ssid = str()
-
-    def __init__(self, wtv_initial_key: bytes = base64.b64encode(get_random_bytes(8)).decode(),
+    __slots__ = ('initial_shared_key', 'current_shared_key', 'past_shared_key', 'incarnation', 'rc4_key1', 'rc4_key2',
+                 'hRC4_Key1', 'hRC4_rawkey1', 'hRC4_Key2', 'hRC4_rawkey2', 'session_token1', 'session_token2',
+                 'ip_address', 'ssid')
+
+    def __init__(self, wtv_initial_key: str = None,
                  wtv_incarnation: int = 1):
         """
         We initialize the incarnation (request count) and initial shared key
         used for encryption in this function.
+
+        Secure connections keep one of these open for their whole life, so only the raw keys are stored; the base64
+        forms are computed when asked for.
         """
-        self.initial_shared_key_b64 = wtv_initial_key
-        initial_key = base64.b64decode(wtv_initial_key)
+        if wtv_initial_key is None:
+            initial_key = os.urandom(8)
+        else:
+            initial_key = base64.b64decode(wtv_initial_key)
         self.initial_shared_key = initial_key
+        self.current_shared_key = bytes()
+        self.past_shared_key = bytes()
         self.incarnation = wtv_incarnation
+        self.rc4_key1 = bytes()
+        self.rc4_key2 = bytes()
+        self.hRC4_Key1 = None
+        self.hRC4_rawkey1 = bytes()
+        self.hRC4_Key2 = None
+        self.hRC4_rawkey2 = bytes()
+        self.session_token1 = str()
+        self.session_token2 = str()
+        self.ip_address = str()
+        self.ssid = str()
         self.set_shared_key(initial_key)
 
+    @property
+    def initial_shared_key_b64(self):
+        return base64.b64encode(self.initial_shared_key).decode()
+
+    @property
+    def current_shared_key_b64(self):
+        return base64.b64encode(self.current_shared_key).decode()
+
+    @property
+    def past_shared_key_b64(self):
+        return base64.b64encode(self.past_shared_key).decode()
+
     def dump(self):
         """
         This dumps a security object, used for either the client ticket, or
@@ -82,8 +101,11 @@ class WTVNetworkSecurity():
         This will import a security object, from a dump provided by the dump()
         function.
         """
+        from Crypto.Cipher import ARC4
         x = jload(base64.b64decode(dump).decode())
         for key, value in x.items():
+            if key not in self.__slots__:
+                continue  # the base64 keys follow from the raw ones; anything else isn't ours
             if (type(value) is int) == False and value.startswith('b~!'):
                 value = base64.b64decode(value[3:])
             elif (type(value) is int) == False and value.startswith('c~!'):
@@ -108,7 +130,7 @@ class WTVNetworkSecurity():
         self.session_token2 = ''.join(random.choice(string.printable) for _ in range(16))
         return (self.session_token1, self.session_token2)
 
-    def verify_session(self, db, ssid, ticket: str):  # FIXME: use redis db object in "db"
+    def verify_session(self, store: 'StateStore', ssid, ticket: str):
         """
         This function will verify session objects for this particular security session.
         """
@@ -118,15 +140,14 @@ class WTVNetworkSecurity():
         if not sess1 == self.session_token1 or not sess2 == self.session_token2:
             raise ValueError('Session does not match security object.')
         # This will be untested for awhile.
-        try:
-            sessionobj = db.get(f'session_{ssid}_{sess1}')
-        except:
+        sessionobj = store.get_session(ssid, sess1)
+        if sessionobj is None:
             raise ValueError('Session does not exist.')
         if not sessionobj['ssid'] == ssid:
             raise ValueError('SSID does not match session.')
-        elif sessionobj['k'] == sess2:
+        elif sessionobj['k'] != sess2:
             raise ValueError('Session token key does not match ticket.')
-        elif sessionobj['k'] == self.session_token2:
+        elif sessionobj['k'] != self.session_token2:
             raise ValueError('Session token key does not match security object.')
         return True
 
@@ -141,13 +162,9 @@ class WTVNetworkSecurity():
         if len(shared_key) == 8:
             if self.past_shared_key == bytes():
                 self.past_shared_key = shared_key
-                self.past_shared_key_b64 = base64.b64encode(
-                    shared_key).decode()
             else:
                 self.past_shared_key = self.current_shared_key
-                self.past_shared_key_b64 = self.current_shared_key_b64
             self.current_shared_key = shared_key
-            self.current_shared_key_b64 = base64.b64encode(shared_key).decode()
         else:
             raise ValueError("Invalid shared key length")
 
@@ -160,6 +177,7 @@ class WTVNetworkSecurity():
         This function is only used when issuing a challenge due to a quirk in
         WebTV's client.
         """
+        from Crypto.Cipher import DES
         challenge = base64.b64decode(wtv_challenge)
 
         if not len(challenge) > 8:
@@ -169,7 +187,7 @@ class WTVNetworkSecurity():
 
         challenge_decrypted = hDES1.decrypt(challenge[8:])
 
-        hMD5 = MD5.new()
+        hMD5 = hashlib.md5()
         hMD5.update(challenge_decrypted[0:80])
         test = challenge_decrypted[80:96]
         test2 = hMD5.digest()
@@ -177,7 +195,7 @@ class WTVNetworkSecurity():
             self.set_shared_key(challenge_decrypted[72:80])
 
             challenge_echo = challenge_decrypted[0:40]
-            hMD5 = MD5.new()
+            hMD5 = hashlib.md5()
             hMD5.update(challenge_echo)
             challenge_echo_md5 = hMD5.digest()
 
@@ -215,17 +233,18 @@ class WTVNetworkSecurity():
             bytes 88-104: MD5 of 8-88
             bytes 104-112: padding. not important
         """
+        from Crypto.Cipher import DES
 
-        random_id_question_mark = get_random_bytes(8)
+        random_id_question_mark = os.urandom(8)
 
-        echo_me = get_random_bytes(40)
-        self.rc4_key1 = get_random_bytes(16)
-        self.rc4_key2 = get_random_bytes(16)
-        new_shared_key = get_random_bytes(8)
+        echo_me = os.urandom(40)
+        self.rc4_key1 = os.urandom(16)
+        self.rc4_key2 = os.urandom(16)
+        new_shared_key = os.urandom(8)
 
         challenge_puzzle = echo_me + self.rc4_key1 + \
                            self.rc4_key2 + new_shared_key
-        hMD5 = MD5.new()
+        hMD5 = hashlib.md5()
         hMD5.update(challenge_puzzle)
         challenge_puzzle_md5 = hMD5.digest()
 
@@ -250,13 +269,14 @@ class WTVNetworkSecurity():
 
         Specifically, these will update 2 RC4 encryption keys.
         """
-        hMD5 = MD5.new()
+        from Crypto.Cipher import ARC4
+        hMD5 = hashlib.md5()
         hMD5.update(self.rc4_key1 + self.incarnation.to_bytes(4,
                                                               byteorder='big') + self.rc4_key1)
         self.hRC4_rawkey1 = hMD5.digest()
         self.hRC4_Key1 = ARC4.new(self.hRC4_rawkey1)
 
-        hMD51 = MD5.new()
+        hMD51 = hashlib.md5()
         hMD51.update(self.rc4_key2 + self.incarnation.to_bytes(4,
                                                                byteorder='big') + self.rc4_key2)
         self.hRC4_rawkey2 = hMD51.digest()
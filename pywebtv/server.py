@@ -1,17 +1,22 @@
 # -*- coding: UTF-8 -*-
 
 from . import functions
-from .decorators import Box, WTVPError
+from .body import RequestBody, iter_form_params
+from .decorators import Box, WTVPError, lookuptable
+from .logs import log_access
+from .profiler import current_routes
 from .security import WTVNetworkSecurity
 import io
 import logging
 import os
-import redis
+import queue
+import socket
 import socketserver
-import sqlalchemy
-from redis.commands.json.path import Path
-from urllib.parse import quote, unquote
-from sqlalchemy.sql import text
+import threading
+import time
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
 
 
 class WTVPServer(socketserver.ThreadingTCPServer):
@@ -22,6 +27,23 @@ class WTVPServer(socketserver.ThreadingTCPServer):
     """
     daemon_threads = True
     allow_reuse_address = 1
+    draining: bool = False
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate: bool = True, listen_fd: int = None):
+        """
+        This will set up the listening socket, or adopt one inherited from a previous server process.
+        """
+        self._active = 0
+        self._active_lock = threading.Condition()
+        if listen_fd is None:
+            super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+            return
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate=False)
+        self.socket.close()
+        self.socket = socket.socket(fileno=listen_fd)
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        logger.info('Service listening on inherited socket %s:%s.', host, port)
 
     def server_bind(self):
         """
@@ -29,46 +51,288 @@ class WTVPServer(socketserver.ThreadingTCPServer):
         """
         socketserver.ThreadingTCPServer.server_bind(self)
         host, port = self.server_address
-        logging.info(f'Service listening on {host}:{port}.')
+        logger.info('Service listening on %s:%s.', host, port)
+
+    def finish_request(self, request, client_address):
+        """
+        Handles a connection while counting it as active, so a draining server knows when it's done.
+        """
+        with self._active_lock:
+            self._active += 1
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            with self._active_lock:
+                self._active -= 1
+                self._active_lock.notify_all()
+
+    @property
+    def active_connections(self):
+        return self._active
+
+    def drain(self, timeout: float):
+        """
+        Waits until every connection has finished or timeout seconds have passed.
+        Keep-alive connections are closed after their current request once draining is set.
+        Returns the number of connections still open.
+        """
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        with self._active_lock:
+            while self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._active_lock.wait(remaining)
+            return self._active
+
 
+class WTVPPooledServer(WTVPServer):
+    """
+    WebTV protocol server class with a fixed-size worker pool.
+
+    Accepted connections are put on a bounded queue and handled by a fixed number of worker threads, instead of
+    starting a new thread for every connection. When the queue is full, the connection is answered with a 500 and
+    closed, so a reconnect storm sheds load instead of spawning thousands of threads.
 
-class WTVPRequestRouter(socketserver.StreamRequestHandler):
+    A keep-alive connection holds its worker while it's idle, so connections that send nothing for idle_timeout
+    seconds are closed; otherwise as many idle boxes as there are workers would starve the pool.
+    """
+    workers: int = 32
+    queue_size: int = 128
+    idle_timeout: float = 120
+
+    def __init__(self, server_address, RequestHandlerClass, workers: int = None, queue_size: int = None,
+                 idle_timeout: float = None, bind_and_activate: bool = True, listen_fd: int = None):
+        """
+        This will initialize the accept queue and start the worker threads.
+        """
+        if workers:
+            self.workers = workers
+        if queue_size:
+            self.queue_size = queue_size
+        if idle_timeout:
+            self.idle_timeout = idle_timeout
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._busy = 0
+        self._served = 0
+        self._shed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate, listen_fd=listen_fd)
+        self._workers = list()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f'wtvp-worker-{i}', daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    @property
+    def queue_depth(self):
+        """
+        Number of accepted connections waiting for a worker.
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        Returns a dictionary of worker pool statistics.
+        """
+        with self._stats_lock:
+            return {
+                'workers': self.workers,
+                'busy': self._busy,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'served': self._served,
+                'shed': self._shed,
+                'wait_avg': self._wait_total / self._served if self._served else 0.0,
+                'wait_max': self._wait_max
+            }
+
+    def process_request(self, request, client_address):
+        """
+        Queues a connection for the worker pool, or sheds it if the queue is full.
+        """
+        request.settimeout(self.idle_timeout)
+        try:
+            self._queue.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self._shed += 1
+            logger.warning('Accept queue full, dropping connection from %s:%s.', *client_address[:2])
+            try:
+                request.sendall(f'{lookuptable[500]}\r\nConnection: close\r\n\r\n'.encode())
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _worker(self):
+        """
+        Worker thread loop; handles queued connections until the server is closed.
+        """
+        while not self._stopping.is_set():
+            try:
+                request, client_address, queued = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            waited = time.monotonic() - queued
+            with self._stats_lock:
+                self._busy += 1
+                self._served += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._stats_lock:
+                    self._busy -= 1
+
+    def server_close(self):
+        """
+        Stops the worker threads and closes any connections still waiting in the queue.
+        """
+        super().server_close()
+        self._stopping.set()
+        while True:
+            try:
+                request, _, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(request)
+
+
+class SocketWriter:
+    """
+    Unbuffered writes to a socket, like the wfile socketserver.StreamRequestHandler sets up.
+    """
+    __slots__ = ('sock', 'closed')
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class DecryptingReader:
+    """
+    Reads a secure request: the request line and headers, already decrypted, then the body, decrypted a chunk at a
+    time as it's read off the socket.
+    """
+    __slots__ = ('head', 'rfile', 'security')
+
+    def __init__(self, head: bytes, rfile, security: WTVNetworkSecurity):
+        self.head = io.BytesIO(head)
+        self.rfile = rfile
+        self.security = security
+
+    def readline(self, size: int = -1):
+        return self.head.readline(size)
+
+    def read(self, size: int = -1):
+        data = self.head.read(size)
+        if size < 0 or len(data) < size:
+            rest = self.rfile.read(size - len(data) if size >= 0 else -1)
+            if rest:
+                data += self.security.decrypt(1, rest)
+        return data
+
+
+class WTVPRequestRouter:
     """
     WebTV request routing class.
 
     This class will handle requests made to the server.
+
+    One is alive for every open connection, most of them idle keep-alives. It does what
+    socketserver.StreamRequestHandler would, but isn't one: that class has no __slots__, so every instance of a
+    subclass would still carry a __dict__. The shared database, store and rate limiter are reached through the
+    service state instead of being held one by one.
     """
-    box: Box = None
-    close_connection: bool = True
-    global_config: dict = None
-    headers: dict = None
-    security: WTVNetworkSecurity = None
-    security_on: bool = False
-    service_ip: str = None
-    service_dir: str = None
-    service_config: dict = None
-    service_name: str = None
-    ssid: str = None
-
-    def __init__(self, *args, service_config, service_dir, service_ip, global_config, **kwargs):
+    __slots__ = ('box', 'client_address', 'close_connection', 'connection', 'headers', 'request', 'request_started',
+                 'requestline', 'rfile', 'security', 'security_on', 'server', 'service_dir', 'service_ip', 'ssid',
+                 'state', 'wfile', 'zfile')
+    # requests from a box are a few hundred bytes; the default 8KiB read buffer is mostly wasted on idle connections
+    rbufsize = 1024
+
+    def __init__(self, request, client_address, server, *, context, service_dir, service_ip):
         """
-        This will initialize service settings.
+        This will initialize service settings, then handle the connection until it's closed.
         """
+        self.request = request
+        self.client_address = client_address
+        self.server = server
         self.service_ip = service_ip
         self.service_dir = service_dir
-        self.service_config = service_config
-        self.global_config = global_config
-
-        sqlconfig = global_config['db']['psql']
-        redisconfig = global_config['db']['redis']
-        # sql used for service and user information storage
-        self.sqlengine = sqlalchemy.create_engine(
-            f"postgresql+pg8000://{sqlconfig['username']}:{quote(sqlconfig['password'])}@{sqlconfig['host']}:{sqlconfig['port']}/{sqlconfig['database']}")
-        # redis used for temporary session storage
-        self.redisengine = redis.Redis(
-            host=redisconfig['host'], port=redisconfig['port'], db=redisconfig['db'])
-        self.redisengine.json().set('connections', Path.rootPath(), dict())
-        super().__init__(*args, **kwargs)
+        self.box = None
+        self.close_connection = True
+        self.headers = None
+        self.request_started = None
+        self.requestline = None
+        self.security = None
+        self.security_on = False
+        self.ssid = None
+        self.zfile = None
+        # the state is taken once, so a reload doesn't change settings mid-connection
+        self.state = context.acquire()
+        try:
+            self.setup()
+            try:
+                self.handle()
+            finally:
+                self.finish()
+        finally:
+            context.release(self.state)
+
+    def setup(self):
+        self.connection = self.request
+        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.wfile = SocketWriter(self.connection)
+
+    def finish(self):
+        self.wfile.close()
+        self.rfile.close()
+
+    @property
+    def service_config(self) -> dict:
+        return self.state.service_config
+
+    @property
+    def global_config(self) -> dict:
+        return self.state.global_config
+
+    @property
+    def sqlengine(self):
+        return self.state.sqlengine
+
+    @property
+    def db(self):
+        return self.state.db
+
+    @property
+    def accounts(self):
+        return self.state.accounts
+
+    @property
+    def store(self):
+        return self.state.store
+
+    @property
+    def ratelimiter(self):
+        return self.state.ratelimiter
 
     def handle(self):
         """
@@ -76,19 +340,36 @@ class WTVPRequestRouter(socketserver.StreamRequestHandler):
 
         It will pass requests through to the actual request handler.
         """
-        logging.debug(
-            f'Connection from {self.client_address[0]}:{self.client_address[1]}')
-        if self.sqlengine.execute(text('select * from public.ipblacklist where ip = :ip;'),
-                                  ip=self.client_address[0]).fetchall():
+        logger.debug('Connection from %s:%s', *self.client_address[:2])
+        if self.db.is_blacklisted(self.client_address[0]):
             self.wfile.write(
                 b'500 MSN TV ran into a technical problem. Please try again.\nConnection: close\n\n')
             return
         self.close_connection = True
-        self.handle_request()
-        while not self.close_connection:
+        try:
             self.handle_request()
+            # a draining server closes keep-alive connections between requests
+            while not self.close_connection and not self.server.draining:
+                self.handle_request()
+        except TimeoutError:
+            logger.debug('Connection from %s:%s timed out.', *self.client_address[:2])
+            self.close_connection = True
+            self.garbage_collection()
         return
 
+    def garbage_collection(self):
+        if self.ssid:  # if we have an ssid for this connection
+            # remove connection from "pool", and its sessions if it was the box's last one
+            self.store.release_connection(self.ssid, f'{self.client_address[1]}:{self.service_config["port"]}')
+
+    def rate_limited(self):
+        """
+        Turns away a request from a client that's over its rate limit, and closes the connection.
+        """
+        logger.info('Rate limited %s (%s).', self.client_address[0], self.ssid)
+        self.wfile.write(b'500 MSN TV ran into a technical problem. Please try again.\r\nConnection: close\r\n\r\n')
+        self.close_connection = True
+
     def handle_request(self):
         """
         This function is the main request handler function.
@@ -96,30 +377,14 @@ class WTVPRequestRouter(socketserver.StreamRequestHandler):
         then call functions to parse, perform, and log the request.
         """
 
-        def garbage_collection(self):
-            if self.ssid:  # if we have an ssid for this connection
-                connectionlist = self.redisengine.json().get('connections')
-                try:
-                    # remove connection from "pool"
-                    connectionlist[self.ssid].remove(f'{self.client_address[1]}:{self.service_config["port"]}')
-                except:
-                    pass
-                self.redisengine.json().set('connections', Path.rootPath(), connectionlist)
-                if connectionlist[self.ssid]:
-                    if len(connectionlist[self.ssid]) == 0:
-                        for key in x.scan_iter(f'session_{self.ssid}_*'):
-                            print('garbage')
-                            self.redisengine.delete(key)  # session garbage collection
-
         if self.security_on:
             data = bytes()
             while True:
                 rbyte = self.rfile.read(1)
                 if not rbyte:
-                    logging.debug(
-                        f'Connection from {self.client_address[0]}:{self.client_address[1]} dropped.')
+                    logger.debug('Connection from %s:%s dropped.', *self.client_address[:2])
                     self.close_connection = True
-                    garbage_collection(self)
+                    self.garbage_collection()
                     return
                 try:
                     decattempt = self.security.decrypt(1, rbyte)
@@ -132,19 +397,28 @@ class WTVPRequestRouter(socketserver.StreamRequestHandler):
                     if data.startswith(b'POST'):
                         cl = int(data.split(b'ength:')[
                                      1].split(b'\n')[0].strip())
-                        data += self.security.decrypt(1, self.rfile.read(cl))
+                        if cl > self.service_config.get('max_body_size', 16 * 1024 * 1024):
+                            self.wfile.write(
+                                b'500 MSN TV ran into a technical problem. Please try again.\r\nConnection: close\r\n\r\n')
+                            self.close_connection = True
+                            return
                     break
-            self.zfile = io.BytesIO(data)
+            # a POST body is left on the socket and decrypted as the request handler reads it into a RequestBody
+            self.zfile = DecryptingReader(data, self.rfile, self.security)
             # self.requestline = self.zfile.readline(65536)
         else:
             self.zfile = self.rfile
 
         self.requestline = self.zfile.readline(65536).decode().strip()
+        self.request_started = time.perf_counter()
         if not self.requestline:
-            logging.debug(
-                f'Connection from {self.client_address[0]}:{self.client_address[1]} dropped.')
+            logger.debug('Connection from %s:%s dropped.', *self.client_address[:2])
             self.close_connection = True
-            garbage_collection(self)
+            self.garbage_collection()
+            return
+        if not self.ratelimiter.allow('ip', self.client_address[0]):
+            self.rate_limited()
+            self.garbage_collection()
             return
         words = self.requestline.split(' ')
         if self.requestline.endswith('HTTP/1.0') or self.requestline.endswith('HTTP/1.1'):
@@ -157,23 +431,20 @@ class WTVPRequestRouter(socketserver.StreamRequestHandler):
             return
         # parse box headers
         if not self.headers:
-            parse_headers(self)
-            print(self.headers)
+            parse_headers(self, self.zfile)
+            logger.debug('Headers: %s', self.headers)
         if not self.box:
             self.box = Box(self.headers)
         if not self.ssid:
             self.ssid = self.headers['wtv-client-serial-number']
+        if not self.ratelimiter.allow('ssid', self.ssid):
+            self.rate_limited()
+            self.garbage_collection()
+            return
 
         # note connection
-        connectionlist = self.redisengine.json().get('connections')
-        if self.ssid not in connectionlist.keys():
-            connectionlist.update({self.ssid: list()})
-        portdata = f'{self.client_address[1]}:{self.service_config["port"]}'
-        if connectionlist[self.ssid] == None:
-            connectionlist[self.ssid] = list()
-        if not portdata in connectionlist[self.ssid]:
-            connectionlist[self.ssid] = connectionlist[self.ssid].append(portdata)  # client port:server port
-            self.redisengine.json().set('connections', Path.rootPath(), connectionlist)
+        portdata = f'{self.client_address[1]}:{self.service_config["port"]}'  # client port:server port
+        self.store.touch_connection(self.ssid, portdata)
         if words[0] == 'SECURE':
             self.security = WTVNetworkSecurity()
             if 'wtv-ticket' in self.headers:
@@ -194,7 +465,12 @@ class WTVPRequestRouter(socketserver.StreamRequestHandler):
                 wfile=self.wfile,
                 router=self
             )
-            request_handler.handle_request()
+            try:
+                request_handler.handle_request()
+            finally:
+                # every request brings its own headers, so an idle connection doesn't need to keep these
+                self.headers = None
+                self.zfile = None
 
 
 class WTVPRequestHandler:
@@ -203,13 +479,15 @@ class WTVPRequestHandler:
 
     This class will handle requests coming from the request router.
     """
+    body: RequestBody = None
+    post_params: dict = None
     router = None
 
     def __init__(self, rfile, wfile, router):
         """
         This will initialize service settings.
         """
-        self.rfile = router.rfile
+        self.rfile = rfile
         self.wfile = router.wfile
         self.service_config = router.service_config
         self.service_dir = router.service_dir
@@ -235,10 +513,24 @@ class WTVPRequestHandler:
         if not self.router.ssid:
             self.router.ssid = self.headers['wtv-client-serial-number']
         if self.method == 'POST':
-            self.data = self.rfile.read(self.headers['Content-Length'])
-            if self.headers['Content-Type'] == 'application/x-www-form-urlencoded':
-                decode_data_params(self)
+            try:
+                self.body = RequestBody(
+                    self.rfile,
+                    int(self.headers.get('Content-Length', 0)),
+                    max_size=self.service_config.get('max_body_size', 16 * 1024 * 1024),
+                    spool_threshold=self.service_config.get('body_spool_threshold', 256 * 1024)
+                )
+                if self.headers.get('Content-Type') == 'application/x-www-form-urlencoded':
+                    decode_data_params(self)
+            except ValueError as e:
+                logger.debug('Rejected body from %s:%s: %s', *self.router.client_address[:2], e)
+                self.wfile.write(
+                    b'500 MSN TV ran into a technical problem. Please try again.\r\nConnection: close\r\n\r\n')
+                self.router.close_connection = True
+                return
         path = self.path[0].replace('-', '_')
+        # lets the sampling profiler attribute this thread's stack to the route
+        current_routes[threading.get_ident()] = (self.service, '/'.join(self.path))
         try:
             if not self.service_config['stub']:
                 import service  # This is that hack mentioned in __main__.py
@@ -253,10 +545,28 @@ class WTVPRequestHandler:
             except UnboundLocalError:
                 page = WTVPError
                 request = 404
-        resp = page(request)
-        self.wfile.write(resp.generate_response())
+        try:
+            resp = page(request)
+            output = resp.generate_response()
+            self.wfile.write(output)
+            log_access(self.router.client_address[0], self.router.ssid, self.service, self.method, self.url,
+                       resp.status_code, len(output), self.router.request_started)
+        finally:
+            current_routes.pop(threading.get_ident(), None)
+            if self.body is not None:
+                self.body.close()
         return
 
+    @property
+    def data(self):
+        """
+        The full request body as bytes.
+        Prefer reading request.body, which does not load the body into memory.
+        """
+        if self.body is None:
+            return b''
+        return self.body.getvalue()
+
     def return_filepath(request):
         """
         Return file path if found.
@@ -281,13 +591,16 @@ class WTVPRequestHandler:
         return path
 
 
-def parse_headers(request):
+def parse_headers(request, rfile=None):
     """
     Parses HTTP headers to a dictionary.
+    They are read from rfile, or from request.rfile if it isn't given.
     """
+    if rfile is None:
+        rfile = request.rfile
     request.headers = dict()
     while True:
-        line = request.rfile.readline(65537)
+        line = rfile.readline(65537)
         if len(line) > 65536:
             raise ValueError('Header is too long.')
         if line in [b'\r\n', b'\n', b'']:
@@ -331,12 +644,10 @@ def parse_url(request):
 
 def decode_data_params(request):
     """
-    This will decode request.data to a key: value dictionary.
+    This will decode request.body to a key: value dictionary.
     Useful for POST requests.
     """
-    data = request.data.decode()
     request.post_params = dict()
-    for param in data.split('&'):
-        param = param.split('=')
-        request.post_params.update({param[0]: param[1]})
+    for key, value in iter_form_params(request.body):
+        request.post_params.update({key: value})
     return
@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+"""
+Startup profiling for python -m pywebtv --profile-startup.
+
+The server is started again in a child process under python -X importtime, which times every import; the child
+also times each startup phase, then exits instead of serving. The parent prints both as one report.
+
+The child reads the same configuration and creates the same clients as a real start, so it connects to the
+configured database and Redis backends if anything it initializes does. It doesn't reset the connection bookkeeping
+in the store and doesn't bind the service port, so it is safe to run next to a live server.
+"""
+
+phase_marker = 'pywebtv-startup-phase'
+# set in the child's environment by profile()
+profiling_variable = 'PYWEBTV_PROFILE_STARTUP'
+phases = list()
+
+
+def profiling():
+    """
+    True in the child process started by profile().
+    """
+    return os.environ.get(profiling_variable) == '1'
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Times a startup phase when profiling. Costs nothing otherwise.
+    """
+    if not profiling():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - started))
+
+
+def report_phases():
+    for name, seconds in phases:
+        print(f'{phase_marker}\t{name}\t{seconds:.6f}', file=sys.stderr, flush=True)
+
+
+def parse_importtime(lines: list):
+    """
+    Returns [(module, self µs, cumulative µs, depth)] from -X importtime output.
+    """
+    imports = list()
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            imports.append((name.strip(), int(self_us), int(cumulative_us), (len(name) - len(name.lstrip())) // 2))
+        except ValueError:
+            continue
+    return imports
+
+
+def profile(argv: list, top: int = 15, out=sys.stdout):
+    """
+    Starts the server with argv in a profiling child process and prints where its startup time went.
+    Returns the child's exit code.
+    """
+    started = time.perf_counter()
+    child = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'pywebtv'] + argv,
+                           stderr=subprocess.PIPE, text=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1', **{profiling_variable: '1'}))
+    wall = time.perf_counter() - started
+    lines = child.stderr.splitlines()
+    imports = parse_importtime(lines)
+    timed = [line.split('\t') for line in lines if line.startswith(phase_marker)]
+    for line in lines:
+        if not line.startswith('import time:') and not line.startswith(phase_marker):
+            print(line, file=sys.stderr)
+
+    packages = dict()
+    for name, self_us, _, _ in imports:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    print(f'\nStartup took {wall * 1000:.0f}ms, including the interpreter.', file=out)
+    print(f'\n{"package":<32} {"import ms":>10}', file=out)
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f'{package:<32} {self_us / 1000:>10.1f}', file=out)
+    print(f'\n{"slowest modules":<48} {"self ms":>8} {"total ms":>9}', file=out)
+    for name, self_us, cumulative_us, depth in sorted(imports, key=lambda item: -item[1])[:top]:
+        print(f'{name[:48]:<48} {self_us / 1000:>8.1f} {cumulative_us / 1000:>9.1f}', file=out)
+    if timed:
+        print(f'\n{"phase":<32} {"ms":>10}', file=out)
+        for _, name, seconds in timed:
+            print(f'{name:<32} {float(seconds) * 1000:>10.1f}', file=out)
+    return child.returncode
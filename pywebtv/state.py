@@ -0,0 +1,634 @@
+# -*- coding: UTF-8 -*-
+
+from .ratelimit import TokenBuckets
+import atexit
+import bisect
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+# redis is imported by RedisStore when it's used, so the memory backend runs without it
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(ABC):
+    """
+    Storage for connection, session and ticket state.
+
+    Connections are the open sockets of each box (by SSID), sessions are the security sessions checked by
+    WTVNetworkSecurity.verify_session, and tickets are security dumps handed between services.
+
+    Backends must implement every abstract method; one that doesn't can't be instantiated.
+    """
+
+    @abstractmethod
+    def add_connection(self, ssid: str, connection: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_connection(self, ssid: str, connection: str):
+        """
+        Removes a connection and returns how many the box still has open.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def connections(self, ssid: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def reset_connections(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_session(self, ssid: str, token: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_session(self, ssid: str, token: str, session: dict, ttl: int = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_sessions(self, ssid: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_ticket(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_ticket(self, key: str, ticket: str, ttl: int = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_ticket(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_account(self, ssid: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_account(self, ssid: str, account: dict, ttl: int = None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def invalidate_accounts(self, ssid: str = None):
+        """
+        Drops the cached account of one box, or of every box if ssid is None, and tells every listener about it.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_invalidation_listener(self, callback):
+        """
+        Calls callback(ssid) whenever a cached account is invalidated, from any node. ssid is None for all of them.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_invalidation_listener(self, callback):
+        raise NotImplementedError
+
+    @abstractmethod
+    def take_token(self, key: str, rate: float, burst: float):
+        """
+        Takes a token from a shared rate limit bucket. Returns False if it's empty.
+        """
+        raise NotImplementedError
+
+    def touch_connection(self, ssid: str, connection: str):
+        """
+        Notes a request on a connection: registers the connection and renews the box's session TTLs.
+        """
+        self.add_connection(ssid, connection)
+
+    def release_connection(self, ssid: str, connection: str):
+        """
+        Removes a connection, and the box's sessions along with it if that was its last one.
+        """
+        if self.remove_connection(ssid, connection) == 0:
+            self.delete_sessions(ssid)
+
+    def close(self):
+        pass
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to node names.
+
+    Each node is placed on the ring replicas * weight times, so adding or removing a node only moves the keys
+    between it and its neighbours (about 1/n of them) instead of reshuffling everything.
+    """
+
+    def __init__(self, nodes: dict, replicas: int = 160):
+        """
+        nodes maps each node name to its weight.
+        """
+        if not nodes:
+            raise ValueError('A hash ring needs at least one node.')
+        self.nodes = dict(nodes)
+        ring = list()
+        for name, weight in self.nodes.items():
+            for i in range(int(replicas * weight)):
+                ring.append((self._hash(f'{name}#{i}'), name))
+        ring.sort()
+        self._hashes = [point for point, _ in ring]
+        self._names = [name for _, name in ring]
+
+    @staticmethod
+    def _hash(key: str):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def get(self, key: str):
+        """
+        Returns the name of the node that owns key.
+        """
+        i = bisect.bisect(self._hashes, self._hash(key))
+        return self._names[i % len(self._names)]
+
+
+class RedisStore(StateStore):
+    """
+    State kept in Redis, sharded over one or more nodes.
+
+    Each box's connections are a set under connections_<ssid>, sessions are RedisJSON documents under
+    session_<ssid>_<token> indexed by the set sessions_<ssid>, and tickets are strings under ticket_<key>.
+    Connection and session keys are placed by SSID, so everything about one box lives on one node; tickets are
+    placed by their key.
+
+    touch_connection and release_connection each run as one server-side script. With write_behind set, they're
+    queued instead and sent in one pipeline per node every write_behind seconds, so the request never waits on
+    Redis for them.
+    """
+
+    # KEYS: connections_<ssid>, sessions_<ssid>. ARGV: connection, session key prefix, session TTL (0 for none)
+    touch_script = """
+redis.call('SADD', KEYS[1], ARGV[1])
+local ttl = tonumber(ARGV[3])
+if ttl > 0 then
+    for _, token in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+        redis.call('EXPIRE', ARGV[2] .. token, ttl)
+    end
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+"""
+
+    # KEYS: connections_<ssid>, sessions_<ssid>. ARGV: connection, session key prefix
+    release_script = """
+redis.call('SREM', KEYS[1], ARGV[1])
+local remaining = redis.call('SCARD', KEYS[1])
+if remaining == 0 then
+    for _, token in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+        redis.call('DEL', ARGV[2] .. token)
+    end
+    redis.call('DEL', KEYS[2])
+end
+return remaining
+"""
+
+    # KEYS: ratelimit_<key>. ARGV: rate per second, burst
+    token_script = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - last) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+    def __init__(self, clients: dict, weights: dict = None, session_ttl: int = None, write_behind: float = None):
+        """
+        clients maps node names to redis.Redis clients. weights optionally maps node names to their share of keys.
+        """
+        self.clients = dict(clients)
+        weights = weights or dict()
+        self.ring = HashRing({name: weights.get(name, 1) for name in self.clients})
+        self.session_ttl = session_ttl
+        self.write_behind = write_behind
+        self._touch = {name: client.register_script(self.touch_script) for name, client in self.clients.items()}
+        self._release = {name: client.register_script(self.release_script) for name, client in self.clients.items()}
+        self._token = {name: client.register_script(self.token_script) for name, client in self.clients.items()}
+        self._pending = list()
+        self._pending_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._listeners = list()
+        self._subscribers = list()
+        if write_behind:
+            self._flusher = threading.Thread(target=self._flush_loop, name='state-write-behind', daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def client(self, key: str):
+        return self.clients[self.ring.get(key)]
+
+    def add_connection(self, ssid: str, connection: str):
+        self.client(ssid).sadd(f'connections_{ssid}', connection)
+
+    def remove_connection(self, ssid: str, connection: str):
+        pipe = self.client(ssid).pipeline()
+        pipe.srem(f'connections_{ssid}', connection)
+        pipe.scard(f'connections_{ssid}')
+        return pipe.execute()[1]
+
+    def connections(self, ssid: str):
+        return sorted(member.decode() for member in self.client(ssid).smembers(f'connections_{ssid}'))
+
+    def reset_connections(self):
+        for client in self.clients.values():
+            for key in client.scan_iter('connections_*'):
+                client.delete(key)
+
+    def get_session(self, ssid: str, token: str):
+        return self.client(ssid).json().get(f'session_{ssid}_{token}')
+
+    def set_session(self, ssid: str, token: str, session: dict, ttl: int = None):
+        ttl = ttl or self.session_ttl
+        from redis.commands.json.path import Path
+        pipe = self.client(ssid).pipeline()
+        pipe.json().set(f'session_{ssid}_{token}', Path.rootPath(), session)
+        pipe.sadd(f'sessions_{ssid}', token)
+        if ttl:
+            pipe.expire(f'session_{ssid}_{token}', ttl)
+            pipe.expire(f'sessions_{ssid}', ttl)
+        pipe.execute()
+
+    def delete_sessions(self, ssid: str):
+        client = self.client(ssid)
+        tokens = client.smembers(f'sessions_{ssid}')
+        client.delete(f'sessions_{ssid}', *(f'session_{ssid}_{token.decode()}' for token in tokens))
+
+    def get_ticket(self, key: str):
+        ticket = self.client(key).get(f'ticket_{key}')
+        return ticket.decode() if ticket is not None else None
+
+    def set_ticket(self, key: str, ticket: str, ttl: int = None):
+        self.client(key).set(f'ticket_{key}', ticket, ex=ttl)
+
+    def delete_ticket(self, key: str):
+        self.client(key).delete(f'ticket_{key}')
+
+    def get_account(self, ssid: str):
+        account = self.client(ssid).get(f'account_{ssid}')
+        return json.loads(account) if account is not None else None
+
+    def set_account(self, ssid: str, account: dict, ttl: int = None):
+        self.client(ssid).set(f'account_{ssid}', json.dumps(account), ex=ttl)
+
+    def invalidate_accounts(self, ssid: str = None):
+        if ssid is not None:
+            pipe = self.client(ssid).pipeline()
+            pipe.delete(f'account_{ssid}')
+            pipe.publish('account_invalidations', ssid)
+            pipe.execute()
+            return
+        for client in self.clients.values():
+            keys = list(client.scan_iter('account_*'))
+            if keys:
+                client.delete(*keys)
+        next(iter(self.clients.values())).publish('account_invalidations', '*')
+
+    def add_invalidation_listener(self, callback):
+        self._listeners.append(callback)
+        if self._subscribers:
+            return
+        # invalidations are published on the node the box lives on, so listen on all of them
+        for client in self.clients.values():
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(account_invalidations=self._invalidated)
+            self._subscribers.append(pubsub.run_in_thread(sleep_time=1, daemon=True))
+
+    def remove_invalidation_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _invalidated(self, message: dict):
+        ssid = message['data'].decode()
+        for callback in list(self._listeners):
+            callback(None if ssid == '*' else ssid)
+
+    def take_token(self, key: str, rate: float, burst: float):
+        name = self.ring.get(key)
+        return bool(self._token[name](keys=(f'ratelimit_{key}',), args=(rate, burst)))
+
+    def touch_connection(self, ssid: str, connection: str):
+        self._run(ssid, self._touch, connection, self.session_ttl or 0)
+
+    def release_connection(self, ssid: str, connection: str):
+        self._run(ssid, self._release, connection)
+
+    def _run(self, ssid: str, scripts: dict, *args):
+        name = self.ring.get(ssid)
+        keys = (f'connections_{ssid}', f'sessions_{ssid}')
+        args = args[:1] + (f'session_{ssid}_',) + args[1:]
+        if self.write_behind and not self._closed.is_set():
+            with self._pending_lock:
+                self._pending.append((name, scripts[name], keys, args))
+        else:
+            scripts[name](keys=keys, args=args)
+
+    def flush(self):
+        """
+        Sends the queued writes, one pipeline per node.
+        """
+        import redis
+        with self._pending_lock:
+            pending, self._pending = self._pending, list()
+        if not pending:
+            return
+        pipes = dict()
+        for name, script, keys, args in pending:
+            if name not in pipes:
+                pipes[name] = self.clients[name].pipeline(transaction=False)
+            script(keys=keys, args=args, client=pipes[name])
+        for name, pipe in pipes.items():
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning('Write-behind flush to redis node %s failed: %s', name, e)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.write_behind):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+        for subscriber in self._subscribers:
+            subscriber.stop()
+        self._subscribers = list()
+
+    @staticmethod
+    def shard_key(key: str):
+        """
+        Returns the SSID or ticket key a Redis key is placed by, or None if it isn't one of ours.
+        """
+        kind, _, rest = key.partition('_')
+        if kind in ('connections', 'sessions', 'ticket', 'account'):
+            return rest or None
+        elif kind == 'session':
+            return rest.rpartition('_')[0] or None
+        return None
+
+    @staticmethod
+    def node_address(client):
+        kwargs = client.connection_pool.connection_kwargs
+        return kwargs.get('host'), kwargs.get('port'), kwargs.get('db'), kwargs.get('path')
+
+    def rebalance(self, previous: dict = None):
+        """
+        Moves keys that are on the wrong node after a membership change, keeping their TTLs.
+        previous maps the replaced store's node names to clients, so nodes that were removed from the ring (or given
+        a new address) are emptied too. Returns the number of keys moved.
+        """
+        nodes = dict()  # address: client, so a node that is in both stores is only scanned once
+        for client in list(self.clients.values()) + list((previous or dict()).values()):
+            nodes.setdefault(self.node_address(client), client)
+        moved = 0
+        for address, client in nodes.items():
+            for pattern in ('connections_*', 'session*_*', 'ticket_*', 'account_*'):
+                for key in client.scan_iter(pattern):
+                    shard = self.shard_key(key.decode())
+                    if shard is None or self.node_address(self.client(shard)) == address:
+                        continue
+                    dump = client.dump(key)
+                    if dump is None:
+                        continue
+                    ttl = max(client.pttl(key), 0)
+                    self.client(shard).restore(key, ttl, dump, replace=True)
+                    client.delete(key)
+                    moved += 1
+        return moved
+
+
+class MemoryStore(StateStore):
+    """
+    State kept in this process, for single-node deployments and benchmarking.
+
+    If path is set, the state is loaded from it at startup and written back through a memory-mapped file every
+    persist_interval seconds when it has changed, so it survives restarts.
+    """
+
+    def __init__(self, path: str = None, persist_interval: float = 5):
+        self.path = path
+        self._lock = threading.RLock()
+        self._connections = dict()
+        self._sessions = dict()
+        self._tickets = dict()
+        self._accounts = dict()
+        self._listeners = list()
+        self._buckets = dict()
+        self._dirty = False
+        self._closed = threading.Event()
+        self._persister = None
+        if path:
+            self.load()
+            if persist_interval:
+                self._persister = threading.Thread(target=self._persist_loop, args=(persist_interval,),
+                                                   name='state-persist', daemon=True)
+                self._persister.start()
+
+    def add_connection(self, ssid: str, connection: str):
+        with self._lock:
+            self._connections.setdefault(ssid, set()).add(connection)
+            self._dirty = True
+
+    def remove_connection(self, ssid: str, connection: str):
+        with self._lock:
+            connections = self._connections.get(ssid, set())
+            connections.discard(connection)
+            if not connections:
+                self._connections.pop(ssid, None)
+            self._dirty = True
+            return len(connections)
+
+    def connections(self, ssid: str):
+        with self._lock:
+            return sorted(self._connections.get(ssid, set()))
+
+    def reset_connections(self):
+        with self._lock:
+            self._connections.clear()
+            self._dirty = True
+
+    def get_session(self, ssid: str, token: str):
+        return self._get(self._sessions, (ssid, token))
+
+    def set_session(self, ssid: str, token: str, session: dict, ttl: int = None):
+        self._set(self._sessions, (ssid, token), session, ttl)
+
+    def delete_sessions(self, ssid: str):
+        with self._lock:
+            for key in [key for key in self._sessions if key[0] == ssid]:
+                del self._sessions[key]
+            self._dirty = True
+
+    def get_ticket(self, key: str):
+        return self._get(self._tickets, key)
+
+    def set_ticket(self, key: str, ticket: str, ttl: int = None):
+        self._set(self._tickets, key, ticket, ttl)
+
+    def delete_ticket(self, key: str):
+        with self._lock:
+            self._tickets.pop(key, None)
+            self._dirty = True
+
+    def get_account(self, ssid: str):
+        return self._get(self._accounts, ssid)
+
+    def set_account(self, ssid: str, account: dict, ttl: int = None):
+        with self._lock:
+            self._accounts[ssid] = (account, time.time() + ttl if ttl else None)
+
+    def invalidate_accounts(self, ssid: str = None):
+        with self._lock:
+            if ssid is None:
+                self._accounts.clear()
+            else:
+                self._accounts.pop(ssid, None)
+        for callback in list(self._listeners):
+            callback(ssid)
+
+    def add_invalidation_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_invalidation_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def take_token(self, key: str, rate: float, burst: float):
+        # a single node's "shared" tier; normally the local buckets already cover this
+        with self._lock:
+            buckets = self._buckets.get((rate, burst))
+            if buckets is None:
+                buckets = self._buckets[(rate, burst)] = TokenBuckets(rate, burst)
+        return buckets.take(key)
+
+    def _get(self, table: dict, key):
+        with self._lock:
+            entry = table.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                del table[key]
+                return None
+            return value
+
+    def _set(self, table: dict, key, value, ttl: int = None):
+        with self._lock:
+            table[key] = (value, time.time() + ttl if ttl else None)
+            self._dirty = True
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            return {
+                'connections': {ssid: sorted(conns) for ssid, conns in self._connections.items()},
+                'sessions': [[ssid, token, value, expires] for (ssid, token), (value, expires) in
+                             self._sessions.items() if expires is None or expires > now],
+                'tickets': [[key, value, expires] for key, (value, expires) in self._tickets.items()
+                            if expires is None or expires > now]
+            }
+
+    def load(self):
+        """
+        Loads the persisted state, if there is any.
+        """
+        try:
+            with open(self.path, 'rb') as fh:
+                if os.fstat(fh.fileno()).st_size == 0:
+                    return
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    data = json.loads(mm[:].rstrip(b'\x00'))
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._connections = {ssid: set(conns) for ssid, conns in data['connections'].items()}
+            self._sessions = {(ssid, token): (value, expires) for ssid, token, value, expires in data['sessions']}
+            self._tickets = {key: (value, expires) for key, value, expires in data['tickets']}
+
+    def persist(self):
+        """
+        Writes the state to the backing file.
+        """
+        with self._lock:
+            data = json.dumps(self.snapshot()).encode()
+            self._dirty = False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w+b') as fh:
+            fh.truncate(len(data))
+            with mmap.mmap(fh.fileno(), len(data)) as mm:
+                mm[:] = data
+                mm.flush()
+        os.replace(tmp, self.path)
+
+    def _persist_loop(self, interval: float):
+        while not self._closed.wait(interval):
+            if not self._dirty:
+                continue
+            try:
+                self.persist()
+            except (OSError, ValueError) as e:
+                logger.warning('Could not persist state to %s: %s', self.path, e)
+
+    def close(self):
+        """
+        Stops the persist thread and writes out any changes it hasn't.
+        """
+        self._closed.set()
+        if self._persister is not None:
+            self._persister.join()
+            self._persister = None
+        if self.path and self._dirty:
+            try:
+                self.persist()
+            except (OSError, ValueError) as e:
+                logger.warning('Could not persist state to %s: %s', self.path, e)
+
+
+def redis_nodes(config: dict):
+    """
+    Returns the Redis nodes in config.json as (name, settings) pairs.
+
+    "db.redis" is either one node or a list of them. A node's name defaults to host:port/db, and is what keys are
+    hashed against, so give nodes explicit names if their addresses might change.
+    """
+    nodes = config['db']['redis']
+    if isinstance(nodes, dict):
+        nodes = [nodes]
+    return [(node.get('name', f"{node['host']}:{node['port']}/{node['db']}"), node) for node in nodes]
+
+
+def create_store(config: dict, redis_clients: dict = None):
+    """
+    Creates the state store described by the "state" section of config.json.
+    Defaults to Redis, with redis_clients mapping node names to clients.
+    """
+    settings = config.get('state', dict())
+    backend = settings.get('backend', 'redis')
+    if backend == 'redis':
+        weights = {name: node.get('weight', 1) for name, node in redis_nodes(config)}
+        return RedisStore(redis_clients, weights, session_ttl=settings.get('session_ttl'),
+                          write_behind=settings.get('write_behind', 0.005))
+    elif backend == 'memory':
+        return MemoryStore(path=settings.get('path'), persist_interval=settings.get('persist_interval', 5))
+    raise ValueError(f'Unknown state backend "{backend}".')
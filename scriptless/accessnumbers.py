@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import os
+import re
+import sys
+
+"""
+Dial-in access number index for building wtv-1800's regional tellyscripts.
+
+The index maps dialing prefixes (area code, or area code + exchange) to a POP region and its access numbers. It is
+kept as a plain dictionary, and lookups try the caller's number from the longest prefix length down, so a lookup is
+a handful of dictionary probes however many prefixes are loaded.
+
+Regions should be ISO 3166-2 subdivision codes (e.g. US-WA), since that is how wtv-1800 picks a box's script from
+static/regions/. Rebuild the index from a CSV of prefix,region,number[,number...] rows, then list the numbers each
+region's script has to dial, with:
+    python3 accessnumbers.py import numbers.csv
+    python3 accessnumbers.py regions
+"""
+
+default_index = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'accessnumbers.tsv')
+
+
+def normalize_number(number: str):
+    """
+    Strips a phone number down to its digits, dropping the NANP country code.
+    """
+    digits = re.sub(r'\D', '', number or '')
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    return digits
+
+
+class AccessNumberIndex:
+    """
+    Prefix -> (region, access numbers) index.
+    """
+
+    def __init__(self, path: str = default_index):
+        self.path = path
+        self.prefixes = dict()
+        self.lengths = tuple()
+        self.mtime = None
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        prefixes = dict()
+        with open(self.path, 'r') as fh:
+            for line in fh:
+                prefix, region, numbers = line.rstrip('\n').split('\t', 2)
+                prefixes[prefix] = (region, tuple(numbers.split(',')))
+        self.prefixes = prefixes
+        self.lengths = tuple(sorted({len(prefix) for prefix in prefixes}, reverse=True))
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    def changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except OSError:
+            return False
+
+    def lookup(self, number: str):
+        """
+        Returns (region, access numbers) for a caller's number, or None if no prefix matches.
+        """
+        digits = normalize_number(number)
+        for length in self.lengths:
+            if length <= len(digits):
+                match = self.prefixes.get(digits[:length])
+                if match:
+                    return match
+        return None
+
+    def regions(self):
+        """
+        Returns {region: access numbers}, merging the numbers of every prefix in a region.
+        """
+        regions = dict()
+        for region, numbers in self.prefixes.values():
+            merged = regions.setdefault(region, list())
+            merged.extend(number for number in numbers if number not in merged)
+        return regions
+
+    def __len__(self):
+        return len(self.prefixes)
+
+
+def import_csv(source: str, destination: str):
+    """
+    Validates a prefix,region,number[,number...] CSV and writes it out as a sorted index file.
+    """
+    prefixes = dict()
+    with open(source, 'r', newline='') as fh:
+        for lineno, row in enumerate(csv.reader(fh), 1):
+            if not row or row[0].startswith('#'):
+                continue
+            if len(row) < 3:
+                raise ValueError(f'{source}:{lineno}: expected prefix,region,number[,number...]')
+            prefix = normalize_number(row[0])
+            region = row[1].strip()
+            numbers = [normalize_number(number) for number in row[2:] if normalize_number(number)]
+            if not prefix or not region or not numbers or '\t' in region:
+                raise ValueError(f'{source}:{lineno}: invalid row')
+            prefixes[prefix] = (region, numbers)
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    tmp = destination + '.tmp'
+    with open(tmp, 'w') as fh:
+        for prefix in sorted(prefixes):
+            region, numbers = prefixes[prefix]
+            fh.write(f'{prefix}\t{region}\t{",".join(numbers)}\n')
+    os.replace(tmp, destination)
+    return len(prefixes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 accessnumbers.py')
+    subparsers = parser.add_subparsers(dest='command')
+    importer = subparsers.add_parser('import', help='Rebuild the access number index from a CSV file.')
+    importer.add_argument('source', help='CSV of prefix,region,number[,number...] rows.')
+    importer.add_argument('--output', '-o', default=default_index, help='Index file to write.')
+    lookup = subparsers.add_parser('lookup', help='Look up the access numbers for a phone number.')
+    lookup.add_argument('number')
+    lookup.add_argument('--index', '-i', default=default_index, help='Index file to read.')
+    regions = subparsers.add_parser('regions', help='List the access numbers of every region.')
+    regions.add_argument('--index', '-i', default=default_index, help='Index file to read.')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        try:
+            count = import_csv(args.source, args.output)
+        except (OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        print(f'Wrote {count} prefixes to {args.output}.')
+    elif args.command == 'lookup':
+        print(AccessNumberIndex(args.index).lookup(args.number))
+    elif args.command == 'regions':
+        for region, numbers in sorted(AccessNumberIndex(args.index).regions().items()):
+            print(f'{region}\t{",".join(numbers)}')
+    else:
+        parser.print_help()
+        sys.exit(1)
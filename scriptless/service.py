@@ -1,7 +1,11 @@
+import logging
 import os
+import threading
+import time
 from pywebtv.decorators import WTVPResponse
-from pywebtv.functions import return_service, returnLocalTime
+from pywebtv.functions import return_service, returnLocalTime, returnRegion
 from pywebtv.security import WTVNetworkSecurity
+from types import MappingProxyType
 
 """
 wtv-1800 (scriptlessd) sets a client up for dialing into the service.
@@ -9,6 +13,135 @@ wtv-1800 (scriptlessd) sets a client up for dialing into the service.
 It will check if the box is authorized to connect, determine local numbers, and configure service routes.
 """
 
+# (client class, open ISP): tellyscript file
+tellyscript_files = {
+    ('classic', False): 'classic.tok',
+    ('classic', True): 'classic_openisp.tok',
+    ('fiji', False): 'fiji.tok',  # TODO: OpenISP for Dreamcast clients
+    ('mstv', False): 'mstv.tok',
+    ('plus', False): 'plus.tok',
+    ('plus', True): 'plus_openisp.tok'
+}
+
+
+class TellyscriptTable:
+    """
+    Every tellyscript, read once into an immutable table.
+
+    Regional variants can be placed in static/regions/<region>/ under the same file names; a region without its own
+    variant gets the national script. Rendered scripts are cached per (region, client class, open ISP), and reload()
+    swaps in a new table and an empty cache with single assignments, so serving a tellyscript never touches the
+    filesystem.
+    """
+
+    def __init__(self, directory: str, files: dict):
+        self.directory = directory
+        self.regions_directory = os.path.join(directory, 'regions')
+        self.files = files
+        self.table = MappingProxyType(dict())
+        self._rendered = dict()
+        self._mtimes = dict()
+        self.reload()
+
+    def reload(self):
+        """
+        Reads every tellyscript from disk and swaps in the new table.
+        """
+        table = dict()
+        mtimes = dict()
+        regions = [None]
+        if os.path.isdir(self.regions_directory):
+            mtimes[self.regions_directory] = os.stat(self.regions_directory).st_mtime_ns
+            regions += sorted(os.listdir(self.regions_directory))
+        for region in regions:
+            directory = self.directory if region is None else os.path.join(self.regions_directory, region)
+            if region is not None:
+                mtimes[directory] = os.stat(directory).st_mtime_ns
+            for key, name in self.files.items():
+                path = os.path.join(directory, name)
+                if region is not None and not os.path.exists(path):
+                    continue
+                with open(path, 'rb') as fh:
+                    table[(region,) + key] = fh.read()
+                mtimes[path] = os.stat(path).st_mtime_ns
+        self.table = MappingProxyType(table)
+        self._rendered = dict()
+        self._mtimes = mtimes
+
+    def changed(self):
+        for path, mtime in self._mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def get(self, client_class: str, openisp: bool, region: str = None):
+        key = (region, client_class, openisp)
+        rendered = self._rendered
+        data = rendered.get(key)
+        if data is None:
+            data = rendered[key] = self.render(region, client_class, openisp)
+        return data
+
+    def render(self, region: str, client_class: str, openisp: bool):
+        """
+        Picks the most specific script for a region, falling back to the national one and to the non-open-ISP one.
+        """
+        for key in ((region, client_class, openisp), (None, client_class, openisp),
+                    (region, client_class, False), (None, client_class, False)):
+            if key in self.table:
+                return self.table[key]
+        raise KeyError((region, client_class, openisp))
+
+
+tellyscripts = TellyscriptTable(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'),
+                                tellyscript_files)
+
+
+def _watch(poll_interval: float = 5):
+    """
+    Reloads the tellyscripts when they change on disk.
+    """
+    while True:
+        time.sleep(poll_interval)
+        if not tellyscripts.changed():
+            continue
+        try:
+            tellyscripts.reload()
+            logging.info('Reloaded tellyscripts.')
+        except (OSError, ValueError) as e:
+            logging.warning('Could not reload tellyscripts, keeping the loaded ones: %s', e)
+
+
+threading.Thread(target=_watch, name='scriptless-watcher', daemon=True).start()
+
+
+def _client_class(box):
+    """
+    Returns which tellyscript family a box uses.
+    """
+    if box.client == 3:
+        return 'fiji'
+    elif box.client == 2:
+        return 'mstv'
+    elif box.systeminfo.get('romtype') == 'bf0app':
+        return 'classic'
+    return 'plus'
+
+
+def _region(request):
+    """
+    Picks the region whose tellyscript a box gets: the subdivision of its address (e.g. US-WA), or None for the
+    national script.
+
+    Boxes don't send their phone number, and the .tok files are tokenized and compressed with no tokenizer in this
+    tree, so scripts aren't generated here. Each region's script is built offline with the numbers that
+    accessnumbers.py lists for it, and placed in static/regions/<region>/.
+    """
+    return returnRegion(request.router.client_address[0])
+
 
 def preregister(request):
     """
@@ -44,25 +177,6 @@ def finish_scriptless(request):
         'wtv-ticket': dump
     }
     headers.update(returnLocalTime(request.router.client_address[0]))
-    if request.router.box.systeminfo['romtype'] == 'bf0app':
-        if request.params['oisp'] == 'true':
-            data = open(os.path.join(request.service_dir,
-                                     'static', 'classic_openisp.tok'), 'rb')
-        else:
-            data = open(os.path.join(request.service_dir,
-                                     'static', 'classic.tok'), 'rb')
-    elif request.router.box.client == 3:
-        data = open(os.path.join(request.service_dir,
-                                 'static', 'fiji.tok'), 'rb')
-        # TODO: OpenISP for Dreamcast clients
-    elif request.router.box.client == 2:
-        data = open(os.path.join(request.service_dir,
-                                 'static', 'mstv.tok'), 'rb')
-    else:
-        if request.params['oisp'] == 'true':
-            data = open(os.path.join(request.service_dir,
-                                     'static', 'plus_openisp.tok'), 'rb')
-        else:
-            data = open(os.path.join(request.service_dir,
-                                     'static', 'plus.tok'), 'rb')
-    return WTVPResponse(content_type='text/tellyscript', data=data.read(), headers=headers)
+    data = tellyscripts.get(_client_class(request.router.box), request.params.get('oisp') == 'true',
+                            _region(request))
+    return WTVPResponse(content_type='text/tellyscript', data=data, headers=headers)
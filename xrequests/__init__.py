@@ -1,4 +1,9 @@
 from .sessions import Session
+from .pool import ConnectionPool
+from .cache import HTTPCache
+from .resolver import Resolver
+from .tls import TLSSessionCache
+from .async_sessions import AsyncSession
 from .api import get, options, head, post, put, patch, delete
 from . import exceptions
 
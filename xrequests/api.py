@@ -1,9 +1,21 @@
 from . import sessions
+from .pool import ConnectionPool
+
+default_pool = ConnectionPool()
+_default_session = None
+
+
+def default_session():
+    """The shared ``Session`` behind the module-level functions, created on
+    first use so importing xrequests doesn't build SSL contexts."""
+    global _default_session
+    if _default_session is None:
+        _default_session = sessions.Session(pool=default_pool)
+    return _default_session
 
 
 def request(method, url, **kwargs):
-    with sessions.Session() as session:
-        return session.request(method=method, url=url, **kwargs)
+    return default_session().request(method=method, url=url, **kwargs)
 
 
 def get(url, **kwargs):
@@ -0,0 +1,228 @@
+from .exceptions import *
+from .models import Response
+from .reader import ContentDecoder
+from .sessions import Session
+import asyncio
+
+
+class AsyncSession(Session):
+    """asyncio counterpart of ``Session``.
+
+    Requests are built and parsed the same way as ``Session`` and return the
+    same ``Response`` objects. At most ``max_per_host`` requests run at once
+    per (scheme, host, port); idle keep-alive connections are reused.
+
+    Without a proxy, connections are opened with ``asyncio.open_connection``.
+    With a proxy, the PySocks handshake runs in the default executor and the
+    connected socket is handed to asyncio afterwards.
+    """
+
+    def __init__(self, max_per_host=None, **kwargs):
+        super().__init__(**kwargs)
+        self.max_per_host = max_per_host if max_per_host is not None else 8
+        self._limits = {}
+        self._idle = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.aclose()
+
+    async def request(self, method, url, headers=None, content=None,
+                      timeout=None, version=None, ssl_verify=None):
+        scheme, host_addr, request = self._build_request(
+            method, url, headers, content, version)
+
+        if ssl_verify is None:
+            ssl_verify = self.ssl_verify
+
+        key = (scheme,) + host_addr + (bool(ssl_verify),)
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(self.max_per_host)
+
+        async with limit:
+            try:
+                return await asyncio.wait_for(
+                    self._request(method, key, host_addr, request, ssl_verify),
+                    timeout or self.timeout)
+            except asyncio.TimeoutError as err:
+                raise RequestException(err)
+
+    async def _request(self, method, key, host_addr, request, ssl_verify):
+        while True:
+            idle = self._idle.get(key)
+            conn_reused = bool(idle)
+            if conn_reused:
+                reader, writer = idle.pop()
+            else:
+                try:
+                    reader, writer = await self._open_connection(
+                        host_addr, ssl_wrap=("https" == key[0]),
+                        ssl_verify=ssl_verify)
+                except RequestException:
+                    raise
+                except Exception as err:
+                    raise RequestException(err)
+
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, message, headers, data = await self._read_response(
+                    reader, method)
+            except asyncio.CancelledError:
+                writer.close()
+                raise
+            except Exception as err:
+                writer.close()
+                if not conn_reused:
+                    if not isinstance(err, RequestException):
+                        err = RequestException(err)
+                    raise err
+                continue
+
+            if self._is_reusable(headers):
+                self._idle.setdefault(key, []).append((reader, writer))
+            else:
+                writer.close()
+            return Response(status, message, headers, data)
+
+    async def _open_connection(self, dest_addr, ssl_wrap, ssl_verify):
+        context = None
+        if ssl_wrap:
+            context = self._verified_context \
+                if ssl_verify else self._unverified_context
+
+        loop = asyncio.get_running_loop()
+        if self._proxy is None:
+            addrs = await loop.run_in_executor(
+                None, self._resolver.resolve, *dest_addr)
+            return await asyncio.open_connection(
+                addrs[0][1][0], dest_addr[1], ssl=context,
+                server_hostname=dest_addr[0] if ssl_wrap else None,
+                limit=self.max_chunk_size)
+
+        sock = await loop.run_in_executor(
+            None, lambda: self._create_socket(
+                dest_addr, timeout=self.timeout, ssl_wrap=False))
+        sock.setblocking(False)
+        return await asyncio.open_connection(
+            sock=sock, ssl=context,
+            server_hostname=dest_addr[0] if ssl_wrap else None,
+            limit=self.max_chunk_size)
+
+    async def _read_response(self, reader, method):
+        try:
+            while True:
+                status, message, headers = self._parse_head(
+                    await reader.readuntil(b"\r\n\r\n"))
+                if not 100 <= status < 200 or status == 101:
+                    break
+        except asyncio.IncompleteReadError as err:
+            if not err.partial:
+                raise EmptyResponse("Empty response from server")
+            raise RequestException("Connection closed mid-response")
+
+        chunks = []
+        decoder = None
+        if "content-encoding" in headers and self.decode_content:
+            decoder = ContentDecoder(headers["content-encoding"])
+
+        async for chunk in self._iter_body(reader, method, status, headers):
+            chunks.append(decoder.decompress(chunk) if decoder else chunk)
+        if decoder:
+            chunks.append(decoder.flush())
+
+        return status, message, headers, b"".join(chunks)
+
+    async def _iter_body(self, reader, method, status, headers):
+        if method == "HEAD" or status in (204, 304):
+            return
+
+        try:
+            if "transfer-encoding" in headers \
+                    and "chunked" in headers["transfer-encoding"].lower():
+                while True:
+                    line = await reader.readuntil(b"\r\n")
+                    length = int(line.split(b";", 1)[0].strip(), 16)
+                    if length == 0:
+                        while await reader.readuntil(b"\r\n") != b"\r\n":
+                            pass
+                        return
+                    yield await reader.readexactly(length)
+                    if await reader.readexactly(2) != b"\r\n":
+                        raise RequestException("Malformed chunked encoding")
+
+            elif "content-length" in headers:
+                remaining = int(headers["content-length"])
+                while remaining > 0:
+                    chunk = await reader.read(
+                        min(remaining, self.max_chunk_size))
+                    if len(chunk) == 0:
+                        raise RequestException("Empty chunk")
+                    remaining -= len(chunk)
+                    yield chunk
+
+            else:
+                while True:
+                    chunk = await reader.read(self.max_chunk_size)
+                    if len(chunk) == 0:
+                        return
+                    yield chunk
+        except asyncio.IncompleteReadError:
+            raise RequestException("Empty chunk")
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def options(self, url, **kwargs):
+        return await self.request("OPTIONS", url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        return await self.request("HEAD", url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request("PUT", url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    async def aclose(self):
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+
+async def gather(urls, method="GET", session=None, return_exceptions=True,
+                 **kwargs):
+    """Fetches ``urls`` concurrently and returns the responses in order.
+
+    Failed fetches are returned as exceptions unless ``return_exceptions`` is
+    false. ``kwargs`` go to ``AsyncSession.request``.
+    """
+    if session is None:
+        async with AsyncSession() as session:
+            return await gather(urls, method, session, return_exceptions,
+                                **kwargs)
+
+    return await asyncio.gather(
+        *(session.request(method, url, **kwargs) for url in urls),
+        return_exceptions=return_exceptions)
+
+
+def fetch_all(urls, method="GET", return_exceptions=True, **kwargs):
+    """Blocking wrapper around ``gather`` for use from request threads."""
+    return asyncio.run(gather(
+        urls, method, return_exceptions=return_exceptions, **kwargs))
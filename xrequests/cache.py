@@ -0,0 +1,330 @@
+from .structures import CaseInsensitiveDict
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+import hashlib
+import json as jsonlib
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+cacheable_methods = ("GET", "HEAD")
+cacheable_statuses = (200, 203, 300, 301, 308, 404, 410)
+# requests carrying these get a response meant for one caller only
+credential_headers = ("authorization", "cookie", "proxy-authorization")
+
+
+class CacheEntry:
+    def __init__(self, status, message, headers, content, stored_at,
+                 expires_at):
+        self.status = status
+        self.message = message
+        self.headers = headers
+        self.content = content
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires_at
+
+    @property
+    def validators(self):
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+
+class HTTPCache:
+    """Opt-in response cache for ``Session``.
+
+    Fresh entries (per ``Cache-Control``/``Expires``) are served without a
+    request. Stale entries with an ``ETag`` or ``Last-Modified`` are
+    revalidated with a conditional request, and a ``304`` refreshes them.
+
+    Entries live in a bounded in-memory LRU tier and, if ``directory`` is set,
+    in one file per entry under it, also bounded and evicted least recently
+    used first. Bodies are stored as returned by the session (decoded unless
+    ``decode_content`` is off) and are zlib-compressed on disk when
+    ``compress`` is true.
+
+    Requests with credentials (``Authorization``, ``Cookie``) are never
+    cached, and entries are keyed by the request's ``Accept-Encoding``, the
+    only ``Vary`` header a response may have and still be stored.
+    """
+
+    def __init__(self, directory=None, max_memory_entries=None,
+                 max_memory_bytes=None, compress=None,
+                 heuristic_fraction=None, max_disk_entries=None,
+                 max_disk_bytes=None):
+        self.directory = directory
+        self.max_memory_entries = max_memory_entries \
+            if max_memory_entries is not None else 256
+        self.max_memory_bytes = max_memory_bytes \
+            if max_memory_bytes is not None else (32 * 1024 ** 2)
+        self.compress = compress if compress is not None else False
+        self.heuristic_fraction = heuristic_fraction \
+            if heuristic_fraction is not None else 0.1
+        self.max_disk_entries = max_disk_entries \
+            if max_disk_entries is not None else 4096
+        self.max_disk_bytes = max_disk_bytes \
+            if max_disk_bytes is not None else (256 * 1024 ** 2)
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+
+    def key(self, method, url, headers=None):
+        """Returns the cache key for a request, or ``None`` if it mustn't
+        be cached."""
+        headers = headers or {}
+        if any(name.lower() in credential_headers for name in headers):
+            return None
+        key = "%s %s" % ("GET" if method == "HEAD" else method, url)
+        for name, value in headers.items():
+            if name.lower() == "accept-encoding":
+                key += "\naccept-encoding: %s" % value
+        return key
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+
+        entry = self._read(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def store(self, key, response, request_time):
+        """Stores ``response`` if its headers allow it."""
+        if response.status not in cacheable_statuses:
+            return None
+
+        directives = parse_cache_control(response.headers.get("cache-control"))
+        if "no-store" in directives or "private" in directives:
+            return None
+
+        vary = [v.strip().lower()
+                for v in response.headers.get("vary", "").split(",")
+                if v.strip()]
+        if any(v != "accept-encoding" for v in vary):
+            return None
+
+        lifetime = self.freshness_lifetime(response.headers, directives,
+                                           request_time)
+        entry = CacheEntry(response.status, response.message,
+                           response.headers, response.content,
+                           stored_at=request_time,
+                           expires_at=request_time + lifetime)
+        if lifetime <= 0 and not entry.validators:
+            return None
+
+        self._remember(key, entry)
+        self._write(key, entry)
+        with self._lock:
+            self.stores += 1
+        return entry
+
+    def refresh(self, key, entry, not_modified, request_time):
+        """Updates a stale entry from a ``304`` response."""
+        for header, value in not_modified.headers.items():
+            if header.lower() not in ("content-length", "content-encoding",
+                                      "transfer-encoding"):
+                entry.headers[header] = value
+        directives = parse_cache_control(entry.headers.get("cache-control"))
+        entry.stored_at = request_time
+        entry.expires_at = request_time + self.freshness_lifetime(
+            entry.headers, directives, request_time)
+        self._remember(key, entry)
+        self._write(key, entry)
+        return entry
+
+    def freshness_lifetime(self, headers, directives, request_time):
+        if "no-cache" in directives:
+            return 0
+        for directive in ("s-maxage", "max-age"):
+            if directive in directives:
+                try:
+                    return max(0, int(directives[directive]))
+                except ValueError:
+                    return 0
+
+        date = parse_http_date(headers.get("date")) or request_time
+        if "expires" in headers:
+            expires = parse_http_date(headers["expires"])
+            return max(0, expires - date) if expires else 0
+        if "last-modified" in headers:
+            modified = parse_http_date(headers["last-modified"])
+            if modified:
+                return max(0, (date - modified) * self.heuristic_fraction)
+        return 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.revalidated
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "stores": self.stores,
+                "hit_ratio": (self.hits + self.revalidated) / lookups
+                if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes
+            }
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._disk.clear()
+            self._disk_bytes = 0
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".cache"):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _remember(self, key, entry):
+        size = len(entry.content)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old.content)
+            self._memory[key] = entry
+            self._memory_bytes += size
+            while len(self._memory) > self.max_memory_entries \
+                    or self._memory_bytes > self.max_memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old.content)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".cache")
+
+    def _write(self, key, entry):
+        if self.directory is None:
+            return
+        content = zlib.compress(entry.content) if self.compress \
+            else entry.content
+        meta = jsonlib.dumps({
+            "key": key,
+            "status": entry.status,
+            "message": entry.message,
+            "headers": list(entry.headers.items()),
+            "stored_at": entry.stored_at,
+            "expires_at": entry.expires_at,
+            "compressed": self.compress
+        }).encode("utf-8")
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(struct.pack(">I", len(meta)))
+                fh.write(meta)
+                fh.write(content)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._track(self._path(key), 4 + len(meta) + len(content))
+
+    def _scan(self):
+        """Indexes the entries already in ``directory``, oldest first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".cache"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._track(path, size)
+
+    def _track(self, path, size):
+        """Records a written entry and evicts the least recently used ones
+        until the disk tier is within its bounds."""
+        evicted = []
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(path, 0)
+            self._disk[path] = size
+            while len(self._disk) > self.max_disk_entries \
+                    or self._disk_bytes > self.max_disk_bytes:
+                old, old_size = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as fh:
+                length, = struct.unpack(">I", fh.read(4))
+                meta = jsonlib.loads(fh.read(length))
+                content = fh.read()
+        except (OSError, ValueError, struct.error):
+            return None
+        if meta["key"] != key:
+            return None
+        with self._lock:
+            if self._path(key) in self._disk:
+                self._disk.move_to_end(self._path(key))
+        if meta["compressed"]:
+            content = zlib.decompress(content)
+        return CacheEntry(meta["status"], meta["message"],
+                          CaseInsensitiveDict(meta["headers"]), content,
+                          meta["stored_at"], meta["expires_at"])
+
+
+def parse_cache_control(value):
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
@@ -12,3 +12,7 @@ class EmptyResponse(RequestException):
 
 class UnsupportedEncoding(RequestException):
     pass
+
+
+class PoolTimeout(RequestException):
+    pass
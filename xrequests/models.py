@@ -2,18 +2,69 @@ import json as jsonlib
 
 
 class Response:
-    def __init__(self, status, message, headers, content):
+    def __init__(self, status, message, headers, content=None, stream=None):
         self.status = status
         self.message = message
         self.headers = headers
-        self.content = content
+        self._content = content
+        self._stream = stream
+        self._consumed = False
 
     def __repr__(self):
         return "<Response [%d]>" % (self.status)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
     def json(self):
         return jsonlib.loads(self.content)
 
+    @property
+    def content(self):
+        if self._content is None:
+            if self._consumed:
+                raise RuntimeError("The content of this response was already consumed")
+            self._content = b"".join(self.iter_content())
+        return self._content
+
     @property
     def text(self):
         return self.content.decode("UTF-8", errors="ignore")
+
+    def iter_content(self, chunk_size=None):
+        """Yields the body in pieces of at most ``chunk_size`` bytes.
+
+        For responses made with ``stream=True`` the body is read from the
+        socket as it is iterated and is not kept, so it can only be iterated
+        once.
+        """
+        if self._content is not None:
+            step = chunk_size or len(self._content) or 1
+            for i in range(0, len(self._content), step):
+                yield self._content[i:i + step]
+            return
+
+        if self._stream is None:
+            return
+
+        stream, self._stream = self._stream, None
+        self._consumed = True
+        try:
+            for chunk in stream:
+                if chunk_size is None or len(chunk) <= chunk_size:
+                    yield chunk
+                    continue
+                for i in range(0, len(chunk), chunk_size):
+                    yield chunk[i:i + chunk_size]
+        finally:
+            stream.close()
+
+    def close(self):
+        """Releases the connection of a streamed response, dropping any
+        unread body."""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
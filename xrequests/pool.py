@@ -0,0 +1,133 @@
+from .exceptions import PoolTimeout
+from collections import deque
+import socket
+import threading
+import time
+
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive connections.
+
+    Connections are grouped by key, normally ``(scheme, host, port, proxy_url,
+    ssl_verify)``, so connections made through different proxies or with
+    different verification settings are never mixed.
+
+    ``max_idle`` is the number of idle connections kept per key,
+    ``max_per_host`` caps idle plus checked out connections per key, and idle
+    connections older than ``idle_timeout`` seconds are closed instead of
+    reused. ``checkout`` blocks for up to ``pool_timeout`` seconds when a key
+    is at its limit.
+    """
+
+    def __init__(self, max_idle=None, max_per_host=None, idle_timeout=None,
+                 pool_timeout=None):
+        self.max_idle = max_idle if max_idle is not None else 4
+        self.max_per_host = max_per_host if max_per_host is not None else 10
+        self.idle_timeout = idle_timeout if idle_timeout is not None else 60
+        self.pool_timeout = pool_timeout if pool_timeout is not None else 30
+        self._idle = {}
+        self._in_use = {}
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.clear()
+
+    def checkout(self, key, factory):
+        """Returns ``(conn, reused)`` for ``key``, creating a connection with
+        ``factory()`` if no usable idle one exists."""
+        deadline = time.monotonic() + self.pool_timeout
+        expired = []
+        with self._cond:
+            while True:
+                idle = self._idle.get(key)
+                now = time.monotonic()
+                while idle:
+                    conn, last_used = idle.pop()
+                    if now - last_used > self.idle_timeout:
+                        expired.append(conn)
+                        continue
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+                else:
+                    conn = None
+
+                if conn is not None:
+                    reused = True
+                    break
+
+                if self._in_use.get(key, 0) < self.max_per_host:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    reused = False
+                    break
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "Timed out waiting for a connection to %s:%s" % key[1:3])
+                self._cond.wait(remaining)
+
+        for old in expired:
+            self._close(old)
+
+        if reused:
+            return conn, True
+
+        try:
+            return factory(), False
+        except BaseException:
+            self._release(key)
+            raise
+
+    def checkin(self, key, conn):
+        """Returns a healthy connection to the pool."""
+        with self._cond:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                conn = None
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                self._in_use.pop(key)
+            self._cond.notify()
+
+        if conn is not None:
+            self._close(conn)
+
+    def discard(self, key, conn):
+        """Closes a checked out connection that must not be reused."""
+        self._close(conn)
+        self._release(key)
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn, _ in conns:
+                self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "idle": sum(len(conns) for conns in self._idle.values()),
+                "in_use": sum(self._in_use.values()),
+                "hosts": len(set(self._idle) | set(self._in_use))
+            }
+
+    def _release(self, key):
+        with self._cond:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                self._in_use.pop(key)
+            self._cond.notify()
+
+    def _close(self, conn):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
@@ -0,0 +1,185 @@
+from .exceptions import *
+import brotli
+import zlib
+
+max_head_size = 65536
+
+
+class SocketReader:
+    """Buffered reader over a connected socket.
+
+    Headers are read with ``read_until``, which keeps reading until the
+    delimiter shows up instead of assuming it arrived in the first ``recv``.
+    Consumed bytes are tracked with an offset and only compacted on the next
+    fill, so reading many small pieces out of a large buffer stays linear.
+    """
+
+    def __init__(self, conn, chunk_size):
+        self._conn = conn
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def _fill(self):
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        chunk = self._conn.recv(self._chunk_size)
+        self._buffer += chunk
+        return len(chunk)
+
+    def _take(self, size):
+        data = bytes(self._buffer[self._pos:self._pos + size])
+        self._pos += len(data)
+        if self._pos == len(self._buffer):
+            self._buffer.clear()
+            self._pos = 0
+        return data
+
+    def read_until(self, delimiter, limit=max_head_size):
+        searched = 0
+        while True:
+            index = self._buffer.find(delimiter, self._pos + searched)
+            if index != -1:
+                return self._take(index + len(delimiter) - self._pos)
+            available = len(self._buffer) - self._pos
+            if available > limit:
+                raise RequestException("Response head is too long")
+            searched = max(0, available - len(delimiter) + 1)
+            if not self._fill():
+                if not available:
+                    raise EmptyResponse("Empty response from server")
+                raise RequestException("Connection closed mid-response")
+
+    def read(self, size):
+        """Reads up to ``size`` bytes; returns ``b""`` at end of stream."""
+        if self._pos < len(self._buffer):
+            return self._take(size)
+        return self._conn.recv(min(size, self._chunk_size))
+
+    def read_exact(self, size):
+        while size > 0:
+            chunk = self.read(size)
+            if len(chunk) == 0:
+                raise RequestException("Empty chunk")
+            size -= len(chunk)
+            yield chunk
+
+
+class ReleasingBody:
+    """Body iterator that calls ``release(completed)`` exactly once, when the
+    body is exhausted, fails, or is closed, even if it was never iterated."""
+
+    def __init__(self, body, release):
+        self._body = iter(body)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._release is None:
+            raise StopIteration
+        try:
+            return next(self._body)
+        except StopIteration:
+            self._finish(True)
+            raise
+        except BaseException:
+            self._finish(False)
+            raise
+
+    def close(self):
+        if self._release is not None:
+            if hasattr(self._body, "close"):
+                self._body.close()
+            self._finish(False)
+
+    def _finish(self, completed):
+        release, self._release = self._release, None
+        if release is not None:
+            release(completed)
+
+
+def iter_length(reader, length, chunk_size):
+    remaining = length
+    while remaining > 0:
+        chunk = reader.read(min(remaining, chunk_size))
+        if len(chunk) == 0:
+            raise RequestException("Empty chunk")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def iter_chunked(reader):
+    while True:
+        line = reader.read_until(b"\r\n")
+        length = int(line.split(b";", 1)[0].strip(), 16)
+        if length == 0:
+            # Skip trailers up to the blank line that ends the message.
+            while reader.read_until(b"\r\n") != b"\r\n":
+                pass
+            return
+        yield from reader.read_exact(length)
+        if b"".join(reader.read_exact(2)) != b"\r\n":
+            raise RequestException("Malformed chunked encoding")
+
+
+def iter_until_close(reader, chunk_size):
+    while True:
+        chunk = reader.read(chunk_size)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class ContentDecoder:
+    """Incremental decompressor for a ``Content-Encoding`` value."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding.strip().lower()
+        if self.encoding == "br":
+            self._obj = brotli.Decompressor()
+            self._process = getattr(self._obj, "process", None) \
+                or self._obj.decompress
+        elif self.encoding == "gzip":
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._process = self._obj.decompress
+        elif self.encoding == "deflate":
+            self._obj = None
+            self._process = self._deflate
+        elif self.encoding == "identity":
+            self._obj = None
+            self._process = lambda data: data
+        else:
+            raise UnsupportedEncoding(
+                "Unknown encoding type '%s' while decoding content" % (encoding))
+
+    def _deflate(self, data):
+        # Servers send either zlib-wrapped or raw deflate; pick on first use.
+        if self._obj is None:
+            self._obj = zlib.decompressobj()
+            try:
+                return self._obj.decompress(data)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(data)
+
+    def decompress(self, data):
+        return self._process(data)
+
+    def flush(self):
+        if self.encoding in ("gzip", "deflate") and self._obj is not None:
+            return self._obj.flush()
+        return b""
+
+
+def iter_decoded(body, encoding):
+    decoder = ContentDecoder(encoding)
+    for chunk in body:
+        chunk = decoder.decompress(chunk)
+        if chunk:
+            yield chunk
+    tail = decoder.flush()
+    if tail:
+        yield tail
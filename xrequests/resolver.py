@@ -0,0 +1,77 @@
+import socket
+import threading
+import time
+
+
+class Resolver:
+    """Thread-safe, TTL-bounded cache in front of ``getaddrinfo``.
+
+    ``getaddrinfo`` does not expose record TTLs, so answers are kept for a
+    fixed ``ttl`` and failures for ``negative_ttl``. One resolver is shared by
+    all sessions unless one is passed in explicitly.
+    """
+
+    def __init__(self, ttl=None, negative_ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else 300
+        self.negative_ttl = negative_ttl if negative_ttl is not None else 5
+        self.max_entries = max_entries if max_entries is not None else 4096
+        self.lookups = 0
+        self.hits = 0
+        self.resolve_time = 0.0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Returns a list of ``(family, sockaddr)`` for ``host``."""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                if isinstance(entry[1], Exception):
+                    raise entry[1]
+                return entry[1]
+
+        start = time.monotonic()
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as err:
+            self._store(key, now + self.negative_ttl, err,
+                        time.monotonic() - start)
+            raise
+        addrs = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+        self._store(key, now + self.ttl, addrs, time.monotonic() - start)
+        return addrs
+
+    def forget(self, host, port):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "entries": len(self._entries),
+                "resolve_time": self.resolve_time
+            }
+
+    def _store(self, key, expires, value, elapsed):
+        with self._lock:
+            self.resolve_time += elapsed
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                for k in [k for k, v in self._entries.items() if v[0] <= now]:
+                    del self._entries[k]
+                if len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (expires, value)
+
+
+default_resolver = Resolver()
@@ -1,10 +1,16 @@
 from .exceptions import *
 from .structures import CaseInsensitiveDict
+from .cache import cacheable_methods
 from .models import Response
+from .resolver import default_resolver
+from .tls import default_tls_sessions
+from .reader import ReleasingBody, SocketReader, iter_chunked, iter_decoded, iter_length, \
+    iter_until_close
 from urllib.parse import urlsplit
 import socks
 import socket
 import ssl
+import time
 import brotli
 import gzip
 import zlib
@@ -25,7 +31,8 @@ scheme_to_port = {
 
 class Session:
     def __init__(self, proxy_url=None, timeout=None, chunk_size=None,
-                 decode_content=None, encode_content=None, ssl_verify=None):
+                 decode_content=None, encode_content=None, ssl_verify=None,
+                 pool=None, cache=None, resolver=None, tls_sessions=None):
         timeout = timeout if timeout is not None else 60
         chunk_size = chunk_size if chunk_size is not None else (1024 ** 2)
         decode_content = decode_content if decode_content is not None else True
@@ -40,6 +47,12 @@ class Session:
         self.ssl_verify = ssl_verify
         self._proxy = urlsplit(proxy_url) if proxy_url is not None else None
         self._addr_to_conn = {}
+        self._pool = pool
+        self._cache = cache
+        self._resolver = resolver if resolver is not None \
+            else default_resolver
+        self._tls_sessions = tls_sessions if tls_sessions is not None \
+            else default_tls_sessions
         self._verified_context = ssl.create_default_context()
         self._unverified_context = ssl._create_unverified_context()
 
@@ -52,45 +65,60 @@ class Session:
             self.close(addrs.pop())
 
     def request(self, method, url, headers=None, content=None, timeout=None,
-                version=None, ssl_verify=None):
-        parsed_url = urlsplit(url)
-        scheme = parsed_url.scheme.lower()
-
-        if not scheme in scheme_to_port:
-            raise UnsupportedScheme("'%s' is not a supported scheme" % (
-                scheme))
-
-        host_addr = (
-            parsed_url.hostname.lower(),
-            parsed_url.port or scheme_to_port[scheme]
-        )
+                version=None, ssl_verify=None, stream=False):
+        key = None
+        if self._cache is not None and not stream \
+                and method in cacheable_methods:
+            key = self._cache.key(method, url, headers)
+        if key is None:
+            return self._request(method, url, headers, content, timeout,
+                                 version, ssl_verify, stream)
+
+        cache = self._cache
+        entry = cache.get(key)
+        if entry is not None and entry.fresh:
+            cache.record("hits")
+            return self._cached_response(method, entry)
+
+        headers = CaseInsensitiveDict(headers or {})
+        if entry is not None:
+            for header, value in entry.validators.items():
+                headers.setdefault(header, value)
+
+        request_time = time.time()
+        response = self._request("GET", url, headers, content, timeout,
+                                 version, ssl_verify, False)
+
+        if response.status == 304 and entry is not None:
+            cache.record("revalidated")
+            entry = cache.refresh(key, entry, response, request_time)
+            return self._cached_response(method, entry)
+
+        cache.record("misses")
+        cache.store(key, response, request_time)
+        if method == "HEAD":
+            return Response(response.status, response.message,
+                            response.headers, b"")
+        return response
+
+    def _cached_response(self, method, entry):
+        return Response(entry.status, entry.message, entry.headers.copy(),
+                        b"" if method == "HEAD" else entry.content)
+
+    def _request(self, method, url, headers, content, timeout, version,
+                 ssl_verify, stream):
+        scheme, host_addr, request = self._build_request(
+            method, url, headers, content, version)
 
         if ssl_verify is None:
             ssl_verify = self.ssl_verify
 
-        if version is None:
-            version = "1.1"
-
-        if not isinstance(headers, CaseInsensitiveDict):
-            headers = CaseInsensitiveDict(headers)
-
-        if not "Host" in headers:
-            headers["Host"] = parsed_url.hostname
-
-        if content is not None:
-            if not isinstance(content, bytes):
-                content = content.encode("utf-8")
-            if not "Content-Length" in headers:
-                headers["Content-Length"] = "%d" % len(content)
-
-        request = self._prepare_request(
-            method=method,
-            path=parsed_url.path \
-                 + ("?" + parsed_url.query if parsed_url.query else ""),
-            version=version,
-            headers=headers,
-            content=content
-        )
+        if self._pool is not None:
+            return self._pooled_request(
+                method, scheme, host_addr, request,
+                timeout=timeout or self.timeout,
+                ssl_verify=ssl_verify,
+                stream=stream)
 
         conn_reused = host_addr in self._addr_to_conn
         while True:
@@ -105,7 +133,19 @@ class Session:
                     self._addr_to_conn[host_addr] = conn
 
                 self._send(conn, request)
-                return Response(*self._get_response(conn))
+                status, message, headers, data = self._get_response(
+                    conn, method=method, stream=stream)
+                if stream:
+                    # The socket is busy until the body has been read.
+                    self._addr_to_conn.pop(host_addr)
+                    return Response(status, message, headers,
+                                    stream=self._release_after(
+                                        data, lambda completed, conn=conn,
+                                        headers=headers: self._return_conn(
+                                            host_addr, conn, headers,
+                                            completed)))
+                self._store_tls_session(host_addr, ssl_verify, conn)
+                return Response(status, message, headers, data)
 
             except Exception as err:
                 if host_addr in self._addr_to_conn:
@@ -118,6 +158,62 @@ class Session:
 
                 conn_reused = False
 
+    def _pooled_request(self, method, scheme, host_addr, request, timeout,
+                        ssl_verify, stream):
+        key = (scheme,) + host_addr + (self.proxy_url, bool(ssl_verify))
+        factory = lambda: self._create_socket(
+            host_addr,
+            timeout=timeout,
+            ssl_wrap=("https" == scheme),
+            ssl_verify=ssl_verify)
+
+        while True:
+            conn, conn_reused = self._pool.checkout(key, factory)
+            try:
+                if timeout:
+                    conn.settimeout(timeout)
+                self._send(conn, request)
+                status, message, headers, data = self._get_response(
+                    conn, method=method, stream=stream)
+            except Exception as err:
+                self._pool.discard(key, conn)
+                if not conn_reused:
+                    if not isinstance(err, RequestException):
+                        err = RequestException(err)
+                    raise err
+                continue
+
+            def release(completed, conn=conn, headers=headers):
+                if completed:
+                    self._store_tls_session(host_addr, ssl_verify, conn)
+                if completed and self._is_reusable(headers):
+                    self._pool.checkin(key, conn)
+                else:
+                    self._pool.discard(key, conn)
+
+            if stream:
+                return Response(status, message, headers,
+                                stream=self._release_after(data, release))
+            release(True)
+            return Response(status, message, headers, data)
+
+    def _return_conn(self, host_addr, conn, headers, completed):
+        if completed and self._is_reusable(headers) \
+                and host_addr not in self._addr_to_conn:
+            self._addr_to_conn[host_addr] = conn
+            return
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+    def _is_reusable(self, headers):
+        if headers.get("connection", "").lower() == "close":
+            return False
+        return "content-length" in headers \
+            or headers.get("transfer-encoding") == "chunked"
+
     def get(self, url, **kwargs):
         return self.request("GET", url, **kwargs)
 
@@ -153,12 +249,15 @@ class Session:
 
     def _create_socket(self, dest_addr, timeout=None, ssl_wrap=True,
                        ssl_verify=True):
-        sock = socks.socksocket()
+        if self._proxy is None:
+            sock = self._connect_direct(dest_addr, timeout)
+
+        else:
+            sock = socks.socksocket()
 
-        if timeout:
-            sock.settimeout(timeout)
+            if timeout:
+                sock.settimeout(timeout)
 
-        if self._proxy is not None:
             proxy_type = protocol_to_proxy_type.get(self._proxy.scheme.lower())
 
             if proxy_type is None:
@@ -174,18 +273,80 @@ class Session:
                 rdns=False
             )
 
-        sock.connect(dest_addr)
+            sock.connect(dest_addr)
 
         if ssl_wrap:
             context = self._verified_context \
                 if ssl_verify else self._unverified_context
 
-            sock = context.wrap_socket(
-                sock,
+            sock = self._tls_sessions.wrap(
+                context, sock,
+                key=dest_addr + (bool(ssl_verify),),
                 server_hostname=dest_addr[0])
 
         return sock
 
+    def _connect_direct(self, dest_addr, timeout):
+        last_err = None
+        for family, sockaddr in self._resolver.resolve(*dest_addr):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            if timeout:
+                sock.settimeout(timeout)
+            try:
+                sock.connect(sockaddr)
+                return sock
+            except OSError as err:
+                sock.close()
+                last_err = err
+
+        # Every cached address failed; look the host up again next time.
+        self._resolver.forget(*dest_addr)
+        raise last_err or OSError("No addresses for %s" % dest_addr[0])
+
+    def _store_tls_session(self, host_addr, ssl_verify, conn):
+        # TLS 1.3 tickets arrive after the handshake, so store the session
+        # again once a response has been read.
+        if isinstance(conn, ssl.SSLSocket):
+            self._tls_sessions.store(host_addr + (bool(ssl_verify),), conn)
+
+    def _build_request(self, method, url, headers, content, version):
+        parsed_url = urlsplit(url)
+        scheme = parsed_url.scheme.lower()
+
+        if not scheme in scheme_to_port:
+            raise UnsupportedScheme("'%s' is not a supported scheme" % (
+                scheme))
+
+        host_addr = (
+            parsed_url.hostname.lower(),
+            parsed_url.port or scheme_to_port[scheme]
+        )
+
+        if version is None:
+            version = "1.1"
+
+        if not isinstance(headers, CaseInsensitiveDict):
+            headers = CaseInsensitiveDict(headers)
+
+        if not "Host" in headers:
+            headers["Host"] = parsed_url.hostname
+
+        if content is not None:
+            if not isinstance(content, bytes):
+                content = content.encode("utf-8")
+            if not "Content-Length" in headers:
+                headers["Content-Length"] = "%d" % len(content)
+
+        request = self._prepare_request(
+            method=method,
+            path=parsed_url.path \
+                 + ("?" + parsed_url.query if parsed_url.query else ""),
+            version=version,
+            headers=headers,
+            content=content
+        )
+        return scheme, host_addr, request
+
     def _prepare_request(self, method, path, version, headers, content):
         request = "%s %s HTTP/%s\r\n" % (
             method, path, version)
@@ -208,58 +369,51 @@ class Session:
     def _send(self, conn, data):
         conn.send(data)
 
-    def _get_response(self, conn):
-        resp = conn.recv(self.max_chunk_size)
+    def _get_response(self, conn, method="GET", stream=False):
+        reader = SocketReader(conn, self.max_chunk_size)
+        status, message, headers = self._read_head(reader)
+        body = self._iter_body(reader, method, status, headers)
 
-        if len(resp) == 0:
-            raise EmptyResponse("Empty response from server")
+        if "content-encoding" in headers and self.decode_content:
+            body = iter_decoded(body, headers["content-encoding"])
+
+        if stream:
+            return status, message, headers, body
+        return status, message, headers, b"".join(body)
+
+    def _read_head(self, reader):
+        while True:
+            status, message, headers = self._parse_head(
+                reader.read_until(b"\r\n\r\n"))
+            # Skip interim responses such as 100 Continue.
+            if not 100 <= status < 200 or status == 101:
+                return status, message, headers
 
-        resp, data = resp.split(b"\r\n\r\n", 1)
-        resp = resp.decode()
-        status, raw_headers = resp.split("\r\n", 1)
-        version, status, message = status.split(" ", 2)
+    def _parse_head(self, head):
+        head = head.decode("iso-8859-1")
+        status_line, _, raw_headers = head[:-4].partition("\r\n")
+        version, status, message = (status_line.split(" ", 2) + [""])[:3]
 
         headers = CaseInsensitiveDict()
         for header in raw_headers.splitlines():
             header, value = header.split(":", 1)
-            if value.startswith(" "):
-                value = value[1:]
-            headers[header] = value
+            headers[header] = value.strip()
 
-        if "content-length" in headers:
-            goal = int(headers["content-length"])
-            while goal > len(data):
-                chunk = conn.recv(min(goal - len(data), self.max_chunk_size))
-                if len(chunk) == 0:
-                    raise RequestException("Empty chunk")
-                data += chunk
-
-        elif headers.get("transfer-encoding") == "chunked":
-            while True:
-                chunk = conn.recv(self.max_chunk_size)
-                if len(chunk) == 0 or chunk == b"0\r\n\r\n":
-                    break
-                data += chunk
-
-            raw = data
-            data = b""
-            while raw:
-                length, raw = raw.split(b"\r\n", 1)
-                length = int(length, 16)
-                chunk, raw = raw[:length], raw[length + 2:]
-                data += chunk
-
-        else:
-            while True:
-                chunk = conn.recv(self.max_chunk_size)
-                if len(chunk) == 0:
-                    break
-                data += chunk
+        return int(status), message, headers
 
-        if "content-encoding" in headers and self.decode_content:
-            data = self._decode_content(data, headers["content-encoding"])
+    def _iter_body(self, reader, method, status, headers):
+        if method == "HEAD" or status in (204, 304):
+            return iter(())
+        if "transfer-encoding" in headers \
+                and "chunked" in headers["transfer-encoding"].lower():
+            return iter_chunked(reader)
+        if "content-length" in headers:
+            return iter_length(
+                reader, int(headers["content-length"]), self.max_chunk_size)
+        return iter_until_close(reader, self.max_chunk_size)
 
-        return int(status), message, headers, data
+    def _release_after(self, body, release):
+        return ReleasingBody(body, release)
 
     def _encode_content(self, content, encoding):
         if encoding == "br":
@@ -273,16 +427,3 @@ class Session:
                 "Unknown encoding type '%s' while encoding content" % (encoding))
 
         return content
-
-    def _decode_content(self, content, encoding):
-        if encoding == "br":
-            content = brotli.decompress(content)
-        elif encoding == "gzip":
-            content = gzip.decompress(content)
-        elif encoding == "deflate":
-            content = zlib.decompress(content)
-        else:
-            raise UnsupportedEncoding(
-                "Unknown encoding type '%s' while decoding content" % (encoding))
-
-        return content
@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+class TLSSessionCache:
+    """Stores TLS sessions per SSL context and (host, port, verify) so new
+    connections can resume them instead of doing a full handshake.
+
+    A session can only be resumed with the context that created it, and every
+    ``Session`` has its own contexts, so sessions are kept apart by context.
+
+    Handshake counts and times are tracked so resumption can be checked.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries if max_entries is not None else 1024
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_time = 0.0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, context, key):
+        with self._lock:
+            entry = self._sessions.get((id(context),) + tuple(key))
+        # the context is kept with the session, so a reused id can't match
+        if entry is not None and entry[0] is context:
+            return entry[1]
+        return None
+
+    def store(self, key, conn):
+        session = getattr(conn, "session", None)
+        if session is None:
+            return
+        context = conn.context
+        key = (id(context),) + tuple(key)
+        with self._lock:
+            if key not in self._sessions \
+                    and len(self._sessions) >= self.max_entries:
+                self._sessions.pop(next(iter(self._sessions)))
+            self._sessions[key] = (context, session)
+
+    def forget(self, context, key):
+        with self._lock:
+            self._sessions.pop((id(context),) + tuple(key), None)
+
+    def wrap(self, context, sock, key, server_hostname):
+        """Wraps ``sock`` with ``context``, resuming a stored session for
+        ``key`` when there is one. A session that can't be resumed is
+        dropped and a full handshake is done instead."""
+        session = self.get(context, key)
+        start = time.monotonic()
+        conn = context.wrap_socket(
+            sock, server_hostname=server_hostname,
+            do_handshake_on_connect=False)
+        try:
+            if session is not None:
+                try:
+                    conn.session = session
+                except ValueError:
+                    self.forget(context, key)
+                    session = None
+            conn.do_handshake()
+        except Exception:
+            conn.close()
+            if session is not None:
+                self.forget(context, key)
+            raise
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.handshakes += 1
+            self.handshake_time += elapsed
+            if conn.session_reused:
+                self.resumed += 1
+        self.store(key, conn)
+        return conn
+
+    def stats(self):
+        with self._lock:
+            return {
+                "handshakes": self.handshakes,
+                "resumed": self.resumed,
+                "handshake_time": self.handshake_time,
+                "sessions": len(self._sessions)
+            }
+
+
+default_tls_sessions = TLSSessionCache()